@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010, 2011, 2012, 2013 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.    See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+"""
+Benchmark the ISR and calibration-building code of obs_lsstSim on synthetic data.
+
+Each benchmark is a subcommand; run with --help for the list.
+"""
+import argparse
+import multiprocessing
+import resource
+import time
+
+import numpy
+
+import lsst.afw.image as afwImage
+import lsst.afw.math as afwMath
+import lsst.geom as geom
+import lsst.ip.isr as isr
+from lsst.obs.lsstSim.ampParallel import AmpStageExecutor, maskSaturated, subtractBias, setVarianceFromImage
+from lsst.obs.lsstSim.eimageIsr import EimageIsrTask
+from lsst.obs.lsstSim.numpyStack import stackMaskedImages
+
+# dimensions of a raw LSST simulated amplifier, including prescan and extended register
+AMP_WIDTH = 513
+AMP_HEIGHT = 2001
+NUM_AMPS = 16
+# dimensions of an LSST simulated eimage
+EIMAGE_WIDTH = 4000
+EIMAGE_HEIGHT = 4072
+
+
+def makeAmpImage(rng, width=AMP_WIDTH, height=AMP_HEIGHT, level=1000., saturation=None):
+    """Make a synthetic amplifier masked image with Poisson noise about level"""
+    mi = afwImage.MaskedImageF(geom.Box2I(geom.Point2I(0, 0), geom.Extent2I(width, height)))
+    mi.getImage().getArray()[:] = rng.poisson(level, size=(height, width))
+    if saturation is not None:
+        mi.getImage().getArray()[rng.random_sample((height, width)) < 1e-3] = saturation
+    mi.getVariance().set(1.)
+    return mi
+
+
+def timeIt(func, numRepeat):
+    """Return the best wall-clock time of numRepeat calls to func"""
+    best = None
+    for i in range(numRepeat):
+        t0 = time.time()
+        func()
+        elapsed = time.time() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def benchmarkAmpThreads(args):
+    """Time the amp-parallel saturation/bias/variance stages against the number of threads"""
+    rng = numpy.random.RandomState(args.seed)
+    saturation = 100000.
+    ampList = [makeAmpImage(rng, saturation=saturation) for i in range(NUM_AMPS)]
+    biasList = [makeAmpImage(rng, level=10.) for i in range(NUM_AMPS)]
+    satBit = ampList[0].getMask().getPlaneBitMask("SAT")
+
+    def correct(index):
+        mi = ampList[index]
+        maskSaturated(mi, saturation, satBit)
+        subtractBias(mi, biasList[index])
+        setVarianceFromImage(mi, 1.7, 7.)
+
+    print("%8s %10s %8s" % ("threads", "time (s)", "speedup"))
+    serialTime = None
+    for numThreads in args.threads:
+        executor = AmpStageExecutor(numThreads)
+        elapsed = timeIt(lambda: executor.map(correct, range(NUM_AMPS)), args.repeat)
+        executor.close()
+        if serialTime is None:
+            serialTime = elapsed
+        print("%8d %10.4f %8.2f" % (numThreads, elapsed, serialTime/elapsed))
+
+
+def benchmarkCombine(args):
+    """Time and compare the afw and numpy engines for stacking amp frames"""
+    rng = numpy.random.RandomState(args.seed)
+    statsCtrl = afwMath.StatisticsControl()
+    statsCtrl.setNumSigmaClip(3.)
+    statsCtrl.setNumIter(3)
+    print("%6s %9s %10s %10s %8s %12s" %
+          ("frames", "method", "afw (s)", "numpy (s)", "speedup", "max |diff|"))
+    for numFrames in args.frames:
+        miList = [makeAmpImage(rng, saturation=1e5) for i in range(numFrames)]
+        for method, statistic in (("MEANCLIP", afwMath.MEANCLIP), ("MEDIAN", afwMath.MEDIAN)):
+            result = {}
+
+            def runAfw():
+                result["afw"] = afwMath.statisticsStack(miList, statistic, statsCtrl)
+
+            def runNumpy():
+                result["numpy"] = stackMaskedImages(miList, method=method, numSigmaClip=3., numIter=3,
+                                                    rowsPerChunk=args.rowsPerChunk)
+            afwTime = timeIt(runAfw, args.repeat)
+            numpyTime = timeIt(runNumpy, args.repeat)
+            diff = result["afw"].getImage().getArray() - result["numpy"].getImage().getArray()
+            print("%6d %9s %10.4f %10.4f %8.2f %12.3g" %
+                  (numFrames, method, afwTime, numpyTime, afwTime/numpyTime, numpy.nanmax(numpy.abs(diff))))
+
+
+def _interpolateEimage(args):
+    """Mask and interpolate the saturation of a synthetic eimage; return (time, peak RSS in MiB)
+
+    Run in a forked child so that its peak resident memory is that of one sensor.
+    """
+    seed, method = args
+    rng = numpy.random.RandomState(seed)
+    task = EimageIsrTask()
+    satVal = task.config.sat_val
+    mi = afwImage.MaskedImageF(geom.Box2I(geom.Point2I(0, 0), geom.Extent2I(EIMAGE_WIDTH, EIMAGE_HEIGHT)))
+    image = mi.getImage().getArray()
+    image[:] = rng.poisson(1000., size=image.shape)
+    for i in range(20):
+        x0, y0 = rng.randint(0, EIMAGE_WIDTH - 20), rng.randint(0, EIMAGE_HEIGHT - 200)
+        image[y0:y0 + rng.randint(10, 200), x0:x0 + rng.randint(2, 20)] = satVal + 1.
+    mi.getVariance().getArray()[:] = image
+    t0 = time.time()
+    isr.makeThresholdMask(maskedImage=mi, threshold=satVal, growFootprints=0, maskName='SAT')
+    if method == "transpose":
+        mi = isr.transposeMaskedImage(mi)
+        isr.interpolateFromMask(maskedImage=mi, fwhm=task.config.interp_size,
+                                growSaturatedFootprints=0, maskNameList=['SAT'])
+        mi = isr.transposeMaskedImage(mi)
+    else:
+        task.interpolateSaturation(mi)
+    elapsed = time.time() - t0
+    return elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.
+
+
+def benchmarkEimageSat(args):
+    """Time and measure the peak memory of the SAT interpolation of one eimage, with and without
+    transposing the whole image
+    """
+    print("%10s %10s %14s" % ("method", "time (s)", "peak RSS (MiB)"))
+    for method in ("transpose", "columns"):
+        bestTime = None
+        peakRss = 0.
+        for i in range(args.repeat):
+            pool = multiprocessing.get_context("fork").Pool(processes=1, maxtasksperchild=1)
+            elapsed, rss = pool.apply(_interpolateEimage, ((args.seed, method),))
+            pool.close()
+            pool.join()
+            bestTime = elapsed if bestTime is None else min(bestTime, elapsed)
+            peakRss = max(peakRss, rss)
+        print("%10s %10.4f %14.1f" % (method, bestTime, peakRss))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5, help="number of repetitions; the best is reported")
+    parser.add_argument("--seed", type=int, default=1, help="random number seed for the synthetic data")
+    subparsers = parser.add_subparsers(dest="benchmark")
+    subparsers.required = True
+
+    ampThreadsParser = subparsers.add_parser("ampThreads", help=benchmarkAmpThreads.__doc__)
+    ampThreadsParser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4, 8, 16],
+                                  help="numbers of threads to time")
+    ampThreadsParser.set_defaults(func=benchmarkAmpThreads)
+
+    combineParser = subparsers.add_parser("combine", help=benchmarkCombine.__doc__)
+    combineParser.add_argument("--frames", type=int, nargs="+", default=[5, 20, 50],
+                               help="numbers of frames to stack")
+    combineParser.add_argument("--rowsPerChunk", type=int, default=64,
+                               help="rows stacked at a time by the numpy engine")
+    combineParser.set_defaults(func=benchmarkCombine)
+
+    eimageSatParser = subparsers.add_parser("eimageSat", help=benchmarkEimageSat.__doc__)
+    eimageSatParser.set_defaults(func=benchmarkEimageSat)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -25,12 +25,21 @@ Produce the camera description FITS files from phosim text files.
 
 Scons should have automatically run this when building obs_lsstSim. To produce
 the same files that scons would have, run with no arguments.
+
+With --incremental an existing output directory is updated in place: the amp info
+file of a detector is only rewritten if its inputs have changed since it was written.
 """
 import argparse
+import functools
+import hashlib
+import json
+import multiprocessing
 import os
 import re
 import shutil
 
+import numpy
+
 import lsst.utils
 import lsst.afw.geom as afwGeom
 import lsst.afw.table as afwTable
@@ -70,136 +79,272 @@ def detectorIdFromAbbrevName(abbrevName):
     return detectorId
 
 
-def makeAmpTables(segmentsFile, gainFile):
-    """
-    Read the segments file from a PhoSim release and produce the appropriate AmpInfo
+# dtypes of the columns of the phosim description files used to build the camera
+SEGMENT_HEADER_DTYPE = [("name", "U32"), ("numAmps", "i8"), ("numx", "i8"), ("numy", "i8")]
+SEGMENT_DTYPE = [("name", "U32"), ("yStart", "i8"), ("yEnd", "i8"), ("x0", "i8"), ("x1", "i8"),
+                 ("flipX", "i8"), ("flipY", "i8"), ("gain", "f8"), ("readNoise", "f8")]
+SEGMENT_COLUMNS = (0, 1, 2, 3, 4, 5, 6, 7, 11)
+GAIN_DTYPE = [("name", "U32"), ("gain", "f8"), ("saturation", "i8")]
+LAYOUT_DTYPE = [("name", "U32"), ("x", "f8"), ("y", "f8"), ("pixelSize", "f8"), ("numx", "i8"),
+                ("numy", "i8"), ("group", "U32"), ("yaw", "f8"), ("pitch", "f8"), ("roll", "f8"),
+                ("dx", "f8"), ("dy", "f8")]
+LAYOUT_COLUMNS = (0, 1, 2, 3, 4, 5, 8, 9, 10, 11, 12, 13)
+# amp rows as written to the per-detector amp info files
+AMP_DTYPE = [("name", "U32"), ("x0", "i8"), ("y0", "i8"), ("x1", "i8"), ("y1", "i8"), ("flipX", "?"),
+             ("flipY", "?"), ("gain", "f8"), ("saturation", "i8"), ("readNoise", "f8")]
+MANIFEST_NAME = "ampInfoManifest.json"
+
+
+def readDataLines(path):
+    """Return the lines of a phosim description file that are not comments or blank"""
+    with open(path) as fh:
+        return [line for line in fh if line.strip() and not line.startswith("#")]
+
+
+def readGains(gainFile):
+    """Read the gain/saturation file as a structured array with fields name, gain and saturation"""
+    return numpy.loadtxt(readDataLines(gainFile), dtype=GAIN_DTYPE, ndmin=1)
+
+
+def readSegments(segmentsFile, gainFile):
+    """Read the segmentation and gain/saturation files as structured arrays
+
+    The segmentation file lists each detector followed by its amps; the amps are told apart
+    from the detectors by their names, which end in _Cxy.
 
     @param segmentsFile (str) full path to the segmentation file.
     @param gainFile (str) full path to the gain/saturation file.
 
-    @return (dict) per amp dictionary of ampCatalogs
+    @return (detectors, amps, detIndex): detectors has the fields of SEGMENT_HEADER_DTYPE,
+        amps those of AMP_DTYPE, and detIndex is the index in detectors of the detector of each amp
+    """
+    lines = readDataLines(segmentsFile)
+    names = numpy.array([line.split(None, 1)[0] for line in lines])
+    suffix = numpy.char.rpartition(names, "_")[:, 2]
+    isAmp = (numpy.char.str_len(suffix) == 3) & numpy.char.startswith(suffix, "C")
+    detectors = numpy.loadtxt([line for line, amp in zip(lines, isAmp) if not amp],
+                              dtype=SEGMENT_HEADER_DTYPE, ndmin=1)
+    segments = numpy.loadtxt([line for line, amp in zip(lines, isAmp) if amp], dtype=SEGMENT_DTYPE,
+                             usecols=SEGMENT_COLUMNS, ndmin=1)
+    detIndex = numpy.cumsum(~isAmp)[isAmp] - 1
+    if (detIndex < 0).any():
+        raise RuntimeError("Amp %s precedes the first detector in %s" % (segments["name"][0], segmentsFile))
+
+    amps = numpy.zeros(len(segments), dtype=AMP_DTYPE)
+    amps["name"] = segments["name"]
+    # Because of the camera coordinate system, we choose an
+    # image coordinate system that requires a -90 rotation to get
+    # the correct pixel positions from the
+    # phosim segments file
+    numy = detectors["numx"][detIndex]
+    amps["y0"] = numy - 1 - segments["yEnd"]
+    amps["y1"] = numy - 1 - segments["yStart"]
+    # Another quirk of the phosim file is that one of the wavefront sensor
+    # chips has an offset of 2000 pix in y.  It's always the 'C1' chip.
+    isWavefront = (numpy.char.count(detectors["name"], "_") == 2)[detIndex]
+    correctY0 = isWavefront & (amps["y0"] > 0)
+    amps["y1"][correctY0] -= amps["y0"][correctY0]
+    amps["y0"][correctY0] = 0
+    amps["x0"] = segments["x0"]
+    amps["x1"] = segments["x1"]
+    amps["flipX"] = segments["flipX"] != -1
+    amps["flipY"] = segments["flipY"] != 1
+    amps["readNoise"] = segments["readNoise"]
+
+    # Set default if no gain exists
+    amps["gain"] = segments["gain"]
+    amps["saturation"] = 65535
+    gains = numpy.sort(readGains(gainFile), order="name")
+    index = numpy.clip(numpy.searchsorted(gains["name"], amps["name"]), 0, max(len(gains) - 1, 0))
+    if len(gains) > 0:
+        found = gains["name"][index] == amps["name"]
+        amps["gain"][found] = gains["gain"][index[found]]
+        amps["saturation"][found] = gains["saturation"][index[found]]
+    return detectors, amps, detIndex
+
+
+def makeAmplifiers(ampRows):
+    """Make the Amplifier.Builders of a detector
+
+    @param ampRows (numpy structured array) rows of the amps of the detector, with the fields of
+        AMP_DTYPE
+
+    @return (list) the Amplifier.Builders, in the order of ampRows
     """
-    gainDict = {}
-    with open(gainFile) as fh:
-        for l in fh:
-            els = l.rstrip().split()
-            gainDict[els[0]] = {'gain': float(els[1]), 'saturation': int(els[2])}
-    returnDict = {}
     # TODO currently there is no linearity provided, but we should identify
     # how to get this information.
     linearityCoeffs = (0., 1., 0., 0.)
     linearityType = NullLinearityType
-    readoutMap = {'LL': ReadoutCorner.LL,
-                  'LR': ReadoutCorner.LR,
-                  'UR': ReadoutCorner.UR,
-                  'UL': ReadoutCorner.UL}
+    # Since the amps are stored in amp coordinates, the readout is the same
+    # for all amps
+    readCorner = ReadoutCorner.LL
+    # Because in versions v3.3.2 and earlier there was no overscan, we use the extended register
+    # as the overscan region
+    prescan = 1
+    hoverscan = 0
+    extended = 4
+    voverscan = 0
+    extraRawX = extended + hoverscan
+    extraRawY = prescan + voverscan
 
     ampCatalog = []
-    detectorName = []  # set to a value that is an invalid dict key, to catch bugs
-    correctY0 = False
-    with open(segmentsFile) as fh:
-        for l in fh:
-            if l.startswith("#"):
-                continue
-
-            els = l.rstrip().split()
-            if len(els) == 4:
-                if len(ampCatalog) != 0:
-                    returnDict[detectorName] = ampCatalog
-                detectorName = expandDetectorName(els[0])
-                numy = int(els[2])
-
-                ampCatalog = []
-                if len(els[0].split('_')) == 3:  # wavefront sensor
-                    correctY0 = True
-                else:
-                    correctY0 = False
-                continue
-            amplifier = Amplifier.Builder()
-            name = els[0].split("_")[-1]
-            name = '%s,%s'%(name[1], name[2])
-            # Because of the camera coordinate system, we choose an
-            # image coordinate system that requires a -90 rotation to get
-            # the correct pixel positions from the
-            # phosim segments file
-            y0 = numy - 1 - int(els[2])
-            y1 = numy - 1 - int(els[1])
-            # Another quirk of the phosim file is that one of the wavefront sensor
-            # chips has an offset of 2000 pix in y.  It's always the 'C1' chip.
-            if correctY0:
-                if y0 > 0:
-                    y1 -= y0
-                    y0 = 0
-            x0 = int(els[3])
-            x1 = int(els[4])
-            try:
-                saturation = gainDict[els[0]]['saturation']
-                gain = gainDict[els[0]]['gain']
-            except KeyError:
-                # Set default if no gain exists
-                saturation = 65535
-                gain = float(els[7])
-            readnoise = float(els[11])
-            bbox = geom.Box2I(geom.Point2I(x0, y0), geom.Point2I(x1, y1))
-
-            if int(els[5]) == -1:
-                flipx = False
-            else:
-                flipx = True
-            if int(els[6]) == 1:
-                flipy = False
-            else:
-                flipy = True
-
-            # Since the amps are stored in amp coordinates, the readout is the same
-            # for all amps
-            readCorner = readoutMap['LL']
-
-            ndatax = x1 - x0 + 1
-            ndatay = y1 - y0 + 1
-            # Because in versions v3.3.2 and earlier there was no overscan, we use the extended register
-            # as the overscan region
-            prescan = 1
-            hoverscan = 0
-            extended = 4
-            voverscan = 0
-            rawBBox = geom.Box2I(geom.Point2I(0, 0),
-                                 geom.Extent2I(extended+ndatax+hoverscan, prescan+ndatay+voverscan))
-            rawDataBBox = geom.Box2I(geom.Point2I(extended, prescan), geom.Extent2I(ndatax, ndatay))
-            rawHorizontalOverscanBBox = geom.Box2I(geom.Point2I(0, prescan),
-                                                   geom.Extent2I(extended, ndatay))
-            rawVerticalOverscanBBox = geom.Box2I(geom.Point2I(extended, prescan+ndatay),
-                                                 geom.Extent2I(ndatax, voverscan))
-            rawPrescanBBox = geom.Box2I(geom.Point2I(extended, 0), geom.Extent2I(ndatax, prescan))
-
-            extraRawX = extended + hoverscan
-            extraRawY = prescan + voverscan
-            rawx0 = x0 + extraRawX*(x0//ndatax)
-            rawy0 = y0 + extraRawY*(y0//ndatay)
-            # Set the elements of the amplifier for this amp
-            amplifier.setBBox(bbox)
-            amplifier.setName(name)
-            amplifier.setReadoutCorner(readCorner)
-            amplifier.setGain(gain)
-            amplifier.setSaturation(saturation)
-            amplifier.setSuspectLevel(float("nan"))
-            amplifier.setReadNoise(readnoise)
-            amplifier.setLinearityCoeffs(linearityCoeffs)
-            amplifier.setLinearityType(linearityType)
-            #            amplifier.setHasRawInfo(True)
-            amplifier.setRawFlipX(flipx)
-            amplifier.setRawFlipY(flipy)
-            amplifier.setRawBBox(rawBBox)
-            amplifier.setRawXYOffset(geom.Extent2I(rawx0, rawy0))
-            amplifier.setRawDataBBox(rawDataBBox)
-            amplifier.setRawHorizontalOverscanBBox(rawHorizontalOverscanBBox)
-            amplifier.setRawVerticalOverscanBBox(rawVerticalOverscanBBox)
-            amplifier.setRawPrescanBBox(rawPrescanBBox)
-            ampCatalog.append(amplifier)
-    returnDict[detectorName] = ampCatalog
+    for row in ampRows.tolist():
+        ampName, x0, y0, x1, y1, flipx, flipy, gain, saturation, readnoise = row
+        amplifier = Amplifier.Builder()
+        name = ampName.split("_")[-1]
+        name = '%s,%s'%(name[1], name[2])
+        bbox = geom.Box2I(geom.Point2I(x0, y0), geom.Point2I(x1, y1))
+
+        ndatax = x1 - x0 + 1
+        ndatay = y1 - y0 + 1
+        rawBBox = geom.Box2I(geom.Point2I(0, 0),
+                             geom.Extent2I(extended+ndatax+hoverscan, prescan+ndatay+voverscan))
+        rawDataBBox = geom.Box2I(geom.Point2I(extended, prescan), geom.Extent2I(ndatax, ndatay))
+        rawHorizontalOverscanBBox = geom.Box2I(geom.Point2I(0, prescan),
+                                               geom.Extent2I(extended, ndatay))
+        rawVerticalOverscanBBox = geom.Box2I(geom.Point2I(extended, prescan+ndatay),
+                                             geom.Extent2I(ndatax, voverscan))
+        rawPrescanBBox = geom.Box2I(geom.Point2I(extended, 0), geom.Extent2I(ndatax, prescan))
+
+        rawx0 = x0 + extraRawX*(x0//ndatax)
+        rawy0 = y0 + extraRawY*(y0//ndatay)
+        # Set the elements of the amplifier for this amp
+        amplifier.setBBox(bbox)
+        amplifier.setName(name)
+        amplifier.setReadoutCorner(readCorner)
+        amplifier.setGain(gain)
+        amplifier.setSaturation(saturation)
+        amplifier.setSuspectLevel(float("nan"))
+        amplifier.setReadNoise(readnoise)
+        amplifier.setLinearityCoeffs(linearityCoeffs)
+        amplifier.setLinearityType(linearityType)
+        #            amplifier.setHasRawInfo(True)
+        amplifier.setRawFlipX(flipx)
+        amplifier.setRawFlipY(flipy)
+        amplifier.setRawBBox(rawBBox)
+        amplifier.setRawXYOffset(geom.Extent2I(rawx0, rawy0))
+        amplifier.setRawDataBBox(rawDataBBox)
+        amplifier.setRawHorizontalOverscanBBox(rawHorizontalOverscanBBox)
+        amplifier.setRawVerticalOverscanBBox(rawVerticalOverscanBBox)
+        amplifier.setRawPrescanBBox(rawPrescanBBox)
+        ampCatalog.append(amplifier)
+    return ampCatalog
+
+
+def makeAmpRows(segmentsFile, gainFile):
+    """
+    Read the segments file from a PhoSim release and group its amps by detector
+
+    @param segmentsFile (str) full path to the segmentation file.
+    @param gainFile (str) full path to the gain/saturation file.
+
+    @return (dict) per detector structured array of amp rows, with the fields of AMP_DTYPE
+    """
+    detectors, amps, detIndex = readSegments(segmentsFile, gainFile)
+    returnDict = {}
+    for i, detectorName in enumerate(detectors["name"].tolist()):
+        ampRows = amps[detIndex == i]
+        if len(ampRows) != 0:
+            returnDict[expandDetectorName(detectorName)] = ampRows
     return returnDict
 
 
+def makeAmpTables(segmentsFile, gainFile):
+    """
+    Read the segments file from a PhoSim release and produce the appropriate AmpInfo
+
+    @param segmentsFile (str) full path to the segmentation file.
+    @param gainFile (str) full path to the gain/saturation file.
+
+    @return (dict) per amp dictionary of ampCatalogs
+    """
+    return {detectorName: makeAmplifiers(ampRows)
+            for detectorName, ampRows in makeAmpRows(segmentsFile, gainFile).items()}
+
+
+def writeAmpInfo(detectorName, ampRows, outDir):
+    """Write the amp info FITS file of one detector
+
+    @param detectorName (str) full name of the detector
+    @param ampRows (numpy structured array) rows of its amps, with the fields of AMP_DTYPE
+    @param outDir (str) output directory
+
+    @return (str) path of the file written
+    """
+    shortDetectorName = LsstSimMapper.getShortCcdName(detectorName)
+    ampInfoPath = os.path.join(outDir, shortDetectorName + ".fits")
+    protoTypeSchema = lsst.afw.cameraGeom.Amplifier.getRecordSchema()
+    detectorTable = afwTable.BaseCatalog(protoTypeSchema)
+    for amp in makeAmplifiers(ampRows):
+        record = detectorTable.makeRecord()
+        tempAmp = amp.finish()
+        tempAmp.toRecord(record)
+        detectorTable.append(record)
+    detectorTable.writeFits(filename=ampInfoPath)
+    return ampInfoPath
+
+
+def _writeAmpInfo(args):
+    """Call writeAmpInfo(*args) in a pool process"""
+    return writeAmpInfo(*args)
+
+
+def writeAmpInfoFiles(ampRowsDict, outDir, numProcesses=1):
+    """Write the amp info FITS files of many detectors, in parallel if numProcesses > 1
+
+    @param ampRowsDict (dict) detector name: structured array of its amp rows
+    @param outDir (str) output directory
+    @param numProcesses (int) number of processes writing files
+
+    @return (list) paths of the files written
+    """
+    argList = [(detectorName, ampRows, outDir) for detectorName, ampRows in ampRowsDict.items()]
+    if numProcesses <= 1 or len(argList) <= 1:
+        return [_writeAmpInfo(args) for args in argList]
+    with multiprocessing.get_context("fork").Pool(processes=min(numProcesses, len(argList))) as pool:
+        return pool.map(_writeAmpInfo, argList, chunksize=1)
+
+
+@functools.lru_cache(maxsize=None)
+def _getScriptSource():
+    """Return the source of this script, as bytes"""
+    with open(__file__, "rb") as fh:
+        return fh.read()
+
+
+def ampRowsDigest(detectorName, ampRows):
+    """Return a hash of everything that goes into the amp info file of a detector
+
+    The hash includes the source of this script, so changing how the files are made
+    invalidates them all.
+
+    @param detectorName (str) full name of the detector
+    @param ampRows (numpy structured array) rows of its amps, with the fields of AMP_DTYPE
+    """
+    digest = hashlib.sha1(_getScriptSource())
+    digest.update(detectorName.encode())
+    digest.update(str(ampRows.dtype.descr).encode())
+    digest.update(numpy.ascontiguousarray(ampRows).tobytes())
+    return digest.hexdigest()
+
+
+def readManifest(outDir):
+    """Return the dict of short detector name: ampRowsDigest of the files in outDir, if any"""
+    manifestPath = os.path.join(outDir, MANIFEST_NAME)
+    if not os.path.exists(manifestPath):
+        return {}
+    with open(manifestPath) as fh:
+        return json.load(fh)
+
+
+def writeManifest(outDir, manifest):
+    """Atomically write the dict of short detector name: ampRowsDigest of the files in outDir"""
+    manifestPath = os.path.join(outDir, MANIFEST_NAME)
+    with open(manifestPath + ".tmp", "w") as fh:
+        json.dump(manifest, fh, indent=1, sort_keys=True)
+    os.replace(manifestPath + ".tmp", manifestPath)
+
+
 def makeLongName(shortName):
     """
     Make the long name from the PhoSim short name
@@ -230,40 +375,39 @@ def makeDetectorConfigs(detectorLayoutFile, phosimVersion):
     detTypeMap = {"Group2": 2, "Group1": 3, "Group0": 0}
     # We know we need to rotate 3 times and also apply the yaw perturbation
     nQuarter = 1
-    with open(detectorLayoutFile) as fh:
-        for l in fh:
-            if l.startswith("#"):
-                continue
-            detConfig = DetectorConfig()
-            els = l.rstrip().split()
-            detConfig.name = expandDetectorName(els[0])
-            detConfig.id = detectorIdFromAbbrevName(els[0])
-            detConfig.bbox_x0 = 0
-            detConfig.bbox_y0 = 0
-            detConfig.bbox_x1 = int(els[5]) - 1
-            detConfig.bbox_y1 = int(els[4]) - 1
-            detConfig.detectorType = detTypeMap[els[8]]
-            detConfig.serial = els[0]+"_"+phosimVersion
-
-            # Convert from microns to mm.
-            detConfig.offset_x = float(els[1])/1000. + float(els[12])
-            detConfig.offset_y = float(els[2])/1000. + float(els[13])
-
-            detConfig.refpos_x = (int(els[5]) - 1.)/2.
-            detConfig.refpos_y = (int(els[4]) - 1.)/2.
-            # TODO translate between John's angles and Orientation angles.
-            # It's not an issue now because there is no rotation except about z in John's model.
-            detConfig.yawDeg = 90.*nQuarter + float(els[9])
-            detConfig.pitchDeg = float(els[10])
-            detConfig.rollDeg = float(els[11])
-            detConfig.pixelSize_x = float(els[3])/1000.
-            detConfig.pixelSize_y = float(els[3])/1000.
-            detConfig.transposeDetector = False
-            detConfig.transformDict.nativeSys = PIXELS.getSysName()
-            # The FOCAL_PLANE and TAN_PIXEL transforms are generated by the Camera maker,
-            # based on orientaiton and other data.
-            # Any additional transforms (such as ACTUAL_PIXELS) should be inserted here.
-            detectorConfigs.append(detConfig)
+    layout = numpy.loadtxt(readDataLines(detectorLayoutFile), dtype=LAYOUT_DTYPE, usecols=LAYOUT_COLUMNS,
+                           ndmin=1)
+    for row in layout.tolist():
+        name, x, y, pixelSize, numx, numy, group, yaw, pitch, roll, dx, dy = row
+        detConfig = DetectorConfig()
+        detConfig.name = expandDetectorName(name)
+        detConfig.id = detectorIdFromAbbrevName(name)
+        detConfig.bbox_x0 = 0
+        detConfig.bbox_y0 = 0
+        detConfig.bbox_x1 = numy - 1
+        detConfig.bbox_y1 = numx - 1
+        detConfig.detectorType = detTypeMap[group]
+        detConfig.serial = name+"_"+phosimVersion
+
+        # Convert from microns to mm.
+        detConfig.offset_x = x/1000. + dx
+        detConfig.offset_y = y/1000. + dy
+
+        detConfig.refpos_x = (numy - 1.)/2.
+        detConfig.refpos_y = (numx - 1.)/2.
+        # TODO translate between John's angles and Orientation angles.
+        # It's not an issue now because there is no rotation except about z in John's model.
+        detConfig.yawDeg = 90.*nQuarter + yaw
+        detConfig.pitchDeg = pitch
+        detConfig.rollDeg = roll
+        detConfig.pixelSize_x = pixelSize/1000.
+        detConfig.pixelSize_y = pixelSize/1000.
+        detConfig.transposeDetector = False
+        detConfig.transformDict.nativeSys = PIXELS.getSysName()
+        # The FOCAL_PLANE and TAN_PIXEL transforms are generated by the Camera maker,
+        # based on orientaiton and other data.
+        # Any additional transforms (such as ACTUAL_PIXELS) should be inserted here.
+        detectorConfigs.append(detConfig)
     return detectorConfigs
 
 
@@ -310,8 +454,15 @@ if __name__ == "__main__":
                         )
     parser.add_argument("--clobber", action="store_true", dest="clobber", default=False,
                         help=("remove and re-create the output directory if it already exists?"))
+    parser.add_argument("--incremental", action="store_true", default=False,
+                        help="update an existing output directory, only rewriting the amp info files "
+                        "of detectors whose inputs have changed")
+    parser.add_argument("-j", "--processes", type=int, default=multiprocessing.cpu_count(),
+                        help="number of processes writing amp info files")
     args = parser.parse_args()
-    ampTableDict = makeAmpTables(args.SegmentsFile, args.GainFile)
+    if args.incremental and args.clobber:
+        parser.error("--incremental and --clobber are mutually exclusive")
+    ampRowsDict = makeAmpRows(args.SegmentsFile, args.GainFile)
     if args.phosimVersion is None:
         phosimVersion = getPhosimVersion(defaultDataDir)
     else:
@@ -361,19 +512,29 @@ if __name__ == "__main__":
 
     # write data products
     outDir = args.OutputDir
-    makeDir(dirPath=outDir, doClobber=args.clobber)
+    if args.incremental and os.path.isdir(outDir):
+        oldManifest = readManifest(outDir)
+    else:
+        makeDir(dirPath=outDir, doClobber=args.clobber)
+        oldManifest = {}
 
     camConfigPath = os.path.join(outDir, "camera.py")
     camConfig.save(camConfigPath)
 
-    for detectorName, ampTable in ampTableDict.items():
+    manifest = {}
+    toWrite = {}
+    for detectorName, ampRows in ampRowsDict.items():
         shortDetectorName = LsstSimMapper.getShortCcdName(detectorName)
+        manifest[shortDetectorName] = ampRowsDigest(detectorName, ampRows)
+        if manifest[shortDetectorName] != oldManifest.get(shortDetectorName) or \
+                not os.path.exists(os.path.join(outDir, shortDetectorName + ".fits")):
+            toWrite[detectorName] = ampRows
+    for shortDetectorName in set(oldManifest) - set(manifest):
         ampInfoPath = os.path.join(outDir, shortDetectorName + ".fits")
-        protoTypeSchema = lsst.afw.cameraGeom.Amplifier.getRecordSchema()
-        detectorTable = afwTable.BaseCatalog(protoTypeSchema)
-        for amp in ampTable:
-            record = detectorTable.makeRecord()
-            tempAmp = amp.finish()
-            tempAmp.toRecord(record)
-            detectorTable.append(record)
-        detectorTable.writeFits(filename=ampInfoPath)
+        if os.path.exists(ampInfoPath):
+            print("Removing %r" % (ampInfoPath,))
+            os.remove(ampInfoPath)
+
+    writeAmpInfoFiles(toWrite, outDir, numProcesses=args.processes)
+    writeManifest(outDir, manifest)
+    print("Wrote %d of %d amp info files" % (len(toWrite), len(manifest)))
@@ -20,42 +20,124 @@
 # the GNU General Public License along with this program.  If not,
 # see <http://www.lsstcorp.org/LegalNotices/>.
 #
+import multiprocessing
+import os
 import sys
+import time
 import traceback
 
 from lsst.pipe.base import ArgumentParser
+from lsst.obs.lsstSim.flatNorm import FlatStatsTable
 from lsst.obs.lsstSim.processCalibLsstSim import ProcessCalibLsstSimTask as TaskClass
 
+# State shared with the worker processes, set before the pool is created so that forked
+# workers inherit the task and data references instead of unpickling them.
+_poolState = {}
+
+
+def groupKey(dataId):
+    """Return a hashable key for the sensor of a dataId: its items other than the visit, sorted"""
+    return tuple(sorted((k, v) for k, v in dataId.items() if k != 'visit'))
+
+
+def outputExists(dataRefList, calibType):
+    """Return True if the master calibration of every amp of a sensor group has been written"""
+    butler = dataRefList[0].butlerSubset.butler
+    ampList = [amp for amp in dataRefList[0].subItems(level="channel") if amp.dataId['snap'] != 1]
+    return len(ampList) > 0 and all(butler.datasetExists(calibType, amp.dataId) for amp in ampList)
+
+
+def flatStaged(dataRefList, table):
+    """Return True if the unnormalized flat of every amp of a sensor group is staged in table"""
+    ampList = [amp for amp in dataRefList[0].subItems(level="channel") if amp.dataId['snap'] != 1]
+    return len(ampList) > 0 and table.containsAll([amp.dataId for amp in ampList])
+
+
+def runGroup(key):
+    """Build the master calibration of one sensor group
+
+    @return (key, elapsed time in sec or None if processing failed)
+    """
+    task = _poolState["task"]
+    t0 = time.time()
+    try:
+        task.runDataRef(_poolState["groups"][key], _poolState["calibType"])
+    except Exception as e:
+        task.log.fatal("Failed on dataId=%s: %s", dict(key), e)
+        traceback.print_exc(file=sys.stderr)
+        return key, None
+    return key, time.time() - t0
+
+
 if __name__ == "__main__":
     parser = ArgumentParser(name="argumentParser")
+    parser.add_argument("--skipExisting", action="store_true", default=False,
+                        help="skip sensors whose master calibration amps have all been written; for flats "
+                             "normalized over a raft or the focal plane, those whose amps are all staged "
+                             "in flatStageDir, since the normalization needs their statistics")
     namespace = parser.parse_args(config=TaskClass.ConfigClass())
     sensorDataRefLists = {}
     typeMap = {'0': 'bias', '1': 'dark', '2': 'flat_u', '3': 'flat_g', '4': 'flat_r',
                '5': 'flat_i', '6': 'flat_z', '7': 'flat_y'}
     types = []
     for dr in namespace.dataRefList:
-        tdict = eval(dr.dataId.__repr__())
-        types.append(typeMap[str(tdict['visit'])[4]])
-        del tdict['visit']
-        dstr = tdict.__repr__()
-        if dstr in sensorDataRefLists:
-            sensorDataRefLists[dstr].append(dr)
-        else:
-            sensorDataRefLists[dstr] = []
-            sensorDataRefLists[dstr].append(dr)
+        types.append(typeMap[str(dr.dataId['visit'])[4]])
+        sensorDataRefLists.setdefault(groupKey(dr.dataId), []).append(dr)
 
     type = types[0]
     for t in types:
         if not t == type:
             raise ValueError("All calib visits must be of the same type: %s is not %s"%(t, type))
 
-    task = TaskClass()
+    task = TaskClass(config=namespace.config)
     if type in ('flat_u', 'flat_g', 'flat_r', 'flat_i', 'flat_z', 'flat_y'):
         type = 'flat'
 
-    for k in sensorDataRefLists:
-        try:
-            task.runDataRef(sensorDataRefLists[k], type)
-        except Exception as e:
-            task.log.fatal("Failed on dataId=%s: %s", k, e)
-            traceback.print_exc(file=sys.stderr)
+    keyList = list(sensorDataRefLists)
+    if namespace.skipExisting and type == 'flat' and task.config.flatNormLevel != 'sensor':
+        # written flats have left the staging table, and their unnormalized statistics are lost, so
+        # only staged sensors can be skipped: the normalization is computed once all are staged
+        table = FlatStatsTable(os.path.join(task.config.flatStageDir, "flatStats.sqlite3"))
+        keyList = [k for k in keyList if not flatStaged(sensorDataRefLists[k], table)]
+        task.log.info("Skipping %d of %d sensors with staged flats",
+                      len(sensorDataRefLists) - len(keyList), len(sensorDataRefLists))
+    elif namespace.skipExisting:
+        keyList = [k for k in keyList if not outputExists(sensorDataRefLists[k], type)]
+        task.log.info("Skipping %d of %d sensors with existing outputs",
+                      len(sensorDataRefLists) - len(keyList), len(sensorDataRefLists))
+
+    numProcesses = min(namespace.processes, len(keyList)) if keyList else 1
+    if numProcesses > 1 and namespace.config.numProcesses != 1:
+        raise ValueError("Sensors (-j) and amps (config numProcesses) cannot both run in worker processes")
+    _poolState.update(task=task, groups=sensorDataRefLists, calibType=type)
+    if numProcesses > 1:
+        pool = multiprocessing.get_context("fork").Pool(processes=numProcesses)
+        resultIter = pool.imap_unordered(runGroup, keyList)
+    else:
+        pool = None
+        resultIter = (runGroup(k) for k in keyList)
+
+    t0 = time.time()
+    numFailed = 0
+    for i, (key, elapsed) in enumerate(resultIter):
+        if elapsed is None:
+            numFailed += 1
+        wallTime = time.time() - t0
+        task.log.info("Sensor %s %s; %d/%d sensors done (%d failed) in %.1f s, %.2f sensors/min",
+                      dict(key), "failed" if elapsed is None else "took %.1f s" % (elapsed,),
+                      i + 1, len(keyList), numFailed, wallTime, 60.*(i + 1)/wallTime if wallTime > 0 else 0.)
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    if type == 'flat' and task.config.flatNormLevel != 'sensor':
+        if numFailed > 0:
+            # normalizing now would leave out the failed sensors, and consume the staged flats that
+            # a rerun of those sensors (with --skipExisting) needs to normalize consistently
+            task.log.fatal("%d sensors failed; not normalizing the flats staged in %s. Rerun the failed "
+                           "sensors with --skipExisting to complete them.",
+                           numFailed, task.config.flatStageDir)
+            sys.exit(1)
+        # all the sensors are staged, so the raft or focal plane normalizations are known
+        task.writeStagedFlats(namespace.butler, task.config.flatStageDir, task.config.flatNormLevel,
+                              numProcesses=namespace.processes)
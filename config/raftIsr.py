@@ -0,0 +1,10 @@
+"""
+LSST Sim-specific overrides for LsstSimRaftIsrTask
+"""
+import os.path
+
+from lsst.utils import getPackageDir
+
+obsConfigDir = os.path.join(getPackageDir("obs_lsstSim"), "config")
+
+config.isr.load(os.path.join(obsConfigDir, "isr.py"))
@@ -0,0 +1,117 @@
+#
+# LSST Data Management System
+# Copyright 2008-2016 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+
+__all__ = ["AmpStageExecutor", "maskSaturated", "subtractBias", "setVarianceFromImage"]
+
+
+class AmpStageExecutor:
+    """Apply a function to each amplifier using a pool of threads
+
+    The afw implementations of the per-amplifier ISR stages hold the GIL, so threads give
+    little speedup with them.  The numpy kernels in this module do the same arithmetic with
+    numpy ufuncs, which release the GIL while they work on the pixel arrays, so functions
+    built from them can process several amplifiers of a sensor at once.
+
+    @param[in] numThreads  number of threads; if 1 the function is applied serially in the
+        calling thread
+    """
+
+    def __init__(self, numThreads=1):
+        if numThreads < 1:
+            raise RuntimeError("numThreads=%s must be positive" % (numThreads,))
+        self.numThreads = numThreads
+        self._pool = None
+
+    def map(self, func, itemList):
+        """Apply func to each item, returning the results in order
+
+        Exceptions raised by func are re-raised in the calling thread.
+        """
+        itemList = list(itemList)
+        if self.numThreads == 1 or len(itemList) <= 1:
+            return [func(item) for item in itemList]
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.numThreads)
+        return list(self._pool.map(func, itemList))
+
+    def close(self):
+        """Shut down the threads
+        """
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def __getstate__(self):
+        # thread pools can't be pickled or inherited by forked processes; make a new one on demand
+        state = self.__dict__.copy()
+        state["_pool"] = None
+        return state
+
+
+def maskSaturated(maskedImage, saturation, bitmask):
+    """Set bitmask in the mask of pixels at or above saturation
+
+    Equivalent to isrFunctions.makeThresholdMask with growFootprints=0.
+
+    @param[in,out] maskedImage  masked image to mask
+    @param[in] saturation  saturation level; nothing is done if it is NaN
+    @param[in] bitmask  mask bits to set
+    """
+    if numpy.isnan(saturation):
+        return
+    maskArr = maskedImage.getMask().getArray()
+    numpy.bitwise_or(maskArr, bitmask, out=maskArr,
+                     where=maskedImage.getImage().getArray() >= saturation)
+
+
+def subtractBias(maskedImage, biasMaskedImage):
+    """Subtract a bias frame in place, as MaskedImage -= bias does
+
+    The variances add and the masks are ORed.
+
+    @param[in,out] maskedImage  masked image to correct
+    @param[in] biasMaskedImage  bias masked image of the same dimensions
+    """
+    if maskedImage.getDimensions() != biasMaskedImage.getDimensions():
+        raise RuntimeError("Bias dimensions %s do not match %s" %
+                           (biasMaskedImage.getDimensions(), maskedImage.getDimensions()))
+    imageArr = maskedImage.getImage().getArray()
+    numpy.subtract(imageArr, biasMaskedImage.getImage().getArray(), out=imageArr)
+    maskArr = maskedImage.getMask().getArray()
+    numpy.bitwise_or(maskArr, biasMaskedImage.getMask().getArray(), out=maskArr)
+    varianceArr = maskedImage.getVariance().getArray()
+    numpy.add(varianceArr, biasMaskedImage.getVariance().getArray(), out=varianceArr)
+
+
+def setVarianceFromImage(maskedImage, gain, readNoise):
+    """Set the variance to image/gain + readNoise**2, as isrFunctions.updateVariance does
+
+    @param[in,out] maskedImage  masked image whose variance is set
+    @param[in] gain  amplifier gain
+    @param[in] readNoise  amplifier read noise
+    """
+    varianceArr = maskedImage.getVariance().getArray()
+    numpy.divide(maskedImage.getImage().getArray(), gain, out=varianceArr)
+    varianceArr += readNoise**2
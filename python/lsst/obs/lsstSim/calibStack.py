@@ -0,0 +1,138 @@
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010, 2011, 2012, 2013 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+import os
+import shutil
+import tempfile
+
+import lsst.afw.image as afwImage
+import lsst.afw.math as afwMath
+import numpy
+
+__all__ = ["OutOfCoreStacker"]
+
+
+class OutOfCoreStacker:
+    """Stack any number of masked images with a fixed memory ceiling
+
+    Each added masked image is written to memory-mapped temporary files (one per plane) and
+    can then be released by the caller.  combine stacks the frames a block of rows at a time,
+    so at most maxBlockBytes of pixel data from the inputs are in memory at once.  The blocks
+    are handed to the stacker as masked images wrapping the memory maps, without copying them.
+    Each block is stacked with afwMath.statisticsStack, so the result is identical to stacking
+    the full frames in memory.
+
+    Use as a context manager, or call close, to delete the temporary files.
+
+    @param[in] maxBlockBytes  maximum number of bytes of input pixels (all frames) per block
+    @param[in] tmpDir  directory in which to create the temporary files; None for the default
+    """
+
+    def __init__(self, maxBlockBytes=256*2**20, tmpDir=None):
+        self.maxBlockBytes = maxBlockBytes
+        self._dir = tempfile.mkdtemp(prefix="calibStack-", dir=tmpDir)
+        self._frameList = []
+        self._bbox = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self._frameList)
+
+    def add(self, maskedImage):
+        """Write a masked image to the temporary planes
+
+        @param[in] maskedImage  masked image to stack; all must have the same bbox
+        """
+        if self._bbox is None:
+            self._bbox = maskedImage.getBBox()
+        elif maskedImage.getBBox() != self._bbox:
+            raise RuntimeError("Frame bbox %s does not match %s" % (maskedImage.getBBox(), self._bbox))
+        pathList = []
+        for name, plane in (("image", maskedImage.getImage()),
+                            ("mask", maskedImage.getMask()),
+                            ("variance", maskedImage.getVariance())):
+            array = plane.getArray()
+            path = os.path.join(self._dir, "%s%04d.npy" % (name, len(self._frameList)))
+            memmap = numpy.lib.format.open_memmap(path, mode="w+", dtype=array.dtype, shape=array.shape)
+            memmap[:] = array
+            memmap.flush()
+            del memmap
+            pathList.append(path)
+        self._frameList.append(pathList)
+
+    def rowsPerBlock(self):
+        """Return the number of rows stacked at a time"""
+        bytesPerRow = len(self._frameList)*self._bbox.getWidth()*(4 + 4 + 4)
+        return max(1, self.maxBlockBytes//max(1, bytesPerRow))
+
+    def iterBlocks(self):
+        """Iterate over the blocks of rows of the stacked frames
+
+        @return an iterator over (y0, y1, list of (image, mask, variance) arrays of rows [y0, y1)),
+            with one entry in the list per frame; the arrays are contiguous views of copy-on-write
+            memory maps, so they may be wrapped by afw images (which need writable arrays) and
+            changes to them do not reach the files
+        """
+        if not self._frameList:
+            raise RuntimeError("No frames were added")
+        mapList = [[numpy.load(path, mmap_mode="c") for path in pathList] for pathList in self._frameList]
+        height = self._bbox.getHeight()
+        rowsPerBlock = self.rowsPerBlock()
+        for y0 in range(0, height, rowsPerBlock):
+            y1 = min(y0 + rowsPerBlock, height)
+            yield y0, y1, [[plane[y0:y1] for plane in planeList] for planeList in mapList]
+
+    def combine(self, statistic, statsCtrl, stackFunc=None):
+        """Stack the frames
+
+        @param[in] statistic  statistic with which to stack, e.g. afwMath.MEANCLIP or afwMath.MEDIAN
+        @param[in] statsCtrl  afwMath.StatisticsControl
+        @param[in] stackFunc  function taking a list of masked images and returning their stack,
+            used instead of afwMath.statisticsStack(miList, statistic, statsCtrl) if not None
+        @return the stacked masked image
+        """
+        combined = afwImage.MaskedImageF(self._bbox)
+        outPlanes = (combined.getImage().getArray(), combined.getMask().getArray(),
+                     combined.getVariance().getArray())
+        for y0, y1, blockList in self.iterBlocks():
+            miList = [afwImage.MaskedImageF(afwImage.ImageF(image, deep=False),
+                                            afwImage.Mask(mask, deep=False),
+                                            afwImage.ImageF(variance, deep=False))
+                      for image, mask, variance in blockList]
+            if stackFunc is not None:
+                stacked = stackFunc(miList)
+            else:
+                stacked = afwMath.statisticsStack(miList, statistic, statsCtrl)
+            for outPlane, plane in zip(outPlanes, (stacked.getImage(), stacked.getMask(),
+                                                   stacked.getVariance())):
+                outPlane[y0:y1] = plane.getArray()
+        return combined
+
+    def close(self):
+        """Delete the temporary files
+        """
+        self._frameList = []
+        shutil.rmtree(self._dir, ignore_errors=True)
@@ -0,0 +1,310 @@
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010, 2011, 2012, 2013 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+import hashlib
+import os
+import tempfile
+
+import lsst.afw.image as afwImage
+import lsst.afw.math as afwMath
+import numpy
+
+__all__ = ["defectRevisionHash", "rasterizeDefects", "InterpolationStencil", "StencilCache",
+           "interpolateDefectsWithStencil", "PackedMaskCache", "orPackedMask"]
+
+# increment when the stencil algorithm changes, to invalidate stencils cached on disk
+STENCIL_VERSION = 1
+
+
+def defectRevisionHash(boxes, shape, *extra):
+    """Return a hex digest identifying a set of defects on an image of a given shape
+
+    @param[in] boxes  DefectBoxArray of the defects, in the pixel coordinates of the image
+    @param[in] shape  (height, width) of the image
+    @param[in] extra  further values the cached product depends on, e.g. the FWHM
+    """
+    sha = hashlib.sha1()
+    sha.update(repr((STENCIL_VERSION, tuple(shape)) + extra).encode())
+    for arr in (boxes.minX, boxes.minY, boxes.maxX, boxes.maxY):
+        sha.update(numpy.ascontiguousarray(arr, dtype=numpy.int64).tobytes())
+    return sha.hexdigest()
+
+
+def rasterizeDefects(boxes, shape):
+    """Return a bool array of the given shape, True inside the defect boxes (clipped to the image)
+
+    @param[in] boxes  DefectBoxArray, in the pixel coordinates of the array
+    @param[in] shape  (height, width) of the array
+    """
+    bad = numpy.zeros(shape, dtype=bool)
+    height, width = shape
+    for x0, y0, x1, y1 in zip(boxes.minX.tolist(), boxes.minY.tolist(),
+                              boxes.maxX.tolist(), boxes.maxY.tolist()):
+        bad[max(y0, 0):max(min(y1 + 1, height), 0), max(x0, 0):max(min(x1 + 1, width), 0)] = True
+    return bad
+
+
+def _atomicWrite(path, writeFunc):
+    """Write a file via a temporary file in the same directory, so concurrent readers never see
+    a partial file
+
+    @param[in] path  path of the file
+    @param[in] writeFunc  function taking a binary file object and writing the contents
+    """
+    fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=os.path.splitext(path)[1])
+    try:
+        with os.fdopen(fd, "wb") as outfile:
+            writeFunc(outfile)
+        os.replace(tmpPath, path)
+    except Exception:
+        os.remove(tmpPath)
+        raise
+
+
+class InterpolationStencil:
+    """A sparse linear operator replacing the bad pixels of an image by interpolation along rows
+
+    Each run of bad pixels in a row is interpolated linearly between the mean of up to numSide
+    good pixels immediately to its left and the mean of up to numSide to its right; runs with
+    good pixels on one side only take that side's mean, and pixels of rows with no good pixels
+    take the fallback value.  Since the operator only depends on which pixels are bad, it can
+    be built once per set of defects and applied to every image as one gather and scatter.
+
+    @param[in] shape  (height, width) of the images
+    @param[in] target  flattened indices of the bad pixels
+    @param[in] targetSlot  for each term of the operator, index into target of the pixel it sets
+    @param[in] source  for each term, flattened index of the good pixel it reads
+    @param[in] weights  for each term, its weight
+    """
+
+    def __init__(self, shape, target, targetSlot, source, weights):
+        self.shape = tuple(shape)
+        self.target = target
+        self.targetSlot = targetSlot
+        self.source = source
+        self.weights = weights
+        self.noSource = numpy.bincount(targetSlot, minlength=len(target)) == 0
+
+    @classmethod
+    def fromMask(cls, bad, numSide=1):
+        """Build the stencil for the bad pixels of a bool array
+
+        @param[in] bad  2-d bool array, True for the pixels to interpolate
+        @param[in] numSide  maximum number of good pixels averaged on either side of a run
+        """
+        height, width = bad.shape
+        padded = numpy.zeros((height, width + 2), dtype=numpy.int8)
+        padded[:, 1:-1] = bad
+        edges = numpy.diff(padded, axis=1)
+        runY, runX0 = numpy.nonzero(edges == 1)
+        runX1 = numpy.nonzero(edges == -1)[1] - 1
+        numRuns = len(runY)
+        if numRuns == 0:
+            empty = numpy.zeros(0, dtype=numpy.int64)
+            return cls(bad.shape, empty, empty, empty, numpy.zeros(0))
+
+        # the good pixels available on either side stop at the neighbouring run or the image edge
+        prevSameRow = numpy.zeros(numRuns, dtype=bool)
+        prevSameRow[1:] = runY[1:] == runY[:-1]
+        nextSameRow = numpy.zeros(numRuns, dtype=bool)
+        nextSameRow[:-1] = runY[:-1] == runY[1:]
+        leftLimit = numpy.where(prevSameRow, numpy.roll(runX1, 1) + 1, 0)
+        rightLimit = numpy.where(nextSameRow, numpy.roll(runX0, -1) - 1, width - 1)
+        numLeft = numpy.clip(runX0 - leftLimit, 0, numSide)
+        numRight = numpy.clip(rightLimit - runX1, 0, numSide)
+
+        # expand the runs to pixels
+        runLength = runX1 - runX0 + 1
+        pixelRun = numpy.repeat(numpy.arange(numRuns), runLength)
+        runStart = numpy.cumsum(runLength) - runLength
+        pixelX = runX0[pixelRun] + numpy.arange(len(pixelRun)) - runStart[pixelRun]
+        pixelY = runY[pixelRun]
+        target = pixelY*width + pixelX
+
+        frac = (pixelX - runX0[pixelRun] + 1)/(runLength[pixelRun] + 1.)
+        hasLeft = numLeft[pixelRun] > 0
+        hasRight = numRight[pixelRun] > 0
+        leftWeight = numpy.where(hasRight, numpy.where(hasLeft, 1. - frac, 0.), 1.)
+        rightWeight = numpy.where(hasRight, 1. - leftWeight, 0.)
+
+        slotList, sourceList, weightList = [], [], []
+        slots = numpy.arange(len(pixelRun))
+        for k in range(numSide):
+            for num, x, weight in ((numLeft, runX0 - 1 - k, leftWeight),
+                                   (numRight, runX1 + 1 + k, rightWeight)):
+                use = (k < num[pixelRun]) & (weight > 0)
+                slotList.append(slots[use])
+                sourceList.append(pixelY[use]*width + x[pixelRun][use])
+                weightList.append(weight[use]/num[pixelRun][use])
+        return cls(bad.shape, target, numpy.concatenate(slotList), numpy.concatenate(sourceList),
+                   numpy.concatenate(weightList))
+
+    def apply(self, imageArr, fallbackValue=numpy.nan):
+        """Replace the bad pixels of an image array in place
+
+        @param[in,out] imageArr  2-d array of the stencil's shape
+        @param[in] fallbackValue  value for bad pixels with no good pixel in their row; may be a
+            callable returning it, which is only called if it is needed
+        """
+        if imageArr.shape != self.shape:
+            raise RuntimeError("Image shape %s does not match stencil shape %s" %
+                               (imageArr.shape, self.shape))
+        if len(self.target) == 0:
+            return
+        # take and put index the array in C order whether or not it is contiguous (e.g. a subimage)
+        values = numpy.bincount(self.targetSlot, weights=self.weights*numpy.take(imageArr, self.source),
+                                minlength=len(self.target))
+        if self.noSource.any():
+            values[self.noSource] = fallbackValue() if callable(fallbackValue) else fallbackValue
+        numpy.put(imageArr, self.target, values)
+
+    def save(self, path):
+        """Write the stencil to an npz file, atomically so concurrent readers never see a partial file"""
+        _atomicWrite(path, lambda outfile: numpy.savez(
+            outfile, shape=numpy.array(self.shape), target=self.target, targetSlot=self.targetSlot,
+            source=self.source, weights=self.weights))
+
+    @classmethod
+    def load(cls, path):
+        """Read a stencil written by save"""
+        with numpy.load(path) as data:
+            return cls(tuple(int(n) for n in data["shape"]), data["target"], data["targetSlot"],
+                       data["source"], data["weights"])
+
+
+class StencilCache:
+    """Interpolation stencils keyed by defect revision hash, kept in memory and optionally on disk
+
+    @param[in] cacheDir  directory of the stencil files shared between processes and runs, or None
+        to keep stencils in memory only
+    """
+
+    def __init__(self, cacheDir=None):
+        self.cacheDir = cacheDir
+        self._stencils = {}
+        if cacheDir is not None:
+            os.makedirs(cacheDir, exist_ok=True)
+
+    def get(self, boxes, shape, numSide):
+        """Return the stencil for a set of defects, building and caching it if needed
+
+        @param[in] boxes  DefectBoxArray of the defects, in the pixel coordinates of the image
+        @param[in] shape  (height, width) of the image
+        @param[in] numSide  maximum number of good pixels averaged on either side of a run
+        """
+        key = defectRevisionHash(boxes, shape, numSide)
+        stencil = self._stencils.get(key)
+        if stencil is not None:
+            return stencil
+        path = None
+        if self.cacheDir is not None:
+            path = os.path.join(self.cacheDir, "stencil_%s.npz" % (key,))
+            if os.path.exists(path):
+                stencil = InterpolationStencil.load(path)
+        if stencil is None:
+            stencil = InterpolationStencil.fromMask(rasterizeDefects(boxes, shape), numSide=numSide)
+            if path is not None:
+                stencil.save(path)
+        self._stencils[key] = stencil
+        return stencil
+
+
+def interpolateDefectsWithStencil(maskedImage, boxes, fwhm, cache):
+    """Interpolate over defects with a cached stencil, setting the INTRP mask plane
+
+    This is not the algorithm of isrFunctions.interpolateDefectList, and its results differ:
+    up to round(fwhm) good pixels (at least 1) on either side of each bad run are averaged and
+    interpolated linearly along the row, with no Gaussian PSF model.  Pixels in rows with no
+    good pixel take the clipped mean of the image, as for isrFunctions.interpolateDefectList.
+    The variance plane is interpolated with the same stencil, its fallback being the clipped
+    mean of the variance, so interpolated pixels have the variance of their neighbours.
+
+    @param[in,out] maskedImage  masked image to correct
+    @param[in] boxes  DefectBoxArray of the defects, in the parent coordinates of maskedImage
+    @param[in] fwhm  FWHM of the PSF (pixels)
+    @param[in] cache  StencilCache
+    """
+    xy0 = maskedImage.getXY0()
+    boxes = boxes.shifted(-xy0.getX(), -xy0.getY())
+    imageArr = maskedImage.getImage().getArray()
+    stencil = cache.get(boxes, imageArr.shape, max(1, int(round(fwhm))))
+
+    def fallbackValue():
+        return afwMath.makeStatistics(maskedImage.getImage(), afwMath.MEANCLIP).getValue()
+
+    def fallbackVariance():
+        return afwMath.makeStatistics(maskedImage.getVariance(), afwMath.MEANCLIP).getValue()
+
+    stencil.apply(imageArr, fallbackValue)
+    stencil.apply(maskedImage.getVariance().getArray(), fallbackVariance)
+    maskArr = maskedImage.getMask().getArray()
+    numpy.put(maskArr, stencil.target,
+              numpy.take(maskArr, stencil.target) | afwImage.Mask.getPlaneBitMask("INTRP"))
+
+
+class PackedMaskCache:
+    """Rasterized defect masks, bit-packed along rows, keyed by defect revision hash
+
+    A packed mask takes one bit per pixel, so that of a 4k x 4k CCD is 2 MB.  Masks cached on
+    disk are memory-mapped read-only, so all the worker processes of a node share one copy in
+    the page cache.
+
+    @param[in] cacheDir  directory of the mask files shared between processes and runs, or None
+        to keep masks in memory only
+    """
+
+    def __init__(self, cacheDir=None):
+        self.cacheDir = cacheDir
+        self._masks = {}
+        if cacheDir is not None:
+            os.makedirs(cacheDir, exist_ok=True)
+
+    def get(self, boxes, shape):
+        """Return the packed mask of a set of defects: a uint8 array of numpy.packbits(bad, axis=1)
+
+        @param[in] boxes  DefectBoxArray of the defects, in the pixel coordinates of the image
+        @param[in] shape  (height, width) of the image
+        """
+        key = defectRevisionHash(boxes, shape, "packedMask")
+        packed = self._masks.get(key)
+        if packed is not None:
+            return packed
+        if self.cacheDir is not None:
+            path = os.path.join(self.cacheDir, "badMask_%s.npy" % (key,))
+            if not os.path.exists(path):
+                packed = numpy.packbits(rasterizeDefects(boxes, shape), axis=1)
+                _atomicWrite(path, lambda outfile: numpy.save(outfile, packed))
+            packed = numpy.load(path, mmap_mode="r")
+        else:
+            packed = numpy.packbits(rasterizeDefects(boxes, shape), axis=1)
+        self._masks[key] = packed
+        return packed
+
+
+def orPackedMask(maskArr, packed, bitmask):
+    """OR bitmask into the pixels of a mask array that are set in a packed mask
+
+    @param[in,out] maskArr  2-d mask array
+    @param[in] packed  mask packed by numpy.packbits(bad, axis=1), for an array of maskArr's shape
+    @param[in] bitmask  bits to set
+    """
+    bad = numpy.unpackbits(packed, axis=1, count=maskArr.shape[1]).view(bool)
+    numpy.bitwise_or(maskArr, numpy.array(bitmask, dtype=maskArr.dtype), out=maskArr, where=bad)
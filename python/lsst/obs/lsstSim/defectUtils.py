@@ -0,0 +1,141 @@
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010, 2011, 2012, 2013 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+import lsst.geom as geom
+import lsst.meas.algorithms as measAlg
+import numpy
+
+__all__ = ["DefectBoxArray", "DefectGridIndex"]
+
+
+class DefectBoxArray:
+    """A list of defect boxes held as numpy arrays
+
+    Each box is the inclusive integer range [minX, maxX] x [minY, maxY], as for a Box2I.
+    Operations return new DefectBoxArrays and act on all the boxes at once.
+
+    @param[in] minX, minY, maxX, maxY  integer array-likes of the box corners
+    """
+
+    def __init__(self, minX, minY, maxX, maxY):
+        self.minX = numpy.asarray(minX, dtype=numpy.int64)
+        self.minY = numpy.asarray(minY, dtype=numpy.int64)
+        self.maxX = numpy.asarray(maxX, dtype=numpy.int64)
+        self.maxY = numpy.asarray(maxY, dtype=numpy.int64)
+
+    @classmethod
+    def fromDefects(cls, defectList):
+        """Make a DefectBoxArray from an iterable of measAlg.Defect or Box2I"""
+        boxList = [d.getBBox() if hasattr(d, "getBBox") else d for d in defectList]
+        corners = numpy.array([(bbox.getMinX(), bbox.getMinY(), bbox.getMaxX(), bbox.getMaxY())
+                               for bbox in boxList], dtype=numpy.int64).reshape(-1, 4)
+        return cls(*corners.T)
+
+    def __len__(self):
+        return len(self.minX)
+
+    def __getitem__(self, index):
+        return DefectBoxArray(self.minX[index], self.minY[index], self.maxX[index], self.maxY[index])
+
+    @property
+    def width(self):
+        return self.maxX - self.minX + 1
+
+    @property
+    def height(self):
+        return self.maxY - self.minY + 1
+
+    def transposed(self):
+        """Return the boxes with x and y swapped"""
+        return DefectBoxArray(self.minY, self.minX, self.maxY, self.maxX)
+
+    def shifted(self, dx, dy):
+        """Return the boxes shifted by (dx, dy); each may be a scalar or an array"""
+        return DefectBoxArray(self.minX + dx, self.minY + dy, self.maxX + dx, self.maxY + dy)
+
+    def flippedY(self, height):
+        """Return the boxes reflected in y within rows [0, height)"""
+        return DefectBoxArray(self.minX, height - 1 - self.maxY, self.maxX, height - 1 - self.minY)
+
+    def overlaps(self, bbox):
+        """Return a bool array, True for the boxes that overlap bbox, as Box2I.overlaps"""
+        if bbox.isEmpty():
+            return numpy.zeros(len(self), dtype=bool)
+        overlapX = (self.minX <= bbox.getMaxX()) & (self.maxX >= bbox.getMinX())
+        return overlapX & (self.minY <= bbox.getMaxY()) & (self.maxY >= bbox.getMinY())
+
+    def toDefects(self):
+        """Return the boxes as a measAlg.Defects"""
+        defectList = measAlg.Defects()
+        for x0, y0, w, h in zip(self.minX.tolist(), self.minY.tolist(), self.width.tolist(),
+                                self.height.tolist()):
+            defectList.append(measAlg.Defect(geom.Box2I(geom.Point2I(x0, y0), geom.Extent2I(w, h))))
+        return defectList
+
+
+class DefectGridIndex:
+    """A spatial index of the defects of a detector on a regular grid of cells
+
+    Each box is registered in every cell it touches, so the boxes overlapping a region are
+    found by checking only those in the cells the region touches.
+
+    @param[in] boxes  DefectBoxArray to index
+    @param[in] cellSize  (width, height) of the grid cells in pixels
+    """
+
+    def __init__(self, boxes, cellSize=(256, 256)):
+        self.boxes = boxes
+        self.cellWidth, self.cellHeight = cellSize
+        self._cells = {}
+        if len(boxes) == 0:
+            return
+        self.x0 = int(boxes.minX.min())
+        self.y0 = int(boxes.minY.min())
+        cx0, cx1 = self._cellX(boxes.minX), self._cellX(boxes.maxX)
+        cy0, cy1 = self._cellY(boxes.minY), self._cellY(boxes.maxY)
+        for i in range(len(boxes)):
+            for cy in range(cy0[i], cy1[i] + 1):
+                for cx in range(cx0[i], cx1[i] + 1):
+                    self._cells.setdefault((cx, cy), []).append(i)
+        self._cells = {key: numpy.array(value, dtype=numpy.int64) for key, value in self._cells.items()}
+
+    def _cellX(self, x):
+        return (numpy.asarray(x) - self.x0)//self.cellWidth
+
+    def _cellY(self, y):
+        return (numpy.asarray(y) - self.y0)//self.cellHeight
+
+    def query(self, bbox):
+        """Return the sorted indices of the boxes that overlap bbox"""
+        if not self._cells or bbox.isEmpty():
+            return numpy.zeros(0, dtype=numpy.int64)
+        candidates = [self._cells[(cx, cy)]
+                      for cy in range(int(self._cellY(bbox.getMinY())), int(self._cellY(bbox.getMaxY())) + 1)
+                      for cx in range(int(self._cellX(bbox.getMinX())), int(self._cellX(bbox.getMaxX())) + 1)
+                      if (cx, cy) in self._cells]
+        if not candidates:
+            return numpy.zeros(0, dtype=numpy.int64)
+        indices = numpy.unique(numpy.concatenate(candidates))
+        return indices[self.boxes[indices].overlaps(bbox)]
+
+    def subset(self, bbox):
+        """Return a DefectBoxArray of the boxes that overlap bbox"""
+        return self.boxes[self.query(bbox)]
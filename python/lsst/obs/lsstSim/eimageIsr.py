@@ -23,7 +23,12 @@
 
 __all__ = ["EimageIsrConfig", "EimageIsrTask"]
 
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
 import lsst.afw.image as afwImage
+import lsst.afw.math as afwMath
+import lsst.geom as geom
 import lsst.pex.config as pexConfig
 import lsst.pipe.base as pipeBase
 import lsst.ip.isr as isr
@@ -36,7 +41,17 @@ class EimageIsrConfig(pexConfig.Config):
                                  doc="Add a flat Poisson noise background to the eimage?")
     rngSeed = pexConfig.Field(dtype=int, default=None, optional=True,
                               doc=("Random number seed used when adding noise (passed directly"
-                                   " to numpy at task initialization)"))
+                                   " to numpy at task initialization for noiseRng='global')"))
+    noiseRng = pexConfig.ChoiceField(dtype=str, default="stream",
+                                     allowed={"global": "the global numpy generator, seeded with rngSeed"
+                                                        " when the task is constructed, as before streams"
+                                                        " were added (reproduces that noise); the noise of a"
+                                                        " sensor depends on the sensors processed before it,"
+                                                        " and forked processes share the generator state",
+                                              "stream": "an independent Philox stream for each row of each"
+                                                        " sensor, keyed by rngSeed, visit, raft, sensor and"
+                                                        " snap; reproducible however the work is split"},
+                                     doc="Random number generator used when adding noise")
     noiseValue = pexConfig.Field(dtype=int, default=1000, doc="Mean of the Poisson distribution in counts")
     doSetVariance = pexConfig.Field(dtype=bool, default=True, doc="Set the variance plane in the eimage?")
     varianceType = pexConfig.ChoiceField(dtype=str, default="image",
@@ -47,6 +62,23 @@ class EimageIsrConfig(pexConfig.Config):
     maskEdgeBorder = pexConfig.Field(dtype=int, default=0, doc="Set mask to EDGE for a border of x pixels")
     sat_val = pexConfig.Field(dtype=int, default=100000, doc="Value at which to detect saturation")
     interp_size = pexConfig.Field(dtype=float, default=0.5, doc="Size of interpolation kernel in arcsec")
+    doFusedPrepare = pexConfig.Field(dtype=bool, default=True,
+                                     doc=("Convert, add noise, set the variance and mask EDGE and SAT pixels"
+                                          " in a single pass over blocks of rows?  The output is the same as"
+                                          " running each step over the whole image"))
+    prepareRowsPerChunk = pexConfig.Field(dtype=int, default=16,
+                                          doc="Number of rows processed at a time by the fused preparation")
+    numThreads = pexConfig.Field(dtype=int, default=1,
+                                 doc=("Number of threads preparing blocks of rows; more than one requires"
+                                      " noiseRng='stream' when adding noise"))
+
+    def validate(self):
+        pexConfig.Config.validate(self)
+        if self.numThreads < 1:
+            raise ValueError("numThreads=%d must be at least 1" % (self.numThreads,))
+        if self.doAddNoise and self.noiseRng == "global" and self.numThreads > 1:
+            raise ValueError("Noise from the global random number generator cannot be drawn on"
+                             " %d threads; use noiseRng='stream'" % (self.numThreads,))
 
 
 class EimageIsrTask(pipeBase.Task):
@@ -56,7 +88,8 @@ class EimageIsrTask(pipeBase.Task):
 
     def __init__(self, **kwargs):
         pipeBase.Task.__init__(self, **kwargs)
-        numpy.random.seed(self.config.rngSeed)
+        if self.config.noiseRng == "global":
+            numpy.random.seed(self.config.rngSeed)
 
     @pipeBase.timeMethod
     def runDataRef(self, sensorRef):
@@ -68,22 +101,30 @@ class EimageIsrTask(pipeBase.Task):
         """
         inputExposure = sensorRef.get("eimage", immediate=True)
 
-        # eimages are int, but computation needs to be done on floating point values
-        inputExposure = inputExposure.convertF()
+        if self.config.doFusedPrepare:
+            inputExposure, satColumns = self.prepareExposure(inputExposure, sensorRef.dataId)
+        else:
+            # eimages are int, but computation needs to be done on floating point values
+            inputExposure = inputExposure.convertF()
 
-        if self.config.doAddNoise:
-            self.addNoise(inputExposure)
+            if self.config.doAddNoise:
+                self.addNoise(inputExposure, sensorRef.dataId)
 
-        if self.config.doSetVariance:
-            self.setVariance(inputExposure)
+            if self.config.doSetVariance:
+                self.setVariance(inputExposure)
 
-        if self.config.maskEdgeBorder > 0:
-            self.maskEdges(inputExposure)
+            if self.config.maskEdgeBorder > 0:
+                self.maskEdges(inputExposure)
+
+            # Mask saturation
+            isr.makeThresholdMask(
+                maskedImage=inputExposure.getMaskedImage(),
+                threshold=self.config.sat_val,
+                growFootprints=0,
+                maskName='SAT')
+            satColumns = None
 
-        # eimages are transposed relative to the read direction.
-        # Transpose the image to do interpolation in the serial direction
         mi = inputExposure.getMaskedImage()
-        mi = isr.transposeMaskedImage(mi)
 
         # We may need to ingest the results of the processing and
         # ingestProcessed.py expects some specific header cards.
@@ -93,29 +134,167 @@ class EimageIsrTask(pipeBase.Task):
         md.add('RDNOISE', 0.)
         md.add('SATURATE', self.config.sat_val)
         md.add('GAINEFF', 1.)
-        # Mask saturation
-        isr.makeThresholdMask(
-            maskedImage=mi,
-            threshold=self.config.sat_val,
-            growFootprints=0,
-            maskName='SAT')
         # Interpolate
-        isr.interpolateFromMask(
-            maskedImage=mi,
-            fwhm=self.config.interp_size,
-            growSaturatedFootprints=0,
-            maskNameList=['SAT'],
-        )
-        inputExposure.setMaskedImage(isr.transposeMaskedImage(mi))
+        if satColumns is None or satColumns.any():
+            self.interpolateSaturation(mi, satColumns)
         return pipeBase.Struct(exposure=inputExposure)
 
-    def addNoise(self, inputExposure):
-        mi = inputExposure.getMaskedImage()
-        (x, y) = mi.getDimensions()
-        noiseArr = numpy.random.poisson(self.config.noiseValue, size=x*y).reshape(y, x)
-        noiseArr = noiseArr.astype(numpy.float32)
-        noiseImage = afwImage.makeImageFromArray(noiseArr)
-        mi += noiseImage
+    def noiseKey(self, dataId=None):
+        """Return the Philox key of the noise streams of a sensor, or None for noiseRng='global'
+
+        @param[in] dataId  sensor dataId; the visit, raft, sensor and snap keys are used if present
+        """
+        if self.config.noiseRng == "global":
+            return None
+        dataId = dataId if dataId is not None else {}
+        rngSeed = self.config.rngSeed
+        entropy = [rngSeed if rngSeed is not None else numpy.random.SeedSequence().entropy,
+                   int(dataId.get("visit", 0)),
+                   zlib.crc32(str(dataId.get("raft", "")).encode()),
+                   zlib.crc32(str(dataId.get("sensor", "")).encode()),
+                   int(dataId.get("snap", 0))]
+        return numpy.random.SeedSequence(entropy).generate_state(2, dtype=numpy.uint64)
+
+    def addNoiseRows(self, imageArr, y0, noiseKey):
+        """Add Poisson noise of mean noiseValue to a block of rows, in place
+
+        For noiseRng='stream' each row of the image has its own Philox stream, whose counter
+        starts from the row number, so the noise does not depend on how the rows are blocked
+        or on the number of threads.
+
+        @param[in,out] imageArr  float32 array of the rows starting with row y0
+        @param[in] y0  index of the first row of imageArr in the image
+        @param[in] noiseKey  Philox key from noiseKey, or None to use the global numpy generator
+        """
+        # the integer draws are converted as they are added, without a float32 copy of the noise
+        if noiseKey is None:
+            numpy.add(imageArr, numpy.random.poisson(self.config.noiseValue, size=imageArr.shape),
+                      out=imageArr, dtype=numpy.float32, casting="unsafe")
+            return
+        for i, row in enumerate(imageArr):
+            rng = numpy.random.Generator(numpy.random.Philox(counter=[0, 0, y0 + i, 0], key=noiseKey))
+            numpy.add(row, rng.poisson(self.config.noiseValue, size=len(row)),
+                      out=row, dtype=numpy.float32, casting="unsafe")
+
+    def mapRowChunks(self, func, numRows):
+        """Call func(rows) for each block of prepareRowsPerChunk rows, on numThreads threads
+
+        @param[in] func  function taking a slice of rows
+        @param[in] numRows  number of rows of the image
+        @return the list of the results, in order of the rows
+        """
+        rowsPerChunk = self.config.prepareRowsPerChunk
+        chunkList = [slice(y0, min(y0 + rowsPerChunk, numRows)) for y0 in range(0, numRows, rowsPerChunk)]
+        if self.config.numThreads <= 1:
+            return [func(rows) for rows in chunkList]
+        with ThreadPoolExecutor(max_workers=self.config.numThreads) as executor:
+            return list(executor.map(func, chunkList))
+
+    def prepareExposure(self, inputExposure, dataId=None):
+        """Make the floating point exposure with noise, variance, EDGE and SAT mask in one pass
+
+        This is equivalent to convertF, addNoise, setVariance, maskEdges and makeThresholdMask
+        (with no growth of the footprints), as configured, but works on blocks of
+        prepareRowsPerChunk rows so that each pixel is read from memory once.  The noise is
+        drawn in the same order from the same random number generator, so the output is identical.
+        With noiseRng='stream' the blocks are processed on numThreads threads.
+
+        @param[in] inputExposure  eimage exposure, of any pixel type
+        @param[in] dataId  sensor dataId, used to choose the noise streams
+        @return (exposure, satColumns): the new float exposure, sharing the ExposureInfo of
+            inputExposure, and a bool array that is True for the columns with SAT pixels
+        """
+        inMi = inputExposure.getMaskedImage()
+        mi = afwImage.MaskedImageF(inMi.getBBox())
+        exposure = afwImage.ExposureF(mi, inputExposure.getInfo())
+        inImage = inMi.getImage().getArray()
+        inMask = inMi.getMask().getArray()
+        inVariance = inMi.getVariance().getArray()
+        image = mi.getImage().getArray()
+        mask = mi.getMask().getArray()
+        variance = mi.getVariance().getArray()
+        edgeBitMask = mi.getMask().getPlaneBitMask("EDGE")
+        satBitMask = mi.getMask().getPlaneBitMask("SAT")
+        npix = self.config.maskEdgeBorder
+        (ys, xs) = image.shape
+        noiseKey = self.noiseKey(dataId) if self.config.doAddNoise else None
+
+        def prepareChunk(rows):
+            imageChunk = image[rows]
+            imageChunk[:] = inImage[rows]
+            if self.config.doAddNoise:
+                self.addNoiseRows(imageChunk, rows.start, noiseKey)
+            if not self.config.doSetVariance:
+                variance[rows] = inVariance[rows]
+            elif self.config.varianceType == 'value':
+                variance[rows] = self.config.varianceValue
+            elif self.config.varianceType == 'image':
+                variance[rows] = imageChunk
+            maskChunk = mask[rows]
+            maskChunk[:] = inMask[rows]
+            if npix > 0:
+                # the same pixels as maskEdges, including its extra row and column at the top and right
+                y = numpy.arange(rows.start, rows.stop)
+                fullRow = (y < npix) | (y >= ys - npix - 1)
+                maskChunk[fullRow] |= edgeBitMask
+                maskChunk[~fullRow, :npix] |= edgeBitMask
+                maskChunk[~fullRow, xs-npix-1:] |= edgeBitMask
+            saturated = imageChunk >= self.config.sat_val
+            maskChunk[saturated] |= satBitMask
+            return saturated.any(axis=0)
+
+        satColumns = numpy.zeros(xs, dtype=bool)
+        for chunkColumns in self.mapRowChunks(prepareChunk, ys):
+            satColumns |= chunkColumns
+        return exposure, satColumns
+
+    def interpolateSaturation(self, maskedImage, satColumns=None):
+        """Interpolate over SAT pixels in the serial direction, in place
+
+        eimages are transposed relative to the read direction, so the interpolation must be done
+        along columns.  Rather than transposing the whole image and back, only the blocks of
+        adjacent columns that contain SAT pixels are transposed, interpolated along rows and
+        copied back.  Interpolation only uses pixels of the same row of the transposed image,
+        and each block holds whole saturated footprints, so the result is the same as for the
+        whole transposed image, given the fallback value computed from the whole image.
+
+        @param[in,out] maskedImage  masked image whose SAT pixels are interpolated
+        @param[in] satColumns  bool array, True for the columns with SAT pixels, or None to find them
+            from the mask
+        """
+        if satColumns is None:
+            mask = maskedImage.getMask()
+            satColumns = numpy.any(mask.getArray() & mask.getPlaneBitMask('SAT'), axis=0)
+        satColumns = numpy.flatnonzero(satColumns)
+        if len(satColumns) == 0:
+            return
+        fallbackValue = afwMath.makeStatistics(maskedImage.getImage(), afwMath.MEANCLIP).getValue()
+        breaks = numpy.flatnonzero(numpy.diff(satColumns) > 1)
+        blockStarts = satColumns[numpy.concatenate(([0], breaks + 1))]
+        blockEnds = satColumns[numpy.concatenate((breaks, [len(satColumns) - 1]))]
+        bbox = maskedImage.getBBox()
+        for x0, x1 in zip(blockStarts.tolist(), blockEnds.tolist()):
+            block = maskedImage.Factory(maskedImage, geom.Box2I(
+                geom.Point2I(bbox.getMinX() + x0, bbox.getMinY()),
+                geom.Point2I(bbox.getMinX() + x1, bbox.getMaxY())))
+            transposed = isr.transposeMaskedImage(block)
+            isr.interpolateFromMask(
+                maskedImage=transposed,
+                fwhm=self.config.interp_size,
+                growSaturatedFootprints=0,
+                maskNameList=['SAT'],
+                fallbackValue=fallbackValue,
+            )
+            block.assign(isr.transposeMaskedImage(transposed))
+
+    def addNoise(self, inputExposure, dataId=None):
+        imageArr = inputExposure.getMaskedImage().getImage().getArray()
+        noiseKey = self.noiseKey(dataId)
+        if noiseKey is None:
+            self.addNoiseRows(imageArr, 0, noiseKey)
+        else:
+            self.mapRowChunks(lambda rows: self.addNoiseRows(imageArr[rows], rows.start, noiseKey),
+                              imageArr.shape[0])
 
     def setVariance(self, inputExposure):
         if self.config.varianceType == 'value':
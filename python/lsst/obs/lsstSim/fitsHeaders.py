@@ -0,0 +1,137 @@
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010, 2011, 2012, 2013 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+import collections
+import gzip
+from concurrent.futures import ThreadPoolExecutor
+
+from astropy.io import fits
+import numpy
+
+import lsst.daf.base as dafBase
+
+__all__ = ["readFitsHeader", "readFitsHeaders", "headerColumns"]
+
+FITS_BLOCK_SIZE = 2880
+FITS_CARD_SIZE = 80
+END_CARD = b"END" + b" "*(FITS_CARD_SIZE - 3)
+
+
+def _readHeaderBytes(fileObj):
+    """Read the header blocks of the next HDU, up to and including the block with the END card
+
+    @return the header bytes, or None at the end of the file
+    """
+    blockList = []
+    while True:
+        block = fileObj.read(FITS_BLOCK_SIZE)
+        if len(block) < FITS_BLOCK_SIZE:
+            return None
+        blockList.append(block)
+        for start in range(0, FITS_BLOCK_SIZE, FITS_CARD_SIZE):
+            if block[start:start + FITS_CARD_SIZE] == END_CARD:
+                return b"".join(blockList)
+
+
+def _addCards(md, header):
+    """Set the cards of an astropy header in a PropertyList, replacing existing values"""
+    for card in header.cards:
+        if card.keyword in ("", "COMMENT", "HISTORY", "END"):
+            continue
+        if isinstance(card.value, (bool, int, float, str)):
+            md.set(card.keyword, card.value, card.comment)
+
+
+def readFitsHeader(path):
+    """Read the header of a FITS file, reading only the header blocks
+
+    As lsst.afw.fits.readMetadata, if the primary HDU has no data the header of the first
+    extension is merged into it, its values taking precedence.  Files ending in .gz are
+    decompressed on the fly.  File reads and decompression release the GIL, so several headers
+    can be read concurrently on threads.
+
+    @param[in] path  path of the FITS file
+    @return the header as an lsst.daf.base.PropertyList
+    """
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as fileObj:
+        headerBytes = _readHeaderBytes(fileObj)
+        if headerBytes is None:
+            raise RuntimeError("No FITS header found in %s" % (path,))
+        md = dafBase.PropertyList()
+        primary = fits.Header.fromstring(headerBytes.decode("ascii"))
+        _addCards(md, primary)
+        if primary.get("NAXIS", 0) == 0 and primary.get("EXTEND", False):
+            headerBytes = _readHeaderBytes(fileObj)
+            if headerBytes is not None:
+                _addCards(md, fits.Header.fromstring(headerBytes.decode("ascii")))
+    return md
+
+
+def readFitsHeaders(pathList, numThreads=8):
+    """Read the headers of many FITS files concurrently
+
+    @param[in] pathList  list of paths of FITS files
+    @param[in] numThreads  number of reading threads
+    @return a list of lsst.daf.base.PropertyList, in the order of pathList
+    """
+    if numThreads <= 1 or len(pathList) <= 1:
+        return [readFitsHeader(path) for path in pathList]
+    with ThreadPoolExecutor(max_workers=numThreads) as executor:
+        return list(executor.map(readFitsHeader, pathList))
+
+
+def _toColumn(values):
+    """Return a list of header values, None where missing, as an array
+
+    Integers present in every header give an int64 array and other numbers a float64 array,
+    NaN where missing; anything else gives an object array, None where missing.
+    """
+    present = [value for value in values if value is not None]
+    if present and all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in present):
+        if len(present) == len(values) and all(isinstance(value, int) for value in present):
+            return numpy.array(values, dtype=numpy.int64)
+        return numpy.array([numpy.nan if value is None else value for value in values], dtype=numpy.float64)
+    column = numpy.empty(len(values), dtype=object)
+    column[:] = values
+    return column
+
+
+def headerColumns(mdList, keys=None):
+    """Return the values of the keywords of many headers as columns, one array per keyword
+
+    Computations over many headers, such as the corners of all the detectors of a visit, can then
+    be done on whole arrays rather than header by header.
+
+    @param[in] mdList  list of headers (lsst.daf.base.PropertyList)
+    @param[in] keys  keywords to return; None for every keyword of any of the headers
+    @return a collections.OrderedDict of keyword: numpy array with one value per header, in the
+        order of mdList; see _toColumn for the dtypes
+    """
+    mdList = list(mdList)
+    if keys is None:
+        keys = collections.OrderedDict()
+        for md in mdList:
+            keys.update((key, None) for key in md.getOrderedNames())
+    columns = collections.OrderedDict()
+    for key in keys:
+        columns[key] = _toColumn([md.getScalar(key) if md.exists(key) else None for md in mdList])
+    return columns
@@ -0,0 +1,139 @@
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010, 2011, 2012, 2013 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+import contextlib
+import json
+import sqlite3
+
+import lsst.pipe.base as pipeBase
+
+__all__ = ["FlatStatsTable", "flatNormKey", "combineAmpStats"]
+
+
+def flatNormKey(dataId, level):
+    """Return the key of the group of amps normalized together
+
+    @param[in] dataId  amp dataId, with raft and sensor keys
+    @param[in] level  "sensor", "raft" or "focalPlane"
+    """
+    if level == "sensor":
+        return (dataId["raft"], dataId["sensor"])
+    elif level == "raft":
+        return (dataId["raft"],)
+    elif level == "focalPlane":
+        return ()
+    raise ValueError("Unknown flat normalization level %s" % (level,))
+
+
+def combineAmpStats(statsList, weighting="amp"):
+    """Return the normalization of a group of amps: the mean of their clipped means
+
+    @param[in] statsList  iterable of (clipped mean, number of pixels)
+    @param[in] weighting  "amp" to weight the amps equally, "pixel" to weight them by their numbers
+        of pixels
+    """
+    if weighting not in ("amp", "pixel"):
+        raise ValueError("Unknown flat normalization weighting %s" % (weighting,))
+    sumWeight = 0.
+    sumMean = 0.
+    for mean, numPix in statsList:
+        weight = numPix if weighting == "pixel" else 1
+        sumWeight += weight
+        sumMean += weight*mean
+    if sumWeight <= 0:
+        raise RuntimeError("No pixels from which to normalize the flats")
+    return sumMean/sumWeight
+
+
+class FlatStatsTable:
+    """A table of the clipped statistics of unnormalized master flat amps
+
+    The table is an sqlite database, so the processes building the flats of different amps
+    and sensors can all write to it; a reducer then computes the normalization of each sensor,
+    raft or the whole focal plane from it without reading the flats again.
+
+    @param[in] path  path of the database file; ":memory:" for a private in-memory table
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with self._transaction() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS flatStats (dataId TEXT PRIMARY KEY, raft TEXT, "
+                         "sensor TEXT, mean REAL, numPix INTEGER, path TEXT)")
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """Yield a connection to the database, committing on success"""
+        if self.path == ":memory:":
+            if not hasattr(self, "_memConn"):
+                self._memConn = sqlite3.connect(self.path)
+            conn = self._memConn
+        else:
+            conn = sqlite3.connect(self.path, timeout=60.)
+        try:
+            with conn:
+                yield conn
+        finally:
+            if conn is not getattr(self, "_memConn", None):
+                conn.close()
+
+    def add(self, dataId, mean, numPix, path=None):
+        """Record (or replace) the statistics of one amp
+
+        @param[in] dataId  amp dataId
+        @param[in] mean  clipped mean of the unnormalized flat
+        @param[in] numPix  number of pixels contributing to the mean
+        @param[in] path  path of the staged unnormalized flat, if any
+        """
+        with self._transaction() as conn:
+            conn.execute("INSERT OR REPLACE INTO flatStats VALUES (?, ?, ?, ?, ?, ?)",
+                         (json.dumps(dataId, sort_keys=True), str(dataId["raft"]), str(dataId["sensor"]),
+                          mean, numPix, path))
+
+    def getRows(self):
+        """Return a list of pipeBase.Struct with fields dataId, mean, numPix and path, one per amp"""
+        with self._transaction() as conn:
+            rowList = conn.execute("SELECT dataId, mean, numPix, path FROM flatStats").fetchall()
+        return [pipeBase.Struct(dataId=json.loads(dataId), mean=mean, numPix=numPix, path=path)
+                for dataId, mean, numPix, path in rowList]
+
+    def containsAll(self, dataIdList):
+        """Return True if the statistics of all the amps in dataIdList are recorded"""
+        keySet = set(json.dumps(dataId, sort_keys=True) for dataId in dataIdList)
+        with self._transaction() as conn:
+            rowList = conn.execute("SELECT dataId FROM flatStats").fetchall()
+        return keySet.issubset(dataId for dataId, in rowList)
+
+    def remove(self, dataId):
+        """Remove the entry of one amp"""
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM flatStats WHERE dataId = ?", (json.dumps(dataId, sort_keys=True),))
+
+    def computeNormalization(self, level, weighting="amp"):
+        """Return a dict of flatNormKey: normalization for all the amps in the table
+
+        @param[in] level  "sensor", "raft" or "focalPlane"
+        @param[in] weighting  weighting of the amp means; see combineAmpStats
+        """
+        groups = {}
+        for row in self.getRows():
+            groups.setdefault(flatNormKey(row.dataId, level), []).append((row.mean, row.numPix))
+        return {key: combineAmpStats(statsList, weighting) for key, statsList in groups.items()}
@@ -0,0 +1,118 @@
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010, 2011, 2012, 2013 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+import contextlib
+import os
+import sqlite3
+
+import lsst.daf.base as dafBase
+
+__all__ = ["HeaderSidecar", "HEADER_SIDECAR_NAME"]
+
+# name of the sidecar in the root of a repository
+HEADER_SIDECAR_NAME = "headers.sqlite3"
+# column of the file paths; "#" cannot appear in a FITS keyword, so it cannot clash with a card
+PATH_COLUMN = '"#path"'
+
+
+def _quote(name):
+    """Quote a card name as an SQL identifier"""
+    return '"%s"' % (name.replace('"', '""'),)
+
+
+class HeaderSidecar:
+    """A table of the primary headers of the files of a repository
+
+    The table has one row per file, keyed by its path relative to the repository root, and one
+    column per header card, so reading the header of a file is a single indexed row lookup instead
+    of opening (and, for the gzipped images, decompressing) the file.  A second table records the
+    order in which the cards were first seen and which of them are booleans, so that the headers
+    are rebuilt with the same keys, types and values.  Comments and cards with several values
+    (such as COMMENT and HISTORY) are not kept.
+
+    @param[in] path  path of the sqlite database
+    @param[in] create  create the tables if they do not exist?  False for read-only use
+    """
+
+    def __init__(self, path, create=True):
+        self.path = path
+        if create:
+            with self._transaction() as conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS headers (%s TEXT PRIMARY KEY)" % (PATH_COLUMN,))
+                conn.execute("CREATE TABLE IF NOT EXISTS cards (name TEXT PRIMARY KEY, isBool INTEGER)")
+
+    @classmethod
+    def inRepository(cls, root):
+        """Return the sidecar of the repository at root for reading, or None if it has none"""
+        path = os.path.join(root, HEADER_SIDECAR_NAME)
+        return cls(path, create=False) if os.path.exists(path) else None
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """Yield a connection to the database, committing on success"""
+        conn = sqlite3.connect(self.path, timeout=60.)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def add(self, relPath, md):
+        """Record (or replace) the header of one file
+
+        @param[in] relPath  path of the file relative to the repository root
+        @param[in] md  header, as an lsst.daf.base.PropertyList
+        """
+        cardList = []
+        for name in md.names():
+            valueList = md.getArray(name)
+            if len(valueList) == 1 and isinstance(valueList[0], (bool, int, float, str)):
+                cardList.append((name, valueList[0]))
+        with self._transaction() as conn:
+            knownNames = {row[0] for row in conn.execute("SELECT name FROM cards")}
+            for name, value in cardList:
+                if name not in knownNames:
+                    conn.execute("ALTER TABLE headers ADD COLUMN %s" % (_quote(name),))
+                    conn.execute("INSERT INTO cards VALUES (?, ?)", (name, isinstance(value, bool)))
+                    knownNames.add(name)
+            conn.execute("INSERT OR REPLACE INTO headers (%s%s) VALUES (?%s)" %
+                         (PATH_COLUMN, "".join(", " + _quote(name) for name, value in cardList),
+                          ", ?"*len(cardList)),
+                         [os.path.normpath(relPath)] + [value for name, value in cardList])
+
+    def getMetadata(self, relPath):
+        """Return the header of one file as an lsst.daf.base.PropertyList, or None if it has no row
+
+        @param[in] relPath  path of the file relative to the repository root
+        """
+        with self._transaction() as conn:
+            cursor = conn.execute("SELECT * FROM headers WHERE %s = ?" % (PATH_COLUMN,),
+                                  (os.path.normpath(relPath),))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            nameList = [description[0] for description in cursor.description]
+            boolNames = {name for name, in conn.execute("SELECT name FROM cards WHERE isBool")}
+        md = dafBase.PropertyList()
+        for name, value in zip(nameList[1:], row[1:]):
+            if value is not None:
+                md.set(name, bool(value) if name in boolNames else value)
+        return md
@@ -1,11 +1,23 @@
+import os
 from glob import glob
+from lsst.afw.fits import readMetadata
+from lsst.pex.config import Field
 from lsst.pipe.tasks.ingest import ParseTask
-from lsst.pipe.tasks.ingest import IngestTask
+from lsst.pipe.tasks.ingest import IngestConfig, IngestTask
+from .headerSidecar import HeaderSidecar, HEADER_SIDECAR_NAME
 
-__all__ = ['SimIngestTask', 'SimParseTask']
+__all__ = ['SimIngestConfig', 'SimIngestTask', 'SimParseTask']
+
+
+class SimIngestConfig(IngestConfig):
+    doWriteHeaderSidecar = Field(dtype=bool, default=True,
+                                 doc=("Record the primary header of every ingested file in the %s table"
+                                      " of the repository, from which the mapper reads *_md and"
+                                      " VisitInfo without opening the files" % (HEADER_SIDECAR_NAME,)))
 
 
 class SimIngestTask(IngestTask):
+    ConfigClass = SimIngestConfig
 
     def run(self, args):
         """Ingest all specified files and add them to the registry"""
@@ -15,6 +27,9 @@ class SimIngestTask(IngestTask):
         else:
             outpath = args.input
         context = self.register.openRegistry(outpath, create=args.create, dryrun=args.dryrun)
+        sidecar = None
+        if self.config.doWriteHeaderSidecar and not args.dryrun:
+            sidecar = HeaderSidecar(os.path.join(outpath, HEADER_SIDECAR_NAME))
         ingest_list = []
         with context as registry:
             for infile in filenameList:
@@ -28,7 +43,10 @@ class SimIngestTask(IngestTask):
                 if self.register.check(registry, fileInfo):
                     self.log.warn("%s: already ingested: %s", infile, fileInfo)
                 outfile = self.parse.getDestination(args.butler, fileInfo, infile)
-                self.ingest(infile, outfile, mode=args.mode, dryrun=args.dryrun)
+                # read before ingesting: with --mode move the input is gone afterwards
+                md = readMetadata(infile) if sidecar is not None else None
+                if self.ingest(infile, outfile, mode=args.mode, dryrun=args.dryrun) and md is not None:
+                    sidecar.add(os.path.relpath(outfile, outpath), md)
                 for info in hduInfoList:
                     # The eimage has the same info as one of the amps, so if that amp has already
                     # been ingested, skip
@@ -19,12 +19,21 @@
 # the GNU General Public License along with this program.  If not,
 # see <http://www.lsstcorp.org/LegalNotices/>.
 #
+import lsst.afw.image as afwImage
+import lsst.afw.math as afwMath
+import lsst.geom as geom
 import lsst.pex.config as pexConfig
 import lsst.pipe.base as pipeBase
 from lsstDebug import getDebugFrame
 from lsst.afw.display import getDisplay
-from lsst.ip.isr import IsrTask
+from lsst.ip.isr import IsrTask, isrFunctions
 from lsst.pipe.tasks.snapCombine import SnapCombineTask
+from .ampParallel import AmpStageExecutor, maskSaturated, subtractBias, setVarianceFromImage
+from .defectCache import StencilCache, interpolateDefectsWithStencil, PackedMaskCache, orPackedMask
+from .defectUtils import DefectBoxArray
+from .memoryUtils import BufferPool, getRss
+from .snapAccumulator import SnapAccumulator
+from .stripeIsr import makeStripeList, copyAmpToCcd, StripeHalo
 import numpy
 
 __all__ = ["LsstSimIsrTask"]
@@ -45,6 +54,75 @@ class LsstSimIsrConfig(IsrTask.ConfigClass):
         target=SnapCombineTask,
         doc="Combine snaps task",
     )
+    doStreamSnapCombine = pexConfig.Field(
+        dtype=bool,
+        doc="Combine snaps by folding each ISR-corrected snap into running sums as soon as it is made, "
+            "so any number of snaps may be combined while holding about one sensor in memory? "
+            "The snapCombine averageKeys, sumKeys and badMaskPlanes are used, but none of its "
+            "other processing (e.g. repair) is run.",
+        default=False,
+    )
+    doReuseBuffers = pexConfig.Field(
+        dtype=bool,
+        doc="Convert raw pixels straight into float32 image, mask and variance buffers that are "
+            "reused for later snaps and sensors processed by this task, instead of allocating new "
+            "planes for every snap? Most useful with doStreamSnapCombine, which lets the buffers of "
+            "each snap after the first be recycled as soon as it has been combined.",
+        default=False,
+    )
+
+    doStripes = pexConfig.Field(
+        dtype=bool,
+        doc="Process each snap in stripes of whole amplifier rows, reading and correcting the "
+            "amplifiers of one stripe at a time and interpolating stripe by stripe, to bound memory? "
+            "Supports saturation, overscan, bias, variance, flat, defects and saturation interpolation.",
+        default=False,
+    )
+    stripeAmpRows = pexConfig.Field(
+        dtype=int,
+        doc="Number of rows of amplifiers in each stripe if doStripes is true",
+        default=1,
+    )
+    numAmpThreads = pexConfig.Field(
+        dtype=int,
+        doc="Number of threads over which the amplifiers of a stripe are corrected. "
+            "If more than 1, saturation detection, bias subtraction and variance are computed with numpy "
+            "kernels that release the GIL. Only the stripe path uses the threads: the full-sensor "
+            "IsrTask.run path corrects the amplifiers serially, so doStripes must be true if this "
+            "is more than 1.",
+        default=1,
+    )
+    defectInterpolation = pexConfig.ChoiceField(
+        dtype=str,
+        doc="Algorithm with which maskAndInterpolateDefects interpolates over defects",
+        default="afw",
+        allowed={
+            "afw": "isrFunctions interpolation with a Gaussian PSF of the configured FWHM",
+            "stencil": "linear interpolation along rows from a sparse operator precomputed per "
+                       "set of defects (see defectCache); a different algorithm from 'afw', so the "
+                       "results are not the same",
+        },
+    )
+    defectStencilCacheDir = pexConfig.Field(
+        dtype=str,
+        doc="Directory in which interpolation stencils are cached between processes and runs if "
+            "defectInterpolation is 'stencil'; None to cache them in memory only",
+        default=None,
+        optional=True,
+    )
+    doPackedDefectMask = pexConfig.Field(
+        dtype=bool,
+        doc="Set the BAD mask plane from a bit-packed rasterization of the defects, built once per "
+            "detector and set of defects, instead of masking the defects one box at a time?",
+        default=False,
+    )
+    defectMaskCacheDir = pexConfig.Field(
+        dtype=str,
+        doc="Directory in which packed defect masks are cached, and memory-mapped by every process, "
+            "if doPackedDefectMask is true; None to cache them in memory only",
+        default=None,
+        optional=True,
+    )
 
     def setDefaults(self):
         IsrTask.ConfigClass.setDefaults(self)
@@ -53,6 +131,12 @@ class LsstSimIsrConfig(IsrTask.ConfigClass):
                                         "ROTANG", "SPIDANG", "ROTRATE")
         self.snapCombine.sumKeys = ("EXPTIME", "CREXPTM", "DARKTIME")
 
+    def validate(self):
+        IsrTask.ConfigClass.validate(self)
+        if self.numAmpThreads > 1 and not self.doStripes:
+            raise ValueError("numAmpThreads=%s requires doStripes; the full-sensor ISR corrects the "
+                             "amplifiers serially" % (self.numAmpThreads,))
+
 
 class LsstSimIsrTask(IsrTask):
 
@@ -83,6 +167,78 @@ class LsstSimIsrTask(IsrTask):
     def __init__(self, **kwargs):
         IsrTask.__init__(self, **kwargs)
         self.makeSubtask("snapCombine")
+        self.bufferPool = BufferPool()
+        self.ampStageExecutor = AmpStageExecutor(self.config.numAmpThreads)
+        self._pooledPlanes = {}  # image array address: (image, mask, variance) buffers from bufferPool
+        self.stencilCache = StencilCache(self.config.defectStencilCacheDir)
+        self.packedMaskCache = PackedMaskCache(self.config.defectMaskCacheDir)
+
+    def convertIntToFloat(self, exposure):
+        """Convert an integer exposure to floating point
+
+        If config.doReuseBuffers is true the pixels are copied into buffers from self.bufferPool,
+        which are recycled by recycleExposure.
+
+        @param[in] exposure  exposure to convert
+        @return the converted exposure, with the variance set to 1 and the mask cleared
+        """
+        if not self.config.doReuseBuffers or isinstance(exposure, afwImage.ExposureF):
+            return IsrTask.convertIntToFloat(self, exposure)
+
+        xy0 = exposure.getXY0()
+        rawArr = exposure.getMaskedImage().getImage().getArray()
+        imageArr = self.bufferPool.acquire(rawArr.shape, numpy.float32)
+        maskArr = self.bufferPool.acquire(rawArr.shape, afwImage.MaskPixel)
+        varianceArr = self.bufferPool.acquire(rawArr.shape, numpy.float32)
+        numpy.copyto(imageArr, rawArr, casting="unsafe")
+        maskArr.fill(0)
+        varianceArr.fill(1)
+        mi = afwImage.makeMaskedImage(afwImage.ImageF(imageArr, deep=False, xy0=xy0),
+                                      afwImage.Mask(maskArr, deep=False, xy0=xy0),
+                                      afwImage.ImageF(varianceArr, deep=False, xy0=xy0))
+        self._pooledPlanes[imageArr.ctypes.data] = (imageArr, maskArr, varianceArr)
+        return afwImage.ExposureF(mi, exposure.getInfo())
+
+    def recycleExposure(self, exposure=None):
+        """Return pixel buffers to self.bufferPool
+
+        @param[in] exposure  exposure whose buffers are recycled; the caller must not use it afterwards.
+            This may be an exposure returned by runDataRef, whose planes then join the pool.
+            If None then recycle every pooled buffer that does not back an exposure still in use
+            by runDataRef; exposures returned by runDataRef are left alone.
+        """
+        if exposure is None:
+            keys = list(self._pooledPlanes.keys())
+        else:
+            mi = exposure.getMaskedImage()
+            planes = (mi.getImage().getArray(), mi.getMask().getArray(), mi.getVariance().getArray())
+            keys = [planes[0].ctypes.data]
+            if keys[0] not in self._pooledPlanes and all(array.flags.c_contiguous for array in planes):
+                self._pooledPlanes[keys[0]] = planes
+        for key in keys:
+            for array in self._pooledPlanes.pop(key, ()):
+                self.bufferPool.release(array)
+
+    def _keepPooledPlanes(self, exposureList):
+        """Recycle the pooled buffers that do not back any of the given exposures
+        """
+        keep = set(exposure.getMaskedImage().getImage().getArray().ctypes.data for exposure in exposureList)
+        for key in list(self._pooledPlanes.keys()):
+            if key not in keep:
+                for array in self._pooledPlanes.pop(key):
+                    self.bufferPool.release(array)
+
+    def logRss(self, stage):
+        """Log and record in the task metadata the current and peak RSS after a processing stage
+
+        @param[in] stage  name of the stage, used as the prefix of the metadata keys
+        """
+        current, peak = getRss()
+        self.log.debug("RSS after %s: current %s MiB, peak %.1f MiB", stage,
+                       "%.1f" % (current/2**20,) if current is not None else "?", peak/2**20)
+        if current is not None:
+            self.metadata.add("%sRss" % (stage,), current)
+        self.metadata.add("%sMaxRss" % (stage,), peak)
 
     def unmaskSatHotPixels(self, exposure):
         mi = exposure.getMaskedImage()
@@ -92,8 +248,40 @@ class LsstSimIsrTask(IsrTask):
         satBitmask = numpy.array(mask.getPlaneBitMask("SAT"), dtype=maskarr.dtype)
         orBitmask = badBitmask | satBitmask
         andMask = ~satBitmask
-        idx = numpy.where((maskarr & orBitmask) == orBitmask)
-        maskarr[idx] &= andMask
+        # clear SAT in place where BAD is also set, without building index arrays
+        numpy.bitwise_and(maskarr, andMask, out=maskarr, where=(maskarr & orBitmask) == orBitmask)
+
+    def maskDefect(self, exposure, defectBaseList):
+        """Mask defects using mask plane "BAD", in place
+
+        With doPackedDefectMask the defects are rasterized once per detector and set of defects
+        and ORed into the mask in one operation.
+
+        @param[in,out] exposure  exposure to process
+        @param[in] defectBaseList  list of defects, in the parent coordinates of exposure
+        """
+        if not self.config.doPackedDefectMask:
+            return IsrTask.maskDefect(self, exposure, defectBaseList)
+        mask = exposure.getMaskedImage().getMask()
+        xy0 = mask.getXY0()
+        boxes = DefectBoxArray.fromDefects(defectBaseList).shifted(-xy0.getX(), -xy0.getY())
+        maskArr = mask.getArray()
+        orPackedMask(maskArr, self.packedMaskCache.get(boxes, maskArr.shape), mask.getPlaneBitMask("BAD"))
+
+    def maskAndInterpolateDefects(self, exposure, defectBaseList):
+        """Mask defects using mask plane "BAD" and interpolate over them, in place
+
+        With defectInterpolation "stencil" the interpolation is a precomputed sparse operator,
+        built once per set of defects and cached.
+
+        @param[in,out] exposure  exposure to process
+        @param[in] defectBaseList  list of defects, in the parent coordinates of exposure
+        """
+        if self.config.defectInterpolation == "afw":
+            return IsrTask.maskAndInterpolateDefects(self, exposure, defectBaseList)
+        self.maskDefect(exposure, defectBaseList)
+        interpolateDefectsWithStencil(exposure.getMaskedImage(), DefectBoxArray.fromDefects(defectBaseList),
+                                      self.config.fwhm, self.stencilCache)
 
     def saturationInterpolation(self, ccdExposure):
         r"""!Unmask hot pixels and interpolate over saturated pixels, in place
@@ -108,34 +296,57 @@ class LsstSimIsrTask(IsrTask):
         super(LsstSimIsrTask, self).saturationInterpolation(ccdExposure)
 
     @pipeBase.timeMethod
-    def runDataRef(self, sensorRef):
+    def runDataRef(self, sensorRef, camera=None):
         """Do instrument signature removal on an exposure
 
         Correct for saturation, bias, overscan, dark, flat..., perform CCD assembly,
         optionally combine snaps, and interpolate over defects and saturated pixels.
 
-        If config.doSnapCombine true then combine the two ISR-corrected snaps to produce the final exposure.
+        If config.doSnapCombine true then combine the two ISR-corrected snaps to produce the final exposure;
+        if config.doStreamSnapCombine is also true then any number of snaps are combined, each being
+        folded into running sums as soon as it has been corrected.
         If config.doSnapCombine false then uses ISR-corrected snap 0 as the final exposure.
         In either case, the final exposure is persisted as "postISRCCD" if config.doWriteSpans is True,
         and the two snaps are persisted as "snapExp" if config.doWriteSnaps is True.
 
         @param sensorRef daf.persistence.butlerSubset.ButlerDataRef of the data to be processed
+        @param camera camera geometry; if None then it is read from sensorRef.
+            Batch drivers processing many sensors pass it in so it is only loaded once.
         @return a pipeBase.Struct with fields:
         - exposure: the exposure after application of ISR
         """
         self.log.info("Performing ISR on sensor %s", sensorRef.dataId)
-        camera = sensorRef.get("camera")
+        if camera is None:
+            camera = sensorRef.get("camera")
         snapDict = dict()
+        accumulator = None
+        if self.config.doSnapCombine and self.config.doStreamSnapCombine:
+            accumulator = SnapAccumulator(
+                averageKeys=self.snapCombine.config.averageKeys,
+                sumKeys=self.snapCombine.config.sumKeys,
+                badMaskPlanes=self.snapCombine.config.badMaskPlanes,
+                log=self.log,
+            )
         for snapRef in sensorRef.subItems(level="snap"):
             snapId = snapRef.dataId['snap']
-            if snapId not in (0, 1):
+            if accumulator is None and snapId not in (0, 1):
                 raise RuntimeError("Unrecognized snapId=%s" % (snapId,))
 
             self.log.info("Performing ISR on snap %s", snapRef.dataId)
-            ccdExposure = snapRef.get('raw')
-            isrData = self.readIsrData(snapRef, ccdExposure)
-            ccdExposure = self.run(ccdExposure, camera=camera, **isrData.getDict()).exposure
-            snapDict[snapId] = ccdExposure
+            if self.config.doStripes:
+                ccdExposure = self.runStripes(snapRef, camera)
+            else:
+                ccdExposure = snapRef.get('raw')
+                isrData = self.readIsrData(snapRef, ccdExposure)
+                self.logRss("read")
+                ccdExposure = self.run(ccdExposure, camera=camera, **isrData.getDict()).exposure
+            self.logRss("isr")
+            if self.config.doReuseBuffers:
+                # buffers not backing the corrected snap (e.g. the pre-assembly planes) are free now
+                keepList = [ccdExposure] + list(snapDict.values())
+                if accumulator is not None and accumulator.numSnaps > 0:
+                    keepList.append(accumulator.exposure)
+                self._keepPooledPlanes(keepList)
 
             if self.config.doWriteSnaps:
                 sensorRef.put(ccdExposure, "snapExp", snap=snapId)
@@ -144,7 +355,19 @@ class LsstSimIsrTask(IsrTask):
             if frame:
                 getDisplay(frame).mtv(ccdExposure)
 
-        if self.config.doSnapCombine:
+            if accumulator is not None:
+                accumulator.add(ccdExposure)
+                if self.config.doReuseBuffers and accumulator.exposure is not ccdExposure:
+                    self.recycleExposure(ccdExposure)
+                self.logRss("combine")
+            else:
+                snapDict[snapId] = ccdExposure
+            del ccdExposure
+
+        if accumulator is not None:
+            self.log.info("Combined %d snaps", accumulator.numSnaps)
+            postIsrExposure = accumulator.finish()
+        elif self.config.doSnapCombine:
             loadSnapDict(snapDict, snapIdList=(0, 1), sensorRef=sensorRef)
             postIsrExposure = self.snapCombine.run(snapDict[0], snapDict[1]).exposure
         else:
@@ -152,8 +375,14 @@ class LsstSimIsrTask(IsrTask):
             loadSnapDict(snapDict, snapIdList=(0,), sensorRef=sensorRef)
             postIsrExposure = snapDict[0]
 
+        if self.config.doReuseBuffers:
+            self._keepPooledPlanes([postIsrExposure])
+            # the caller owns the result: its buffers must not be recycled by the next call
+            self._pooledPlanes.pop(postIsrExposure.getMaskedImage().getImage().getArray().ctypes.data, None)
+
         if self.config.doWrite:
             sensorRef.put(postIsrExposure, "postISRCCD")
+            self.logRss("write")
 
         frame = getDebugFrame(self._display, "postISRCCD")
         if frame:
@@ -163,6 +392,163 @@ class LsstSimIsrTask(IsrTask):
             exposure=postIsrExposure,
         )
 
+    def runStripes(self, snapRef, camera):
+        """Do instrument signature removal on one snap, a stripe of amplifiers at a time
+
+        The amplifiers of each stripe are read, corrected for saturation, overscan, bias,
+        variance and flat (concurrently if config.numAmpThreads > 1), trimmed and copied into a
+        CCD-level exposure before the next stripe is read, so at most one stripe of raw amplifier
+        data and calibrations is held besides the output.  Saturated pixels and defects are then
+        interpolated stripe by stripe, using a halo of growSaturationFootprintSize rows and a
+        fallback value computed from the whole CCD; since the interpolation works along rows the
+        result matches the full-frame processing.
+
+        @param[in] snapRef  snap-level data reference
+        @param[in] camera  camera geometry
+        @return the post-ISR exposure of the snap
+        """
+        for name in ("doDark", "doFringe", "doLinearize", "doCrosstalk", "doBrighterFatter"):
+            if getattr(self.config, name, False):
+                raise RuntimeError("%s is not supported with doStripes" % (name,))
+        detector = camera["R:%(raft)s S:%(sensor)s" % snapRef.dataId]
+        halo = self.config.growSaturationFootprintSize if self.config.doSaturationInterpolation else 0
+        stripeList = makeStripeList(detector, ampRowsPerStripe=self.config.stripeAmpRows, halo=halo)
+        ampRefDict = dict((ampRef.dataId['channel'], ampRef) for ampRef in snapRef.subItems(level="channel"))
+
+        ccdExposure = None
+        for stripe in stripeList:
+            ampDataList = []
+            for amp in stripe.ampList:
+                ampRef = ampRefDict[amp.getName()]
+                ampExposure = self.convertIntToFloat(ampRef.get("raw"))
+                if ccdExposure is None:
+                    ccdExposure = self._makeStripeOutputExposure(ampExposure, detector, amp)
+                ampDataList.append(pipeBase.Struct(
+                    exposure=ampExposure,
+                    amp=amp,
+                    bias=ampRef.get("bias") if self.config.doBias else None,
+                    flat=ampRef.get("flat") if self.config.doFlat else None,
+                ))
+            dataViewList = self.ampStageExecutor.map(self.correctAmp, ampDataList)
+            for ampData, dataView in zip(ampDataList, dataViewList):
+                copyAmpToCcd(dataView.getMaskedImage(), ccdExposure.getMaskedImage(), ampData.amp)
+                if self.config.doReuseBuffers:
+                    self.recycleExposure(ampData.exposure)
+            del ampDataList, dataViewList
+            self.logRss("stripe")
+
+        self.interpolateStripeExposure(ccdExposure, stripeList,
+                                       snapRef.get("defects") if self.config.doDefect else None)
+        return ccdExposure
+
+    def interpolateStripeExposure(self, ccdExposure, stripeList, defectBaseList=None):
+        """Interpolate over saturated pixels and defects of an exposure assembled by stripes, in place
+
+        The result matches saturationInterpolation followed by maskAndInterpolateDefects on the
+        whole exposure, with the same choice of defectInterpolation and doPackedDefectMask.
+        The "afw" interpolation works on halo copies of one stripe at a time; the "stencil"
+        interpolation is a single sparse operation along rows, so it is applied to the whole
+        exposure without copying it.
+
+        @param[in,out] ccdExposure  CCD-level exposure
+        @param[in] stripeList  stripes, as returned by makeStripeList
+        @param[in] defectBaseList  list of defects, in the parent coordinates of ccdExposure;
+            None to skip defect correction
+        """
+        if self.config.doSaturationInterpolation:
+            self.unmaskSatHotPixels(ccdExposure)
+            self.interpolateStripes(ccdExposure, stripeList, maskNameList=[self.config.saturatedMaskName],
+                                    growSaturatedFootprints=self.config.growSaturationFootprintSize)
+        if defectBaseList is not None:
+            if self.config.defectInterpolation == "stencil":
+                self.maskAndInterpolateDefects(ccdExposure, defectBaseList)
+            else:
+                self.maskDefect(ccdExposure, defectBaseList)
+                self.interpolateStripes(ccdExposure, stripeList, maskNameList=["BAD"],
+                                        growSaturatedFootprints=0)
+
+    def correctAmp(self, ampData):
+        """Apply the pre-assembly corrections to one amplifier
+
+        Safe to call from several threads at once for different amplifiers.
+
+        @param[in,out] ampData  pipeBase.Struct with fields:
+        - exposure: raw amplifier exposure, converted to float; corrected in place
+        - amp: amplifier (lsst.afw.cameraGeom.Amplifier)
+        - bias: bias exposure of the amplifier data section, or None
+        - flat: flat exposure of the amplifier data section, or None
+        @return a view of the data section of the corrected exposure
+        """
+        exposure = ampData.exposure
+        amp = ampData.amp
+        useKernels = self.ampStageExecutor.numThreads > 1
+        if self.config.doSaturation:
+            if useKernels:
+                mi = exposure.getMaskedImage()
+                maskSaturated(mi, amp.getSaturation(),
+                              mi.getMask().getPlaneBitMask(self.config.saturatedMaskName))
+            else:
+                self.saturationDetection(exposure, amp)
+        if self.config.doOverscan:
+            self.overscanCorrection(exposure, amp)
+        dataView = exposure.Factory(exposure, amp.getRawDataBBox())
+        if ampData.bias is not None:
+            if useKernels:
+                subtractBias(dataView.getMaskedImage(), ampData.bias.getMaskedImage())
+            else:
+                self.biasCorrection(dataView, ampData.bias)
+        if self.config.doVariance:
+            if useKernels:
+                setVarianceFromImage(dataView.getMaskedImage(), amp.getGain(), amp.getReadNoise())
+            else:
+                self.updateVariance(dataView, amp)
+        if ampData.flat is not None:
+            self.flatCorrection(dataView, ampData.flat)
+        return dataView
+
+    def interpolateStripes(self, ccdExposure, stripeList, maskNameList, growSaturatedFootprints):
+        """Interpolate over masked pixels one stripe at a time, in place
+
+        @param[in,out] ccdExposure  CCD-level exposure
+        @param[in] stripeList  stripes, as returned by makeStripeList
+        @param[in] maskNameList  names of the mask planes of the pixels to interpolate over
+        @param[in] growSaturatedFootprints  number of pixels by which to grow SAT footprints;
+            must not exceed the stripe halo
+        """
+        mi = ccdExposure.getMaskedImage()
+        fallbackValue = afwMath.makeStatistics(mi.getImage(), afwMath.MEANCLIP).getValue()
+        halo = StripeHalo()
+        for i, stripe in enumerate(stripeList):
+            stripeMi = mi.Factory(mi, stripe.haloBBox, deep=True)
+            halo.restore(stripeMi)
+            halo.save(mi, stripe, stripeList[i + 1] if i + 1 < len(stripeList) else None)
+            isrFunctions.interpolateFromMask(
+                maskedImage=stripeMi,
+                fwhm=self.config.fwhm,
+                growSaturatedFootprints=growSaturatedFootprints,
+                maskNameList=maskNameList,
+                fallbackValue=fallbackValue,
+            )
+            mi.Factory(mi, stripe.bbox).assign(stripeMi.Factory(stripeMi, stripe.bbox))
+
+    def _makeStripeOutputExposure(self, ampExposure, detector, amp):
+        """Make the CCD-level exposure into which stripe processing writes its results
+
+        @param[in] ampExposure  raw exposure of one amplifier, providing the metadata
+        @param[in] detector  detector being processed
+        @param[in] amp  amplifier of ampExposure
+        """
+        ccdExposure = afwImage.ExposureF(detector.getBBox())
+        ccdExposure.setDetector(detector)
+        ccdExposure.setMetadata(ampExposure.getMetadata())
+        ccdExposure.setFilter(ampExposure.getFilter())
+        ccdExposure.getInfo().setVisitInfo(ampExposure.getInfo().getVisitInfo())
+        wcs = ampExposure.getWcs()
+        if wcs is not None and not amp.getRawFlipX() and not amp.getRawFlipY():
+            offset = amp.getBBox().getMin() - amp.getRawDataBBox().getMin()
+            ccdExposure.setWcs(wcs.copyAtShiftedPixelOrigin(geom.Extent2D(offset)))
+        return ccdExposure
+
 
 def loadSnapDict(snapDict, snapIdList, sensorRef):
     """Load missing snaps from disk.
@@ -22,16 +22,22 @@
 
 __all__ = ["LsstSimMapper"]
 
+import collections
 import os
 import re
 from astropy.io import fits
+import numpy
 
 import lsst.daf.base as dafBase
+from lsst.afw.fits import readMetadata
 import lsst.afw.image.utils as afwImageUtils
 import lsst.geom as geom
 import lsst.daf.persistence as dafPersist
 from lsst.meas.algorithms import Defects
+from .fitsHeaders import readFitsHeaders, headerColumns
+from .headerSidecar import HeaderSidecar
 from .makeLsstSimRawVisitInfo import MakeLsstSimRawVisitInfo
+from .visitFootprint import VisitFootprint
 from lsst.utils import getPackageDir
 
 from lsst.obs.base import CameraMapper
@@ -46,11 +52,17 @@ class LsstSimMapper(CameraMapper):
 
     _CcdNameRe = re.compile(r"R:(\d,\d) S:(\d,\d(?:,[AB])?)$")
 
+    # the maximum number of visits whose footprints are cached
+    maxVisitFootprints = 16
+
     def __init__(self, inputPolicy=None, **kwargs):
         policyFile = dafPersist.Policy.defaultPolicyFile(self.packageName, "LsstSimMapper.yaml", "policy")
         policy = dafPersist.Policy(policyFile)
         repositoryDir = os.path.join(getPackageDir(self.packageName), 'policy')
         self.defectRegistry = None
+        self._defectTableCache = {}
+        self._headerSidecars = {}
+        self._visitFootprintCache = collections.OrderedDict()
         if 'defects' in policy:
             self.defectPath = os.path.join(repositoryDir, policy['defects'])
             defectRegistryLocation = os.path.join(self.defectPath, "defectRegistry.sqlite3")
@@ -306,21 +318,217 @@ class LsstSimMapper(CameraMapper):
         detectorName = self._extractDetectorName(dataId)
         defectsFitsPath = butlerLocation.locationList[0]
 
-        with fits.open(defectsFitsPath) as hduList:
-            for hdu in hduList[1:]:
-                if hdu.header["name"] != detectorName:
-                    continue
-
-                defectList = Defects()
-                for data in hdu.data:
-                    bbox = geom.Box2I(
-                        geom.Point2I(int(data['x0']), int(data['y0'])),
-                        geom.Extent2I(int(data['width']), int(data['height'])),
-                    )
-                    defectList.append(bbox)
-                return defectList
-
-        raise RuntimeError("No defects for ccd %s in %s" % (detectorName, defectsFitsPath))
+        defectTable = self._readDefectTable(defectsFitsPath).get(detectorName)
+        if defectTable is None:
+            raise RuntimeError("No defects for ccd %s in %s" % (detectorName, defectsFitsPath))
+
+        defectList = Defects()
+        for x0, y0, width, height in defectTable:
+            defectList.append(geom.Box2I(geom.Point2I(x0, y0), geom.Extent2I(width, height)))
+        return defectList
+
+    def _readDefectTable(self, defectsFitsPath):
+        """Read and cache the defect boxes of every detector in a defects file
+
+        Every sensor of a raft (and every snap of a sensor) asks for its defects separately;
+        caching the parsed file means it is only opened once per mapper.
+
+        Parameters
+        ----------
+        defectsFitsPath : `str`
+            Path to the defects FITS file.
+
+        Returns
+        -------
+        `dict`
+            Detector name: list of (x0, y0, width, height) tuples.
+        """
+        defectTableDict = self._defectTableCache.get(defectsFitsPath)
+        if defectTableDict is None:
+            defectTableDict = {}
+            with fits.open(defectsFitsPath) as hduList:
+                for hdu in hduList[1:]:
+                    defectTableDict[hdu.header["name"]] = [
+                        (int(data['x0']), int(data['y0']), int(data['width']), int(data['height']))
+                        for data in hdu.data
+                    ]
+            self._defectTableCache[defectsFitsPath] = defectTableDict
+        return defectTableDict
+
+    def _readHeader(self, location):
+        """Return the primary header of the file of a butler location
+
+        The header is read from the header sidecar written at ingest if the repository has one
+        with a row for the file, and from the file otherwise.
+
+        Parameters
+        ----------
+        location : `lsst.daf.persistence.ButlerLocation`
+            Location of the file.
+
+        Returns
+        -------
+        `lsst.daf.base.PropertyList`
+            The header; a new object, which the caller may modify.
+        """
+        md = self._readSidecarHeader(location)
+        if md is None:
+            md = readMetadata(location.getLocationsWithRoot()[0])
+        return md
+
+    def _readSidecarHeader(self, location):
+        """Return the header of the file of a butler location from the header sidecar of its
+        repository, or None if there is no sidecar or it has no row for the file
+        """
+        relPath = location.getLocations()[0]
+        fullPath = location.getLocationsWithRoot()[0]
+        if not fullPath.endswith(relPath):
+            return None
+        root = fullPath[:len(fullPath) - len(relPath)] or "."
+        if root not in self._headerSidecars:
+            self._headerSidecars[root] = HeaderSidecar.inRepository(root)
+        sidecar = self._headerSidecars[root]
+        return sidecar.getMetadata(relPath) if sidecar is not None else None
+
+    def readMetadataBulk(self, datasetType, dataIdList, numThreads=8):
+        """Read the headers of a CCD-level dataset for many data IDs, e.g. all the calexps of a visit
+
+        The files are located serially (the registry lookups are not thread safe), then the headers
+        found in the header sidecar are taken from it and the others are read concurrently on
+        numThreads threads, reading only the header blocks of each file.  The headers are not
+        standardized as by the butler's <datasetType>_md.
+
+        Parameters
+        ----------
+        datasetType : `str`
+            Name of a CCD-level dataset stored as a FITS file, e.g. "calexp"; a "_md" suffix is
+            ignored.
+        dataIdList : iterable of `dict`
+            Data IDs of the datasets.
+        numThreads : `int`
+            Number of threads reading headers.
+
+        Returns
+        -------
+        `collections.OrderedDict`
+            ccdExposureId: header as an `lsst.daf.base.PropertyList`, in the order of dataIdList.
+
+        Raises
+        ------
+        RuntimeError
+            If two data IDs have the same ccdExposureId.
+        """
+        if datasetType.endswith("_md"):
+            datasetType = datasetType[:-len("_md")]
+        result = collections.OrderedDict()
+        toRead = []
+        for dataId in dataIdList:
+            location = self.map(datasetType, dataId)
+            ccdExposureId = self._computeCcdExposureId(dataId)
+            if ccdExposureId in result:
+                raise RuntimeError("Data IDs %s have the same ccdExposureId %d" % (dataId, ccdExposureId))
+            result[ccdExposureId] = self._readSidecarHeader(location)
+            if result[ccdExposureId] is None:
+                toRead.append((ccdExposureId, location.getLocationsWithRoot()[0]))
+        mdList = readFitsHeaders([path for ccdExposureId, path in toRead], numThreads=numThreads)
+        for (ccdExposureId, path), md in zip(toRead, mdList):
+            result[ccdExposureId] = md
+        return result
+
+    def readMetadataColumns(self, datasetType, dataIdList, keys=None, numThreads=8):
+        """Read the headers of a CCD-level dataset for many data IDs as columns, one array per keyword
+
+        The headers are read as by readMetadataBulk, then gathered by keyword, so that quantities
+        computed from the headers of many detectors can be computed on whole arrays.
+
+        Parameters
+        ----------
+        datasetType : `str`
+            Name of a CCD-level dataset stored as a FITS file, e.g. "calexp"; a "_md" suffix is
+            ignored.
+        dataIdList : iterable of `dict`
+            Data IDs of the datasets.
+        keys : iterable of `str`, optional
+            Keywords to return; by default every keyword of any of the headers.
+        numThreads : `int`
+            Number of threads reading headers.
+
+        Returns
+        -------
+        `collections.OrderedDict`
+            keyword: `numpy.ndarray` of the values of the headers, in the order of dataIdList, as
+            returned by `lsst.obs.lsstSim.fitsHeaders.headerColumns`, preceded by a "ccdExposureId"
+            column of the ccdExposureIds of the data IDs.
+
+        Raises
+        ------
+        RuntimeError
+            If two data IDs have the same ccdExposureId.
+        """
+        mdDict = self.readMetadataBulk(datasetType, dataIdList, numThreads=numThreads)
+        columns = collections.OrderedDict(ccdExposureId=numpy.array(list(mdDict), dtype=numpy.int64))
+        columns.update(headerColumns(mdDict.values(), keys=keys))
+        return columns
+
+    def getVisitFootprint(self, visit, datasetType="calexp", dataIdList=None, numThreads=8):
+        """Return the sky corners and polygons of the detectors of a visit
+
+        The headers are read in bulk as columns by readMetadataColumns and the corners of the
+        detectors are computed by VisitFootprint.fromColumns, in one vectorized TAN-SIP transform.
+        The result is cached per visit, dataset type and list of data IDs, so warping and
+        tract/patch selection can share it.
+
+        Parameters
+        ----------
+        visit : `int`
+            Visit number.
+        datasetType : `str`
+            CCD-level dataset whose headers hold the WCSs, e.g. "calexp" or "eimage".
+        dataIdList : iterable of `dict`, optional
+            Data IDs of the detectors; by default all the sensors of the visit in the registry,
+            with snap=0.
+        numThreads : `int`
+            Number of threads reading headers.
+
+        Returns
+        -------
+        `lsst.obs.lsstSim.visitFootprint.VisitFootprint`
+            Corners and polygons of the detectors, keyed by ccdExposureId.
+        """
+        if dataIdList is not None:
+            dataIdList = list(dataIdList)
+            # a footprint of some of the detectors must not be returned for the whole visit
+            key = (datasetType, visit,
+                   tuple(sorted(tuple(sorted(dataId.items())) for dataId in dataIdList)))
+        else:
+            key = (datasetType, visit, None)
+        footprint = self._visitFootprintCache.get(key)
+        if footprint is not None:
+            self._visitFootprintCache.move_to_end(key)
+            return footprint
+        if dataIdList is None:
+            dataIdList = [dict(visit=visit, raft=raft, sensor=sensor, snap=0) for raft, sensor in
+                          sorted(set(self.queryMetadata("raw", ("raft", "sensor"), dict(visit=visit))))]
+        footprint = VisitFootprint.fromColumns(
+            self.readMetadataColumns(datasetType, dataIdList, numThreads=numThreads))
+        self._visitFootprintCache[key] = footprint
+        while len(self._visitFootprintCache) > self.maxVisitFootprints:
+            self._visitFootprintCache.popitem(last=False)
+        return footprint
+
+    def bypass_raw_md(self, datasetType, pythonType, location, dataId):
+        return self._readHeader(location)
+
+    def bypass_eimage_md(self, datasetType, pythonType, location, dataId):
+        return self._readHeader(location)
+
+    def bypass_raw_visitInfo(self, datasetType, pythonType, location, dataId):
+        return self.makeRawVisitInfo(md=self._readHeader(location),
+                                     exposureId=self._computeCcdExposureId(dataId))
+
+    def bypass_eimage_visitInfo(self, datasetType, pythonType, location, dataId):
+        return self.makeRawVisitInfo(md=self._readHeader(location),
+                                     exposureId=self._computeCcdExposureId(dataId))
 
     _nbit_id = 30
 
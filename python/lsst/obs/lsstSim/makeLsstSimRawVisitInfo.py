@@ -19,6 +19,9 @@
 # the GNU General Public License along with this program.  If not,
 # see <http://www.lsstcorp.org/LegalNotices/>.
 #
+import collections
+import threading
+
 import astropy.units
 
 from lsst.afw.image import VisitInfo, RotType
@@ -38,9 +41,56 @@ class MakeLsstSimRawVisitInfo(MakeRawVisitInfo):
     at 90 degrees E = -X CCD = -Y Focal Plane, N = +Y CCD = -X Focal Plane: 270 boresightRotAng
 
     So boresightRotAng = -ROTANG
+
+    All the amps of a visit and snap share the cards a VisitInfo is made from, so the arguments
+    parsed from them are cached, keyed by the values of those cards (cardKeys), and only the
+    exposure ID differs from one amp to the next.  The cards are still popped from the metadata
+    on a cache hit, and the warnings from parsing them are only logged once per visit and snap.
     """
     observatory = Observatory(-70.749417*degrees, -30.244633*degrees, 2663)  # long, lat, elev
 
+    # the cards that setArgDict reads
+    cardKeys = ("EXPTIME", "TAI", "DARKTIME", "AZIMUTH", "ZENITH", "RA_DEG", "DEC_DEG", "AIRMASS",
+                "ROTANG", "TEMPERA", "PRESS", "HA")
+    # the maximum number of visits and snaps whose arguments are cached
+    maxCacheSize = 16
+
+    def __init__(self, *args, **kwargs):
+        MakeRawVisitInfo.__init__(self, *args, **kwargs)
+        self._argDictCache = collections.OrderedDict()
+        self._cacheLock = threading.Lock()
+
+    def __call__(self, md, exposureId):
+        """Construct a VisitInfo and strip associated data from the metadata
+
+        @param[in,out] md  metadata, as an lsst.daf.base.PropertyList or PropertySet;
+            the cards used are removed, as by setArgDict
+        @param[in] exposureId  exposure ID
+        """
+        fingerprint = tuple(md.getScalar(key) if md.exists(key) else None for key in self.cardKeys)
+        with self._cacheLock:
+            cached = self._argDictCache.get(fingerprint)
+            if cached is not None:
+                self._argDictCache.move_to_end(fingerprint)
+        if cached is None:
+            namesBefore = set(md.names())
+            argDict = dict()
+            self.setArgDict(md, argDict)
+            for key in list(argDict.keys()):
+                if argDict[key] is None:
+                    self.log.warn("argDict[%s] is None; stripping", key)
+                    del argDict[key]
+            cached = (argDict, namesBefore - set(md.names()))
+            with self._cacheLock:
+                self._argDictCache[fingerprint] = cached
+                while len(self._argDictCache) > self.maxCacheSize:
+                    self._argDictCache.popitem(last=False)
+        else:
+            for name in cached[1]:
+                if md.exists(name):
+                    md.remove(name)
+        return VisitInfo(exposureId=exposureId, **cached[0])
+
     def setArgDict(self, md, argDict):
         """Set an argument dict for VisitInfo and pop associated metadata
 
@@ -0,0 +1,90 @@
+#
+# LSST Data Management System
+# Copyright 2008-2016 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+import os
+import resource
+import sys
+
+import numpy
+
+__all__ = ["BufferPool", "getRss"]
+
+
+class BufferPool:
+    """A pool of numpy arrays that are reused instead of being reallocated
+
+    Arrays are handed out by acquire and returned by release; a released array is handed out
+    again by a later acquire with the same shape and dtype.  The caller must not use an array
+    after releasing it.
+    """
+
+    def __init__(self):
+        self._free = {}
+        self.numAllocated = 0
+        self.numReused = 0
+
+    def acquire(self, shape, dtype):
+        """Return an array of the given shape and dtype; its contents are undefined
+
+        @param[in] shape  shape of the array
+        @param[in] dtype  numpy dtype of the array
+        """
+        key = (tuple(shape), numpy.dtype(dtype))
+        freeList = self._free.get(key)
+        if freeList:
+            self.numReused += 1
+            return freeList.pop()
+        self.numAllocated += 1
+        return numpy.empty(shape, dtype=dtype)
+
+    def release(self, array):
+        """Return an array to the pool
+
+        @param[in] array  array previously returned by acquire
+        """
+        self._free.setdefault((array.shape, array.dtype), []).append(array)
+
+    def clear(self):
+        """Drop all the free arrays
+        """
+        self._free = {}
+
+    @property
+    def nbytes(self):
+        """Number of bytes held in free arrays"""
+        return sum(array.nbytes for freeList in self._free.values() for array in freeList)
+
+
+def getRss():
+    """Return the current and peak resident set size of this process
+
+    @return (current RSS, peak RSS) in bytes; current RSS is None if it is not available
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != "darwin":
+        peak *= 1024  # ru_maxrss is in kB on Linux, bytes on macOS
+    current = None
+    try:
+        with open("/proc/self/statm") as f:
+            current = int(f.read().split()[1])*os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+    return current, peak
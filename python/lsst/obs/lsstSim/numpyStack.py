@@ -0,0 +1,151 @@
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010, 2011, 2012, 2013 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+import lsst.afw.image as afwImage
+import numpy
+
+__all__ = ["stackMaskedImages", "stackCube"]
+
+# conversion from the interquartile range to the standard deviation of a Gaussian, as used by afw
+IQ_TO_STDEV = 0.741301109252802
+
+
+def stackCube(imageCube, maskCube, varianceCube, method="MEANCLIP", numSigmaClip=3., numIter=3,
+              andMask=0, weights=None):
+    """Stack a cube of pixels along its first axis
+
+    The clipped mean follows the afw MEANCLIP algorithm: the first clip is about the median
+    with a width derived from the interquartile range, and each of numIter iterations then
+    clips about the mean of the previous one with a width of numSigmaClip standard deviations.
+    Pixels where none survive a clip keep the previous estimate.
+
+    @param[in] imageCube  float array of shape (number of frames, rows, columns)
+    @param[in] maskCube  mask array of the same shape
+    @param[in] varianceCube  variance array of the same shape
+    @param[in] method  "MEANCLIP" or "MEDIAN"
+    @param[in] numSigmaClip  clipping threshold in standard deviations
+    @param[in] numIter  number of clipping iterations
+    @param[in] andMask  pixels with any of these mask bits set are ignored
+    @param[in] weights  weight of each frame in the clipped mean, or None for equal weights;
+        ignored by MEDIAN
+    @return (image, mask, variance, good) arrays of shape (rows, columns); mask is the OR of the
+        masks of the pixels not ignored, and good is False where all the pixels were ignored.
+        The variance is that of the (weighted) mean of the surviving pixels, times pi/2 for MEDIAN.
+    """
+    if method not in ("MEANCLIP", "MEDIAN"):
+        raise ValueError("Method %s is not supported for combining frames" % (method,))
+    imageCube = numpy.asarray(imageCube, dtype=numpy.float32)
+    valid = (maskCube & andMask) == 0
+    valid &= numpy.isfinite(imageCube)
+    numValid = valid.sum(axis=0)
+    good = numValid > 0
+    mask = numpy.bitwise_or.reduce(numpy.where(valid, maskCube, 0), axis=0).astype(maskCube.dtype)
+    data = numpy.where(valid, imageCube, numpy.nan)
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        if method == "MEDIAN":
+            image = numpy.nanmedian(data, axis=0) if good.all() else _nanReduce(numpy.nanmedian, data, good)
+            variance = (0.5*numpy.pi)*numpy.where(valid, varianceCube, 0).sum(axis=0)/numValid**2
+            return image.astype(numpy.float32), mask, variance.astype(numpy.float32), good
+
+        if weights is None:
+            weightCube = valid.astype(numpy.float32)
+        else:
+            weightCube = valid*numpy.asarray(weights, dtype=numpy.float32)[:, numpy.newaxis, numpy.newaxis]
+        if good.all():
+            q25, center, q75 = numpy.nanpercentile(data, [25., 50., 75.], axis=0)
+        else:
+            q25, center, q75 = _nanReduce(lambda d, axis: numpy.nanpercentile(d, [25., 50., 75.], axis=axis),
+                                          data, good, shape=(3,))
+        halfWidth = numSigmaClip*IQ_TO_STDEV*(q75 - q25)
+        use = valid
+        for i in range(numIter):
+            clipped = valid & (numpy.abs(imageCube - center) < halfWidth)
+            clipWeight = numpy.where(clipped, weightCube, 0.)
+            sumWeight = clipWeight.sum(axis=0)
+            numUsed = clipped.sum(axis=0)
+            hasData = numUsed > 0
+            mean = (clipWeight*numpy.where(clipped, imageCube, 0.)).sum(axis=0)/sumWeight
+            resid = numpy.where(clipped, imageCube - mean, 0.)
+            var = (clipWeight*resid**2).sum(axis=0)/sumWeight*numUsed/(numUsed - 1)
+            center = numpy.where(hasData, mean, center)
+            halfWidth = numpy.where(hasData & (numUsed > 1), numSigmaClip*numpy.sqrt(var), halfWidth)
+            use = numpy.where(hasData, clipped, use)
+        useWeight = numpy.where(use, weightCube, 0.)
+        sumWeight = useWeight.sum(axis=0)
+        variance = (useWeight**2*numpy.where(use, varianceCube, 0.)).sum(axis=0)/sumWeight**2
+    return center.astype(numpy.float32), mask, variance.astype(numpy.float32), good
+
+
+def _nanReduce(func, data, good, shape=()):
+    """Apply func(data, axis=0) only to the columns of data where good, NaN elsewhere"""
+    result = numpy.full(shape + good.shape, numpy.nan, dtype=numpy.float64)
+    if good.any():
+        result[..., good] = func(data[:, good], axis=0)
+    return result
+
+
+def stackMaskedImages(miList, method="MEANCLIP", numSigmaClip=3., numIter=3, andMask=0,
+                      noGoodPixelsMask=None, weights=None, rowsPerChunk=64):
+    """Stack masked images with numpy, as afwMath.statisticsStack does
+
+    The variance planes are those given by statisticsStack when its StatisticsControl has
+    calcErrorFromInputVariance set.
+
+    The images are stacked a chunk of rows at a time so that the working cube of each chunk
+    stays small enough to be cache friendly.
+
+    @param[in] miList  list of masked images with the same bbox
+    @param[in] method  "MEANCLIP" or "MEDIAN"
+    @param[in] numSigmaClip  clipping threshold in standard deviations
+    @param[in] numIter  number of clipping iterations
+    @param[in] andMask  pixels with any of these mask bits set are ignored
+    @param[in] noGoodPixelsMask  mask bits set where no pixel could be used; default NO_DATA
+    @param[in] weights  weight of each masked image in the clipped mean, or None for equal weights
+    @param[in] rowsPerChunk  number of rows stacked at a time
+    @return the stacked masked image; pixels where no pixel could be used are NaN
+    """
+    if not miList:
+        raise RuntimeError("No masked images to stack")
+    bbox = miList[0].getBBox()
+    for mi in miList[1:]:
+        if mi.getBBox() != bbox:
+            raise RuntimeError("Masked image bbox %s does not match %s" % (mi.getBBox(), bbox))
+    if noGoodPixelsMask is None:
+        noGoodPixelsMask = afwImage.Mask.getPlaneBitMask("NO_DATA")
+    combined = afwImage.MaskedImageF(bbox)
+    outImage = combined.getImage().getArray()
+    outMask = combined.getMask().getArray()
+    outVariance = combined.getVariance().getArray()
+    imageList = [mi.getImage().getArray() for mi in miList]
+    maskList = [mi.getMask().getArray() for mi in miList]
+    varianceList = [mi.getVariance().getArray() for mi in miList]
+    for y0 in range(0, bbox.getHeight(), rowsPerChunk):
+        rows = slice(y0, min(y0 + rowsPerChunk, bbox.getHeight()))
+        image, mask, variance, good = stackCube(
+            numpy.stack([arr[rows] for arr in imageList]),
+            numpy.stack([arr[rows] for arr in maskList]),
+            numpy.stack([arr[rows] for arr in varianceList]),
+            method=method, numSigmaClip=numSigmaClip, numIter=numIter, andMask=andMask, weights=weights,
+        )
+        outImage[rows] = numpy.where(good, image, numpy.nan)
+        outMask[rows] = numpy.where(good, mask, mask | noGoodPixelsMask)
+        outVariance[rows] = numpy.where(good, variance, numpy.nan)
+    return combined
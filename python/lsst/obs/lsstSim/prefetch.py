@@ -0,0 +1,130 @@
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010, 2011, 2012, 2013 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+import collections
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+__all__ = ["PrefetchIterator"]
+
+
+class PrefetchIterator:
+    """Iterate over the results of a read function, reading ahead on background threads
+
+    While the caller works on one result, up to depth of the following reads run on a pool of
+    threads, so that the time spent reading (and decompressing, which in cfitsio and zlib
+    releases the GIL) overlaps with the caller's computation.  Results are returned in order;
+    an exception raised by a read is re-raised when its result is reached.
+
+    The time the reads took and the time the caller spent waiting for them are recorded, so
+    the I/O time hidden by prefetching is readTime - waitTime.
+
+    @param[in] readFunc  function taking an item and returning the data read for it
+    @param[in] itemList  items to read; it is iterated on the caller's thread, as results are taken,
+        so a generator may do work that is not thread safe (such as butler location lookups)
+        to make each item
+    @param[in] depth  number of reads to keep in flight ahead of the caller; if 0 each item is
+        read synchronously when it is requested
+    @param[in] numThreads  number of reading threads; None for depth threads
+    """
+
+    def __init__(self, readFunc, itemList, depth=2, numThreads=None):
+        if depth < 0:
+            raise RuntimeError("depth=%s must not be negative" % (depth,))
+        self.readFunc = readFunc
+        self.depth = depth
+        self.readTime = 0.
+        self.waitTime = 0.
+        self._items = iter(itemList)
+        self._pending = collections.deque()
+        self._lock = threading.Lock()
+        self._pool = None
+        if depth > 0:
+            self._pool = ThreadPoolExecutor(max_workers=numThreads or depth)
+
+    @property
+    def hiddenTime(self):
+        """Time spent reading that the caller did not have to wait for (sec)"""
+        return max(0., self.readTime - self.waitTime)
+
+    def _timedRead(self, item):
+        t0 = time.time()
+        try:
+            return self.readFunc(item)
+        finally:
+            elapsed = time.time() - t0
+            with self._lock:
+                self.readTime += elapsed
+
+    def _fill(self):
+        while len(self._pending) < self.depth:
+            try:
+                item = next(self._items)
+            except StopIteration:
+                return
+            self._pending.append(self._pool.submit(self._timedRead, item))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        t0 = time.time()
+        try:
+            if self._pool is None:
+                return self._timedRead(next(self._items))
+            self._fill()
+            if not self._pending:
+                self.close()
+                raise StopIteration
+            future = self._pending.popleft()
+            self._fill()
+            return future.result()
+        finally:
+            self.waitTime += time.time() - t0
+
+    def take(self, num):
+        """Return a list of the next num results, or fewer if the items run out"""
+        resultList = []
+        if num <= 0:
+            return resultList
+        for result in self:
+            resultList.append(result)
+            if len(resultList) >= num:
+                break
+        return resultList
+
+    def close(self):
+        """Cancel outstanding reads and shut down the threads; no further items are read
+        """
+        self._items = iter(())
+        for future in self._pending:
+            future.cancel()
+        self._pending.clear()
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -19,16 +19,27 @@
 # the GNU General Public License along with this program.  If not,
 # see <http://www.lsstcorp.org/LegalNotices/>.
 #
+import functools
+import multiprocessing
+import os
+import pickle
+import shutil
+import tempfile
+
 import lsst.afw.image as afwImage
 import lsst.afw.math as afwMath
-import lsst.geom as geom
-import lsst.meas.algorithms as measAlg
 import lsst.pex.config as pexConfig
 import lsst.pipe.base as pipeBase
 from lsst.ip.isr import IsrTask
 from lsst.ip.isr import isr
-
-import numpy
+from .ampParallel import AmpStageExecutor, maskSaturated, subtractBias, setVarianceFromImage
+from .calibStack import OutOfCoreStacker
+from .defectCache import StencilCache, interpolateDefectsWithStencil
+from .defectUtils import DefectBoxArray, DefectGridIndex
+from .flatNorm import FlatStatsTable, flatNormKey, combineAmpStats
+from .numpyStack import stackMaskedImages
+from .prefetch import PrefetchIterator
+from .sharedExposure import SharedExposure
 
 __all__ = ["ProcessCalibLsstSimTask"]
 
@@ -42,10 +53,118 @@ class ProcessCalibLsstSimConfig(IsrTask.ConfigClass):
                                  allowed={'bias': "make master bias(zero)",
                                           'dark': "make master dark",
                                           'flat': "make master flat"})
+    numAmpThreads = pexConfig.Field(dtype=int, default=1,
+                                    doc="Number of threads over which the input frames of an amp are "
+                                        "corrected. If more than 1, saturation detection, bias subtraction "
+                                        "and variance are computed with numpy kernels that release the GIL.")
+    doOutOfCoreStack = pexConfig.Field(dtype=bool, default=False,
+                                       doc="Stack the visits of each amp from memory-mapped temporary files, "
+                                           "a block of rows at a time, so that memory does not grow with "
+                                           "the number of visits?")
+    stackStatistic = pexConfig.ChoiceField(dtype=str, default='MEANCLIP',
+                                           doc="Statistic with which the frames of each amp are stacked into "
+                                               "the master frame",
+                                           allowed={'MEANCLIP': "sigma-clipped mean",
+                                                    'MEDIAN': "median"})
+    stackMemoryLimit = pexConfig.Field(dtype=int, default=256,
+                                       doc="Memory (MiB) for the input pixels of one block of rows if "
+                                           "doOutOfCoreStack is true")
+    stackTmpDir = pexConfig.Field(dtype=str, default=None, optional=True,
+                                  doc="Directory for temporary files (out-of-core stacks, and unnormalized "
+                                      "flats if numProcesses != 1); None for the system default")
+    doSinglePassStack = pexConfig.Field(dtype=bool, default=False,
+                                        doc="Stack all the snaps of all the visits of an amp at once, each "
+                                            "weighted by the inverse of its mean variance, instead of "
+                                            "combining the snaps of each visit and then the visits? "
+                                            "The snaps are always stacked out of core (as for "
+                                            "doOutOfCoreStack), since there are twice as many of them.")
+    combineEngine = pexConfig.ChoiceField(dtype=str, default='afw', doc="Implementation used to stack frames",
+                                          allowed={'afw': "afwMath.statisticsStack",
+                                                   'numpy': "vectorized numpy stacker (numpyStack module)"})
+    combineRowsPerChunk = pexConfig.Field(dtype=int, default=64,
+                                          doc="Number of rows stacked at a time if combineEngine is 'numpy'")
+    prefetchDepth = pexConfig.Field(dtype=int, default=0,
+                                    doc="Number of visits whose raw snaps (and bias) are read on background "
+                                        "threads ahead of the visits being corrected; 0 to read "
+                                        "synchronously")
+    defectInterpolation = pexConfig.ChoiceField(dtype=str, default='afw',
+                                                doc="Algorithm with which defects of the master frames are "
+                                                    "interpolated",
+                                                allowed={'afw': "isrFunctions.interpolateDefectList",
+                                                         'stencil': "linear interpolation along rows by a "
+                                                                    "cached sparse operator (see "
+                                                                    "defectCache); a different algorithm "
+                                                                    "from 'afw', which fits a Gaussian PSF, "
+                                                                    "so the results are not the same"})
+    defectStencilCacheDir = pexConfig.Field(dtype=str, default=None, optional=True,
+                                            doc="Directory in which interpolation stencils are cached if "
+                                                "defectInterpolation is 'stencil'; None for memory only")
+    numProcesses = pexConfig.Field(dtype=int, default=1,
+                                   doc="Number of worker processes over which the amps are scheduled; "
+                                       "0 means one per core. If not 1 the master frames are written by "
+                                       "the workers and not returned, so doWrite must be true.")
+
+    flatNormLevel = pexConfig.ChoiceField(dtype=str, default='sensor',
+                                          doc="Group of amps whose flats are normalized to unit mean "
+                                              "together",
+                                          allowed={'sensor': "each sensor, as it is processed",
+                                                   'raft': "each raft, once all its sensors are staged",
+                                                   'focalPlane': "all amps, once all sensors are staged"})
+    flatNormWeighting = pexConfig.ChoiceField(dtype=str, default='amp',
+                                              doc="Weighting of the clipped amp means in the normalization "
+                                                  "of a group of amps",
+                                              allowed={'amp': "mean of the amp means",
+                                                       'pixel': "mean of the amp means weighted by their "
+                                                                "numbers of unclipped pixels"})
+    flatStageDir = pexConfig.Field(dtype=str, default=None, optional=True,
+                                   doc="Directory in which unnormalized flats (as memory-mapped pixel files) "
+                                       "and their statistics table are staged until they are normalized; "
+                                       "required unless flatNormLevel is 'sensor'")
 
     def __init__(self, *args, **kwargs):
         pexConfig.Config.__init__(self, *args, **kwargs)
 
+    def validate(self):
+        IsrTask.ConfigClass.validate(self)
+        if self.numProcesses != 1 and not self.doWrite:
+            raise ValueError("numProcesses=%s requires doWrite" % (self.numProcesses,))
+        if self.flatNormLevel != 'sensor' and (self.flatStageDir is None or not self.doWrite):
+            raise ValueError("flatNormLevel=%s requires flatStageDir and doWrite" % (self.flatNormLevel,))
+        if self.doSinglePassStack and self.stackStatistic != 'MEANCLIP':
+            raise ValueError("doSinglePassStack weights the frames, which requires stackStatistic MEANCLIP")
+
+
+# State shared with the worker processes.  It is set before the pool is created so that
+# forked workers inherit the task and data references instead of unpickling them.
+_poolState = {}
+
+
+def _processAmp(index):
+    """Make and persist the master frame of one amp
+
+    Flats can only be normalized once the statistics of all the amps are known, so they are
+    staged unnormalized in _poolState["stageDir"], to be written by _writeStagedFlat.
+
+    @param[in] index  index of the amp in _poolState["ampList"]
+    """
+    task = _poolState["task"]
+    amp = _poolState["ampList"][index]
+    calibType = _poolState["calibType"]
+    exp = task.processAmp(amp, _poolState["sensorRefList"], calibType)
+    if calibType != 'flat':
+        task.log.info("Writing %s %s", calibType, amp.dataId)
+        amp.butlerSubset.butler.put(exp, calibType, dataId=amp.dataId)
+    else:
+        task.stageFlat(exp, amp.dataId, _poolState["stageDir"])
+
+
+def _writeStagedFlat(args):
+    """Normalize and persist one flat staged by ProcessCalibLsstSimTask.stageFlat
+
+    @param[in] args  (path of the staged flat, amp dataId, normalization)
+    """
+    _poolState["task"].writeFlat(_poolState["butler"], *args)
+
 
 class ProcessCalibLsstSimTask(IsrTask):
     ConfigClass = ProcessCalibLsstSimConfig
@@ -56,9 +175,20 @@ class ProcessCalibLsstSimTask(IsrTask):
         self.statsCtrl = afwMath.StatisticsControl()
         self.statsCtrl.setNumSigmaClip(self.config.sigmaClip)
         self.statsCtrl.setNumIter(self.config.clipIter)
+        self.weightedStatsCtrl = afwMath.StatisticsControl()
+        self.weightedStatsCtrl.setNumSigmaClip(self.config.sigmaClip)
+        self.weightedStatsCtrl.setNumIter(self.config.clipIter)
+        self.weightedStatsCtrl.setWeighted(True)
+        # the variance of a master frame is that of the mean of its inputs, as the numpy engine
+        # computes it, rather than an estimate from the scatter of the few frames stacked
+        for statsCtrl in (self.statsCtrl, self.weightedStatsCtrl):
+            statsCtrl.setCalcErrorFromInputVariance(True)
         # Not sure how to do this.
         # self.statsCtrl.setAndMask('BAD')
         self.isr = isr
+        self.ampStageExecutor = AmpStageExecutor(self.config.numAmpThreads)
+        self._defectIndexCache = {}
+        self.stencilCache = StencilCache(self.config.defectStencilCacheDir)
 
     @pipeBase.timeMethod
     def runDataRef(self, sensorRefList, calibType):
@@ -68,80 +198,351 @@ class ProcessCalibLsstSimTask(IsrTask):
         @return pipe_base Struct containing these fields:
         - masterExpList: amp exposures of master calibration products
         """
-        referenceAmps = sensorRefList[0].subItems(level="channel")
+        referenceAmps = [amp for amp in sensorRefList[0].subItems(level="channel") if amp.dataId['snap'] != 1]
+        if calibType == 'flat' and self.config.flatNormLevel != 'sensor' and self.config.numProcesses == 1:
+            # normalized and written by writeStagedFlats once all the sensors have been staged
+            for amp in referenceAmps:
+                self.stageFlat(self.processAmp(amp, sensorRefList, calibType), amp.dataId,
+                               self.config.flatStageDir)
+            return pipeBase.Struct(
+                masterFrameList=[],
+            )
+        if self.config.numProcesses != 1:
+            self.runAmpPool(referenceAmps, sensorRefList, calibType)
+            return pipeBase.Struct(
+                masterFrameList=[],
+            )
         masterExpList = []
         dataIdList = []
-        expmeta = None
+        statsList = []
         for amp in referenceAmps:
-            if amp.dataId['snap'] == 1:
-                continue
-            self.log.info("Amp: Processing %s", amp.dataId)
-            print("dataid %s" % (amp.dataId))
-            butler = amp.butlerSubset.butler
-            ampMIList = []
-            for sRef in sensorRefList:
-                self.log.info("Sensor: Processing %s", sRef.dataId)
-                ampSnapMIList = []
-                dataId = eval(amp.dataId.__repr__())
-                dataId['visit'] = sRef.dataId['visit']
-                for snap in (0, 1):
-                    dataId['snap'] = snap
-                    ampExposure = sRef.butlerSubset.butler.get('raw', dataId)
-                    if expmeta is None:
-                        expmeta = ampExposure.getMetadata()
-                        expfilter = ampExposure.getFilter()
-                        expPhotoCalib = ampExposure.getPhotoCalib()
-                    ampDetector = ampExposure.getDetector()
-
-                    ampExposure = self.convertIntToFloat(ampExposure)
-                    ampExpDataView = ampExposure.Factory(ampExposure, ampDetector.getDiskDataSec())
-
-                    self.saturationDetection(ampExposure, ampDetector)
-
-                    self.overscanCorrection(ampExposure, ampDetector)
-                    if calibType in ('flat', 'dark'):
-                        self.biasCorrection(ampExpDataView, amp)
-
-                    if False:
-                        self.darkCorrection(ampExpDataView, amp)
-
-                    self.updateVariance(ampExpDataView, ampDetector)
-                    ampSnapMIList.append(ampExpDataView.getMaskedImage())
-                ampMIList.append(self.combineMIList(ampSnapMIList))
-            masterFrame = self.combineMIList(ampMIList)
-            # Fix saturation too???
-            self.fixDefectsAndSat(masterFrame, ampDetector)
-            exp = afwImage.ExposureF(masterFrame)
-            self.copyMetadata(exp, expmeta, calibType)
-            exp.setDetector(ampDetector)
-            exp.setWcs(None)
-            exp.setPhotoCalib(expPhotoCalib)
-            if calibType == 'flat':
-                exp.setFilter(expfilter)
+            exp = self.processAmp(amp, sensorRefList, calibType)
             if self.config.doWrite and calibType != 'flat':
-                print("writing file %s" % dataId)
-                butler.put(exp, calibType, dataId=amp.dataId)
+                self.log.info("Writing %s %s", calibType, amp.dataId)
+                amp.butlerSubset.butler.put(exp, calibType, dataId=amp.dataId)
+            if calibType == 'flat':
+                statsList.append(self.ampStats(exp))
             masterExpList.append(exp)
             dataIdList.append(amp.dataId)
         if self.config.doWrite and calibType == 'flat':
-            self.normChipAmps(masterExpList)
+            norm = combineAmpStats(statsList, self.config.flatNormWeighting)
+            butler = referenceAmps[0].butlerSubset.butler
             for exp, dataId in zip(masterExpList, dataIdList):
-                print("writing flat file %s" % dataId)
-                butler.put(exp, calibType, dataId)
+                self.writeFlat(butler, exp, dataId, norm)
         return pipeBase.Struct(
             masterFrameList=masterExpList,
         )
 
-    def normChipAmps(self, exposureList):
-        means = []
-        for exp in exposureList:
-            means.append(afwMath.makeStatistics(exp.getMaskedImage(),
-                                                afwMath.MEANCLIP, self.statsCtrl).getValue())
-        means = numpy.asarray(means)
-        mean = means.mean()
-        for exp in exposureList:
-            mi = exp.getMaskedImage()
-            mi /= mean
+    def runAmpPool(self, ampList, sensorRefList, calibType):
+        """Make and persist the master frames of the amps over a pool of worker processes
+
+        Each worker reads, corrects and stacks the frames of one amp and writes the result.
+        Flats are staged with their statistics; unless they are normalized over a raft or the
+        focal plane later, a second pass over the pool normalizes and writes them.
+
+        @param[in] ampList  channel-level data references of the amps to process
+        @param[in] sensorRefList  sensor-level data references of the input visits
+        @param[in] calibType  type of master calibration: 'bias', 'dark' or 'flat'
+        """
+        numProcesses = self.config.numProcesses or multiprocessing.cpu_count()
+        numProcesses = min(numProcesses, len(ampList))
+        normalizeNow = self.config.flatNormLevel == 'sensor'
+        if normalizeNow:
+            stageDir = tempfile.mkdtemp(prefix="processCalib-", dir=self.config.stackTmpDir)
+        else:
+            stageDir = self.config.flatStageDir
+        _poolState.update(task=self, ampList=ampList, sensorRefList=sensorRefList, calibType=calibType,
+                          stageDir=stageDir, butler=ampList[0].butlerSubset.butler)
+        try:
+            pool = multiprocessing.get_context("fork").Pool(processes=numProcesses)
+            try:
+                pool.map(_processAmp, range(len(ampList)), chunksize=1)
+                if calibType == 'flat' and normalizeNow:
+                    self.writeStagedFlats(_poolState["butler"], stageDir, 'sensor', pool=pool)
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            _poolState.clear()
+            if normalizeNow:
+                shutil.rmtree(stageDir, ignore_errors=True)
+
+    def stageFlat(self, exposure, dataId, stageDir):
+        """Stage an unnormalized amp flat, recording its statistics for the normalization
+
+        The pixels are copied into a SharedExposure pixel file, so that writeFlat maps them and
+        divides them in place rather than reading the flat back from FITS; the path recorded in
+        the statistics table is that of the pickled SharedExposure handle.
+
+        @param[in] exposure  unnormalized master flat of the amp
+        @param[in] dataId  amp dataId
+        @param[in] stageDir  directory for the staged flat and the statistics table
+        """
+        stats = self.ampStats(exposure)
+        path = os.path.join(stageDir, "flat_%s.pickle" %
+                            "_".join("%s%s" % (k, dataId[k]) for k in sorted(dataId)).replace(",", ""))
+        if os.path.exists(path):
+            # restaging the amp: the previous pixel file would otherwise be left behind
+            self.loadStagedFlat(path).unlink()
+        shared = SharedExposure.fromExposure(exposure, shmDir=stageDir)
+        with open(path, "wb") as handleFile:
+            pickle.dump(shared, handleFile)
+        FlatStatsTable(os.path.join(stageDir, "flatStats.sqlite3")).add(dataId, stats[0], stats[1], path)
+
+    def loadStagedFlat(self, path):
+        """Return the SharedExposure of a flat staged by stageFlat
+
+        @param[in] path  path of the pickled SharedExposure handle
+        """
+        with open(path, "rb") as handleFile:
+            return pickle.load(handleFile)
+
+    def writeStagedFlats(self, butler, stageDir, level, numProcesses=1, pool=None):
+        """Normalize and write all the flats staged in a directory
+
+        The normalization of each group of amps is computed from the statistics table alone;
+        each flat is divided by it as it is written.
+
+        @param[in] butler  butler with which to write the flats
+        @param[in] stageDir  directory of the staged flats and statistics table
+        @param[in] level  group of amps normalized together: 'sensor', 'raft' or 'focalPlane'
+        @param[in] numProcesses  number of processes over which to write the flats if pool is None
+        @param[in] pool  multiprocessing pool whose workers have _poolState["task"] and
+            _poolState["butler"] set, or None
+        """
+        table = FlatStatsTable(os.path.join(stageDir, "flatStats.sqlite3"))
+        normDict = table.computeNormalization(level, self.config.flatNormWeighting)
+        for key, norm in sorted(normDict.items()):
+            self.log.info("Normalizing flats of %s by %g", key or "the focal plane", norm)
+        argsList = [(row.path, row.dataId, normDict[flatNormKey(row.dataId, level)])
+                    for row in table.getRows()]
+        if pool is not None:
+            pool.map(_writeStagedFlat, argsList, chunksize=1)
+        elif numProcesses != 1 and len(argsList) > 1:
+            _poolState.update(task=self, butler=butler)
+            try:
+                with multiprocessing.get_context("fork").Pool(processes=numProcesses or None) as writePool:
+                    writePool.map(_writeStagedFlat, argsList, chunksize=1)
+            finally:
+                _poolState.clear()
+        else:
+            for args in argsList:
+                self.writeFlat(butler, *args)
+        for path, dataId, norm in argsList:
+            table.remove(dataId)
+
+    def processAmp(self, amp, sensorRefList, calibType):
+        """Read, correct and stack the frames of one amp
+
+        @param[in] amp  channel-level data reference of the amp (snap 0)
+        @param[in] sensorRefList  sensor-level data references of the input visits
+        @param[in] calibType  type of master calibration: 'bias', 'dark' or 'flat'
+        @return master frame exposure of the amp; flats are not normalized
+        """
+        self.log.info("Amp: Processing %s", amp.dataId)
+        expmeta = None
+        ampMIList = []
+        weightList = []
+        stacker = None
+        if self.config.doOutOfCoreStack or self.config.doSinglePassStack:
+            stacker = OutOfCoreStacker(maxBlockBytes=self.config.stackMemoryLimit*2**20,
+                                       tmpDir=self.config.stackTmpDir)
+        # just enough visits are corrected together to give each thread a snap, so that only
+        # a few raw frames are held besides the stack
+        visitsPerBatch = max(1, (self.config.numAmpThreads + 1)//2)
+        visitIdList = []
+        for sRef in sensorRefList:
+            snapIdList = []
+            for snap in (0, 1):
+                dataId = eval(amp.dataId.__repr__())
+                dataId['visit'] = sRef.dataId['visit']
+                dataId['snap'] = snap
+                snapIdList.append(dataId)
+            visitIdList.append((sRef, snapIdList))
+        # the butler is not thread safe, so the frames are located on this thread as the reader
+        # asks for them, and only read on the prefetching threads
+        reader = PrefetchIterator(self.readVisitFrames, self.locateVisitFrames(visitIdList, calibType),
+                                  depth=self.config.prefetchDepth)
+        try:
+            for batchStart in range(0, len(sensorRefList), visitsPerBatch):
+                ampDataList = []
+                for visitFrames in reader.take(visitsPerBatch):
+                    self.log.info("Sensor: Processing %s", visitFrames.sensorRef.dataId)
+                    for ampExposure in visitFrames.exposureList:
+                        if expmeta is None:
+                            expmeta = ampExposure.getMetadata()
+                            expfilter = ampExposure.getFilter()
+                            expPhotoCalib = ampExposure.getPhotoCalib()
+                        ampDetector = ampExposure.getDetector()
+                        ampDataList.append(pipeBase.Struct(
+                            exposure=self.convertIntToFloat(ampExposure),
+                            detector=ampDetector,
+                            bias=visitFrames.bias,
+                        ))
+                # the snaps of a batch of visits are corrected concurrently; unless doSinglePassStack
+                # they are then combined visit by visit
+                ampSnapMIList = self.ampStageExecutor.map(self.correctAmpExposure, ampDataList)
+                del ampDataList
+                if self.config.doSinglePassStack:
+                    frameMIList = ampSnapMIList
+                    weightList.extend(self.frameWeight(mi) for mi in frameMIList)
+                else:
+                    frameMIList = [self.combineMIList(ampSnapMIList[i:i + 2])
+                                   for i in range(0, len(ampSnapMIList), 2)]
+                del ampSnapMIList
+                for frameMI in frameMIList:
+                    if stacker is not None:
+                        stacker.add(frameMI)
+                    else:
+                        ampMIList.append(frameMI)
+                del frameMIList
+            weights = weightList if self.config.doSinglePassStack else None
+            masterFrame = self.stackMasterFrame(stacker if stacker is not None else ampMIList,
+                                                weights=weights)
+        finally:
+            reader.close()
+            if stacker is not None:
+                stacker.close()
+        self.reportPrefetch(amp.dataId, reader)
+        # Fix saturation too???
+        self.fixDefectsAndSat(masterFrame, ampDetector)
+        exp = afwImage.ExposureF(masterFrame)
+        self.copyMetadata(exp, expmeta, calibType)
+        exp.setDetector(ampDetector)
+        exp.setWcs(None)
+        exp.setPhotoCalib(expPhotoCalib)
+        if calibType == 'flat':
+            exp.setFilter(expfilter)
+        return exp
+
+    def locateVisitFrames(self, visitIdList, calibType):
+        """Locate the raw amp exposures of the snaps of each visit, and the bias with which to correct them
+
+        A generator, run on the calling thread: all the butler and registry lookups are done here,
+        returning deferred reads for readVisitFrames.  The filter is looked up once per visit and
+        put in the dataIds, so that standardizing the raws does not query the registry.
+
+        @param[in] visitIdList  list of (sensor-level data reference, list of the amp dataIds of
+            the snaps)
+        @param[in] calibType  type of master calibration: 'bias', 'dark' or 'flat'
+        @return for each visit, pipeBase.Struct with fields sensorRef, rawProxyList (in snap order)
+            and biasProxy (None for biases)
+        """
+        for sRef, snapIdList in visitIdList:
+            butler = sRef.butlerSubset.butler
+            biasProxy = None
+            if calibType in ('flat', 'dark'):
+                biasProxy = butler.get('bias', snapIdList[0], immediate=False)
+            rawIdList = [dict(dataId) for dataId in snapIdList]
+            if 'filter' not in rawIdList[0]:
+                filterName = butler.queryMetadata('raw', 'filter', rawIdList[0])[0]
+                for dataId in rawIdList:
+                    dataId['filter'] = filterName
+            yield pipeBase.Struct(
+                sensorRef=sRef,
+                rawProxyList=[butler.get('raw', dataId, immediate=False) for dataId in rawIdList],
+                biasProxy=biasProxy,
+            )
+
+    def readVisitFrames(self, visitLocation):
+        """Read the raw amp exposures of the snaps of one visit, and its bias
+
+        Called from the prefetching threads; only the files are read and the exposures
+        standardized, the butler lookups having been done by locateVisitFrames.  The bias is read
+        once for all the snaps.
+
+        @param[in] visitLocation  one of the results of locateVisitFrames
+        @return pipeBase.Struct with fields sensorRef, exposureList (raws, in snap order) and
+            bias (None for biases)
+        """
+        bias = None
+        if visitLocation.biasProxy is not None:
+            bias = visitLocation.biasProxy.__subject__
+        return pipeBase.Struct(
+            sensorRef=visitLocation.sensorRef,
+            exposureList=[proxy.__subject__ for proxy in visitLocation.rawProxyList],
+            bias=bias,
+        )
+
+    def reportPrefetch(self, dataId, reader):
+        """Log and accumulate in the metadata the time spent reading the inputs of an amp
+
+        @param[in] dataId  dataId of the amp
+        @param[in] reader  PrefetchIterator that read the inputs
+        """
+        self.log.info("Amp %s: %.2f s reading, %.2f s waiting for reads, %.2f s hidden by prefetching",
+                      dataId, reader.readTime, reader.waitTime, reader.hiddenTime)
+        for key, value in (("prefetchReadTime", reader.readTime), ("prefetchWaitTime", reader.waitTime),
+                           ("prefetchHiddenTime", reader.hiddenTime)):
+            if self.metadata.exists(key):
+                value += self.metadata.getScalar(key)
+            self.metadata.set(key, value)
+
+    def writeFlat(self, butler, flat, dataId, norm):
+        """Divide an amp flat by its normalization and write it
+
+        @param[in] butler  butler with which to write the flat
+        @param[in,out] flat  unnormalized flat exposure, or the path of one staged by stageFlat, which
+            is divided in its memory map and removed
+        @param[in] dataId  amp dataId
+        @param[in] norm  normalization
+        """
+        shared = None
+        if isinstance(flat, str):
+            path = flat
+            shared = self.loadStagedFlat(path)
+            flat = shared.getExposure()
+        mi = flat.getMaskedImage()
+        mi /= norm
+        self.log.info("Writing flat %s", dataId)
+        butler.put(flat, 'flat', dataId)
+        if shared is not None:
+            del flat, mi
+            shared.unlink()
+            os.remove(path)
+
+    def correctAmpExposure(self, ampData):
+        """Correct one amp exposure for saturation, overscan, bias and variance
+
+        Safe to call from several threads at once for different exposures.
+
+        @param[in,out] ampData  pipeBase.Struct with fields:
+        - exposure: raw amp exposure, converted to float; corrected in place
+        - detector: amp detector
+        - bias: bias exposure, or None to skip bias correction
+        @return the corrected MaskedImage of the data section
+        """
+        ampExposure = ampData.exposure
+        ampDetector = ampData.detector
+        useKernels = self.ampStageExecutor.numThreads > 1
+        ampExpDataView = ampExposure.Factory(ampExposure, ampDetector.getDiskDataSec())
+
+        if useKernels:
+            mi = ampExposure.getMaskedImage()
+            maskSaturated(mi, ampDetector.getSaturation(),
+                          mi.getMask().getPlaneBitMask(self.config.saturatedMaskName))
+        else:
+            self.saturationDetection(ampExposure, ampDetector)
+
+        self.overscanCorrection(ampExposure, ampDetector)
+        if ampData.bias is not None:
+            if useKernels:
+                subtractBias(ampExpDataView.getMaskedImage(), ampData.bias.getMaskedImage())
+            else:
+                self.biasCorrection(ampExpDataView, ampData.bias)
+
+        if useKernels:
+            setVarianceFromImage(ampExpDataView.getMaskedImage(), ampDetector.getGain(),
+                                 ampDetector.getReadNoise())
+        else:
+            self.updateVariance(ampExpDataView, ampDetector)
+        return ampExpDataView.getMaskedImage()
+
+    def ampStats(self, exposure):
+        """Return the (clipped mean, number of pixels) of an amp master frame, used to normalize flats"""
+        stats = afwMath.makeStatistics(exposure.getMaskedImage(), afwMath.MEANCLIP | afwMath.NPOINT,
+                                       self.statsCtrl)
+        return stats.getValue(afwMath.MEANCLIP), int(stats.getValue(afwMath.NPOINT))
 
     def copyMetadata(self, exposure, metadata, calibType):
         outmetadata = exposure.getMetadata()
@@ -160,40 +561,79 @@ class ProcessCalibLsstSimTask(IsrTask):
         x = dataBbox.getMinY()
         height = dataBbox.getDimensions()[0]
         # When at detector level, there will not be the need to go through the step of getting the parent
-        defectList = detector.getParent().getDefects()
-        dl = self.transposeDefectList(defectList, dataBbox)
-        for d in dl:
-            d.shift(-x, -y)
-            if detector.getId() > 8:
-                d.shift(0, height - 2*d.getBBox().getMinY()-d.getBBox().getHeight())
+        boxes = self.getDefectIndex(detector.getParent()).subset(dataBbox).transposed().shifted(-x, -y)
+        if detector.getId() > 8:
+            boxes = boxes.flippedY(height)
+        dl = boxes.toDefects()
         # Should saturation be interpolated as well?
         # sdl = self.isr.getDefectListFromMask(masterFrame, 'SAT')
         # for d in sdl:
         #     dl.append(d)
         masterFrame = dl.maskPixels(masterFrame, maskName='BAD')
-        self.isr.interpolateDefectList(masterFrame, dl, fwhm)
+        if self.config.defectInterpolation == 'stencil':
+            interpolateDefectsWithStencil(masterFrame, boxes, fwhm, self.stencilCache)
+        else:
+            self.isr.interpolateDefectList(masterFrame, dl, fwhm)
         return masterFrame
 
+    def getDefectIndex(self, ccd):
+        """Return a DefectGridIndex of the defects of a CCD, built on first use
+
+        @param[in] ccd  CCD detector whose defects are indexed
+        """
+        key = ccd.getName()
+        if key not in self._defectIndexCache:
+            self._defectIndexCache[key] = DefectGridIndex(DefectBoxArray.fromDefects(ccd.getDefects()))
+        return self._defectIndexCache[key]
+
     def transposeDefectList(self, defectList, checkBbox=None):
-        retDefectList = measAlg.Defects()
-        for defect in defectList:
-            bbox = defect.getBBox()
-            nbbox = geom.Box2I(geom.Point2I(bbox.getMinY(), bbox.getMinX()),
-                               geom.Extent2I(bbox.getDimensions()[1], bbox.getDimensions()[0]))
-            if checkBbox:
-
-                if checkBbox.overlaps(bbox):
-                    retDefectList.append(measAlg.Defect(nbbox))
-                else:
-                    pass
-            else:
-                retDefectList.append(measAlg.Defect(nbbox))
-        return retDefectList
+        boxes = DefectBoxArray.fromDefects(defectList)
+        if checkBbox:
+            boxes = boxes[boxes.overlaps(checkBbox)]
+        return boxes.transposed().toDefects()
+
+    def frameWeight(self, maskedImage):
+        """Return the weight of a frame in a single-pass stack: the inverse of its clipped mean variance
+        """
+        meanVariance = afwMath.makeStatistics(maskedImage.getVariance(), afwMath.MEANCLIP,
+                                              self.statsCtrl).getValue()
+        return 1.0/meanVariance if meanVariance > 0 else 1.0
+
+    def stackMasterFrame(self, frames, weights=None):
+        """Stack the frames of an amp into its master frame with config.stackStatistic
+
+        @param[in] frames  list of masked images, or an OutOfCoreStacker to which they were added
+        @param[in] weights  weight of each frame in the clipped mean, or None for equal weights
+        @return the stacked masked image
+        """
+        statistic = self.config.stackStatistic
+        if not isinstance(frames, OutOfCoreStacker):
+            return self.combineMIList(frames, method=statistic, weights=weights)
+        stackFunc = None
+        if self.config.combineEngine == 'numpy':
+            stackFunc = functools.partial(self.stackNumpy, method=statistic, weights=weights)
+        elif weights is not None:
+            def stackFunc(miList):
+                return afwMath.statisticsStack(miList, afwMath.MEANCLIP, self.weightedStatsCtrl, weights)
+        return frames.combine(getattr(afwMath, statistic), self.statsCtrl, stackFunc=stackFunc)
+
+    def stackNumpy(self, miList, method='MEANCLIP', weights=None):
+        """Stack masked images with the numpy engine, using the clipping parameters of self.statsCtrl
+        """
+        return stackMaskedImages(miList, method=method, numSigmaClip=self.statsCtrl.getNumSigmaClip(),
+                                 numIter=self.statsCtrl.getNumIter(), andMask=self.statsCtrl.getAndMask(),
+                                 weights=weights, rowsPerChunk=self.config.combineRowsPerChunk)
 
-    def combineMIList(self, miList, method='MEANCLIP'):
+    def combineMIList(self, miList, method='MEANCLIP', weights=None):
+        if self.config.combineEngine == 'numpy':
+            # unlike statisticsStack, failures are not silently replaced by an empty frame
+            return self.stackNumpy(miList, method, weights=weights)
         combinedFrame = miList[0].Factory()
         try:
-            if method == 'MEANCLIP':
+            if method == 'MEANCLIP' and weights is not None:
+                combinedFrame = afwMath.statisticsStack(miList, afwMath.MEANCLIP, self.weightedStatsCtrl,
+                                                        weights)
+            elif method == 'MEANCLIP':
                 combinedFrame = afwMath.statisticsStack(miList, afwMath.MEANCLIP, self.statsCtrl)
             elif method == 'MEDIAN':
                 combinedFrame = afwMath.statisticsStack(miList, afwMath.MEDIAN, self.statsCtrl)
@@ -34,6 +34,27 @@ class ProcessEimageConfig(ProcessCcdTask.ConfigClass):
     """Config for ProcessEimage"""
     rngSeed = Field(dtype=int, default=1234567890, doc="Seed for random number generator")
 
+    @property
+    def doWriteIntermediates(self):
+        """Are any of the products of the stages before calibrate persisted?
+
+        Assigning it sets the write flags of those stages: charImage.doWrite (icSrc),
+        charImage.doWriteExposure (icExp, icExpBackground) and, if the ISR task has one, isr.doWrite
+        (postISRCCD).  If False the products are handed from stage to stage in memory and only those
+        of calibrate (calexp, src, ...) are written.  It is not a field of its own, so the flags it
+        sets are what is persisted, and a flag assigned after it overrides it.
+        """
+        isrWrite = "doWrite" in self.isr.keys() and self.isr.doWrite
+        return bool(isrWrite or self.charImage.doWrite or self.charImage.doWriteExposure)
+
+    @doWriteIntermediates.setter
+    def doWriteIntermediates(self, value):
+        # EimageIsrTask writes nothing, but a retargeted IsrTask would write postISRCCD
+        if "doWrite" in self.isr.keys():
+            self.isr.doWrite = value
+        self.charImage.doWrite = value
+        self.charImage.doWriteExposure = value
+
     def setDefaults(self):
         ProcessCcdTask.ConfigClass.setDefaults(self)
         self.isr.retarget(EimageIsrTask)
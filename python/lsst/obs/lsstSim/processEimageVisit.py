@@ -0,0 +1,327 @@
+#
+# LSST Data Management System
+# Copyright 2008-2016 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+import multiprocessing
+import os
+import time
+
+import lsst.afw.geom as afwGeom
+import lsst.geom as geom
+import lsst.pex.config as pexConfig
+import lsst.pipe.base as pipeBase
+from lsst.pipe.base.argumentParser import ArgumentParser
+from .processEimage import ProcessEimageTask
+
+__all__ = ["ProcessEimageVisitConfig", "ProcessEimageVisitTask", "CachingButler"]
+
+# the stages of ProcessEimageTask whose times are reported
+STAGE_NAMES = ("isr", "charImage", "calibrate")
+
+
+class CachingButler:
+    """A butler proxy that keeps the datasets of some types in memory once they are read
+
+    Everything else is forwarded to the wrapped butler.  Datasets preloaded in a parent
+    process are shared copy-on-write with the processes forked from it.
+
+    @param[in] butler  butler to wrap
+    @param[in] datasetTypes  names of the dataset types to cache
+    """
+
+    def __init__(self, butler, datasetTypes):
+        self.butler = butler
+        self.datasetTypes = set(datasetTypes)
+        self._cache = {}
+
+    @staticmethod
+    def _key(datasetType, dataId, rest):
+        fullId = dict(dataId if dataId is not None else {}, **rest)
+        return (datasetType, tuple(sorted(fullId.items())))
+
+    def get(self, datasetType, dataId=None, immediate=True, **rest):
+        if datasetType not in self.datasetTypes:
+            return self.butler.get(datasetType, dataId, immediate=immediate, **rest)
+        key = self._key(datasetType, dataId, rest)
+        if key not in self._cache:
+            self._cache[key] = self.butler.get(datasetType, dataId, immediate=True, **rest)
+        return self._cache[key]
+
+    def datasetExists(self, datasetType, dataId=None, **rest):
+        if datasetType in self.datasetTypes and self._key(datasetType, dataId, rest) in self._cache:
+            return True
+        return self.butler.datasetExists(datasetType, dataId, **rest)
+
+    def preload(self, datasetType, dataIdList):
+        """Read the existing datasets of one type into the cache
+
+        @return the number of datasets read
+        """
+        numRead = 0
+        for dataId in dataIdList:
+            if self.butler.datasetExists(datasetType, dataId):
+                self.get(datasetType, dataId)
+                numRead += 1
+        return numRead
+
+    def __getattr__(self, name):
+        return getattr(self.butler, name)
+
+
+class ProcessEimageVisitConfig(pexConfig.Config):
+    """Config for ProcessEimageVisitTask"""
+    processEimage = pexConfig.ConfigurableField(
+        target=ProcessEimageTask,
+        doc="CCD-level processing of an eimage",
+    )
+    numProcesses = pexConfig.Field(
+        dtype=int,
+        doc="Number of worker processes over which the CCDs of a visit are scheduled; "
+            "0 means one per core",
+        default=0,
+    )
+    doPreloadRefCats = pexConfig.Field(
+        dtype=bool,
+        doc="Read the reference catalog shards covering the visit once, before the workers are forked?",
+        default=True,
+    )
+    refCatPadding = pexConfig.Field(
+        dtype=float,
+        doc="Padding added to the radius of the visit when choosing the shards to preload (degrees)",
+        default=0.1,
+    )
+
+    def validate(self):
+        pexConfig.Config.validate(self)
+        isrConfig = self.processEimage.isr
+        if self.numProcesses != 1 and "noiseRng" in isrConfig.keys() and isrConfig.doAddNoise and \
+                isrConfig.noiseRng != "stream":
+            raise ValueError("Worker processes forked with numProcesses=%d would share the state of the"
+                             " global random number generator; use processEimage.isr.noiseRng='stream'" %
+                             (self.numProcesses,))
+
+
+class ProcessEimageVisitRunner(pipeBase.ButlerInitializedTaskRunner):
+    """Run ProcessEimageVisitTask once per visit, on the list of the CCD data references of the visit
+    """
+
+    @staticmethod
+    def getTargetList(parsedCmd, **kwargs):
+        visitRefLists = {}
+        for sensorRef in parsedCmd.id.refList:
+            visitRefLists.setdefault(sensorRef.dataId["visit"], []).append(sensorRef)
+        return [(visitRefLists[visit], kwargs) for visit in sorted(visitRefLists)]
+
+
+# State shared with the worker processes.  It is set before the pool is created so that forked
+# workers inherit the task, its configs and the reference catalog shards instead of reading or
+# unpickling them.
+_poolState = {}
+
+
+def _runCcd(index):
+    """Run ProcessEimageTask on one CCD of the visit being processed
+
+    @param[in] index  index of the CCD in _poolState["sensorRefList"]
+    @return (dataId, elapsed time in sec or None if processing failed, dict of stage: CPU time in sec)
+    """
+    task = _poolState["task"]
+    sensorRef = _poolState["sensorRefList"][index]
+    t0 = time.time()
+    try:
+        task.processEimage.runDataRef(sensorRef)
+    except Exception as e:
+        task.log.warn("Failed to process CCD %s: %s", sensorRef.dataId, e)
+        return sensorRef.dataId, None, {}
+    return sensorRef.dataId, time.time() - t0, task.stageCpuTimes()
+
+
+class ProcessEimageVisitTask(pipeBase.CmdLineTask):
+    """Run ProcessEimageTask on all the CCDs of a visit
+
+    The task, with its configs and subtasks, and (if doPreloadRefCats) the reference
+    catalog shards covering the visit are set up once in the parent process; worker processes are
+    then forked and inherit them copy-on-write.  The CCDs are scheduled longest first, using the
+    size of the eimage file as the estimate of the processing time, so that the last CCDs to
+    start are the quick ones.
+
+    The CPU time spent in each stage (isr, charImage, calibrate) is summed over the CCDs of the
+    visit, logged and recorded in the task metadata.
+    """
+    ConfigClass = ProcessEimageVisitConfig
+    RunnerClass = ProcessEimageVisitRunner
+    _DefaultName = "processEimageVisit"
+
+    def __init__(self, butler=None, **kwargs):
+        pipeBase.CmdLineTask.__init__(self, **kwargs)
+        self.makeSubtask("processEimage", butler=butler)
+
+    @classmethod
+    def _makeArgumentParser(cls):
+        """Create an argument parser
+        """
+        parser = ArgumentParser(name=cls._DefaultName)
+        parser.add_id_argument("--id", "eimage", "data ID, e.g. --id visit=85470982 snap=0")
+        return parser
+
+    def _getMetadataName(self):
+        """Do not persist the metadata
+
+        The runner's targets are lists of the CCD data references of a visit, not data references,
+        so TaskRunner has nothing to put the metadata with; the per-CCD metadata is written by
+        ProcessEimageTask, and the visit timings are logged.
+        """
+        return None
+
+    @pipeBase.timeMethod
+    def runDataRef(self, sensorRefList):
+        """Process all the CCDs of a visit
+
+        @param sensorRefList  list of the eimage data references of the CCDs of one visit
+        @return a pipeBase.Struct with fields:
+        - ccdTimeDict: dict of CCD dataId string: elapsed time (sec) or None if processing failed
+        - stageTimeDict: dict of stage name: CPU time (sec) summed over the CCDs
+        """
+        t0 = time.time()
+        butler = sensorRefList[0].getButler()
+        if self.config.doPreloadRefCats:
+            self.preloadRefCats(butler, sensorRefList)
+        setupTime = time.time() - t0
+        sensorRefList = sorted(sensorRefList, key=self.ccdCost, reverse=True)
+        self.log.info("Processing %d CCDs of visit %s", len(sensorRefList), sensorRefList[0].dataId["visit"])
+
+        ccdTimeDict = {}
+        stageTimeDict = {stage: 0. for stage in STAGE_NAMES}
+        numProcesses = self.config.numProcesses or multiprocessing.cpu_count()
+        numProcesses = min(numProcesses, len(sensorRefList))
+        _poolState.update(task=self, sensorRefList=sensorRefList)
+        pool = None
+        try:
+            if numProcesses > 1:
+                pool = multiprocessing.get_context("fork").Pool(processes=numProcesses)
+                # chunksize=1 hands out the CCDs one at a time, in longest-first order
+                resultIter = pool.imap_unordered(_runCcd, range(len(sensorRefList)), chunksize=1)
+            else:
+                resultIter = (_runCcd(index) for index in range(len(sensorRefList)))
+            for dataId, elapsed, stageTimes in resultIter:
+                ccdTimeDict[str(dataId)] = elapsed
+                for stage, cpuTime in stageTimes.items():
+                    stageTimeDict[stage] += cpuTime
+                self.log.info("CCD %s %s; %d/%d CCDs done", dataId,
+                              "failed" if elapsed is None else "took %.1f s" % (elapsed,),
+                              len(ccdTimeDict), len(sensorRefList))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            _poolState.clear()
+
+        self.reportTimes(sensorRefList[0].dataId["visit"], ccdTimeDict, stageTimeDict,
+                         wallTime=time.time() - t0, setupTime=setupTime)
+        return pipeBase.Struct(
+            ccdTimeDict=ccdTimeDict,
+            stageTimeDict=stageTimeDict,
+        )
+
+    @staticmethod
+    def ccdCost(sensorRef):
+        """Return the estimated cost of processing a CCD: the size of its eimage file, or 0 if unknown
+        """
+        try:
+            return os.path.getsize(sensorRef.get("eimage_filename")[0])
+        except Exception:
+            return 0
+
+    def stageCpuTimes(self):
+        """Return a dict of stage name: CPU time (sec) of the last run of each stage of processEimage
+
+        The times are those recorded in the metadata of the stage's runDataRef by pipeBase.timeMethod.
+        """
+        stageTimes = {}
+        for stage in STAGE_NAMES:
+            md = getattr(self.processEimage, stage).metadata
+            if md.exists("runDataRefStartCpuTime") and md.exists("runDataRefEndCpuTime"):
+                endTime = md.getArray("runDataRefEndCpuTime")[-1]
+                stageTimes[stage] = endTime - md.getArray("runDataRefStartCpuTime")[-1]
+        return stageTimes
+
+    def preloadRefCats(self, butler, sensorRefList):
+        """Read the reference catalog shards covering the CCDs of a visit into the loaders' butlers
+
+        The region is the circle about the mean of the corners of the CCDs, as given by the WCS
+        in the eimage headers, that contains all of them, padded by refCatPadding.  Only indexed
+        reference catalog loaders (those with an indexer) are preloaded; they read their shards as
+        "ref_cat" datasets whose dataId names the catalog, so that is what is cached.
+
+        @param[in] butler  data butler
+        @param[in] sensorRefList  list of the eimage data references of the CCDs of one visit
+        """
+        loaderList = []
+        for subtask, name in (("charImage", "refObjLoader"), ("calibrate", "astromRefObjLoader"),
+                              ("calibrate", "photoRefObjLoader")):
+            loader = getattr(getattr(self.processEimage, subtask), name, None)
+            if loader is not None and hasattr(loader, "indexer") and hasattr(loader, "butler"):
+                loaderList.append(loader)
+        if not loaderList:
+            return
+        cornerList = []
+        for sensorRef in sensorRefList:
+            md = sensorRef.get("eimage_md")
+            wcs = afwGeom.makeSkyWcs(md, strip=False)
+            width, height = md.getScalar("NAXIS1"), md.getScalar("NAXIS2")
+            cornerList += [wcs.pixelToSky(x, y) for x in (0, width) for y in (0, height)]
+        center = geom.averageSpherePoint(cornerList)
+        radius = max(center.separation(corner) for corner in cornerList)
+        radius += self.config.refCatPadding*geom.degrees
+        numRead = 0
+        for loader in loaderList:
+            if not isinstance(loader.butler, CachingButler):
+                loader.butler = CachingButler(loader.butler, ["ref_cat"])
+            shardIdList, isOnBoundaryList = loader.indexer.getShardIds(center, radius)
+            numRead += loader.butler.preload(
+                "ref_cat", [loader.indexer.makeDataId(shardId, loader.ref_dataset_name)
+                            for shardId in shardIdList])
+        self.log.info("Preloaded %d reference catalog shards within %.3f deg of %s",
+                      numRead, radius.asDegrees(), center)
+
+    def reportTimes(self, visit, ccdTimeDict, stageTimeDict, wallTime, setupTime):
+        """Log and record the timings for one visit
+
+        @param[in] visit  visit number
+        @param[in] ccdTimeDict  dict of CCD dataId string: elapsed time (sec) or None if failed
+        @param[in] stageTimeDict  dict of stage name: CPU time (sec) summed over the CCDs
+        @param[in] wallTime  wall-clock time for the whole visit (sec)
+        @param[in] setupTime  time taken to preload the reference catalogs (sec)
+        """
+        ccdTimeList = [t for t in ccdTimeDict.values() if t is not None]
+        numCcds = len(ccdTimeList)
+        numFailed = len(ccdTimeDict) - numCcds
+        self.log.info("Visit %s: %d CCDs (%d failed) in %.1f s (%.1f s setup); %.2f CCDs/min; "
+                      "summed CCD time %.1f s; CPU time %s",
+                      visit, numCcds, numFailed, wallTime, setupTime,
+                      60.*numCcds/wallTime if wallTime > 0 else float("nan"), sum(ccdTimeList),
+                      ", ".join("%s %.1f s" % (stage, stageTimeDict[stage]) for stage in STAGE_NAMES))
+        self.metadata.set("numCcds", numCcds)
+        self.metadata.set("numFailedCcds", numFailed)
+        self.metadata.set("visitWallTime", wallTime)
+        self.metadata.set("setupTime", setupTime)
+        self.metadata.set("ccdTime", sum(ccdTimeList))
+        for stage in STAGE_NAMES:
+            self.metadata.set("%sCpuTime" % (stage,), stageTimeDict[stage])
@@ -0,0 +1,175 @@
+#
+# LSST Data Management System
+# Copyright 2008-2016 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+import multiprocessing
+import time
+
+import lsst.pex.config as pexConfig
+import lsst.pipe.base as pipeBase
+from lsst.pipe.base.argumentParser import ArgumentParser
+from .lsstSimIsrTask import LsstSimIsrTask
+
+__all__ = ["LsstSimRaftIsrConfig", "LsstSimRaftIsrTask"]
+
+
+class LsstSimRaftIsrConfig(pexConfig.Config):
+    """Config for LsstSimRaftIsrTask"""
+    isr = pexConfig.ConfigurableField(
+        target=LsstSimIsrTask,
+        doc="Sensor-level instrument signature removal",
+    )
+    numProcesses = pexConfig.Field(
+        dtype=int,
+        doc="Number of worker processes over which the sensors of a raft are scheduled; "
+            "0 means one per core",
+        default=1,
+    )
+
+
+# State shared with the worker processes.  It is set before the pool is created so that
+# forked workers inherit the task, camera and data references instead of unpickling them.
+_poolState = {}
+
+
+def _runSensor(index):
+    """Run sensor-level ISR on one sensor of the raft being processed
+
+    @param[in] index  index of the sensor in _poolState["sensorRefList"]
+    @return (dataId, elapsed time in sec or None if processing failed)
+    """
+    task = _poolState["task"]
+    sensorRef = _poolState["sensorRefList"][index]
+    t0 = time.time()
+    try:
+        exposure = task.isr.runDataRef(sensorRef, camera=_poolState["camera"]).exposure
+        if task.isr.config.doReuseBuffers:
+            # the exposure has been persisted, so its buffers can be used for the next sensor
+            task.isr.recycleExposure(exposure)
+    except Exception as e:
+        task.log.warn("Failed to process sensor %s: %s", sensorRef.dataId, e)
+        return sensorRef.dataId, None
+    return sensorRef.dataId, time.time() - t0
+
+
+class LsstSimRaftIsrTask(pipeBase.CmdLineTask):
+    """Run LsstSimIsrTask on all the sensors of a raft in one process
+
+    The camera is read once per raft and handed to every sensor, and the defects file is parsed
+    once by the mapper, instead of once per sensor as happens when each sensor is run as an
+    independent task invocation.  The sensors (including the A and B halves of the wavefront
+    sensors) can be scheduled over several cores with config.numProcesses; in that case the
+    sensor exposures are only persisted (isr.doWrite), not returned.
+
+    The wall-clock time for the raft, the summed per-sensor time and an estimate of the time
+    nine independent sensor-level runs would have taken are logged and recorded in the task
+    metadata.
+    """
+    ConfigClass = LsstSimRaftIsrConfig
+    _DefaultName = "raftIsr"
+
+    def __init__(self, **kwargs):
+        pipeBase.CmdLineTask.__init__(self, **kwargs)
+        self.makeSubtask("isr")
+
+    @classmethod
+    def _makeArgumentParser(cls):
+        """Create an argument parser
+        """
+        parser = ArgumentParser(name=cls._DefaultName)
+        parser.add_id_argument("--id", "raw", "data ID, e.g. --id visit=85471048 raft=0,3", level="raft")
+        return parser
+
+    @pipeBase.timeMethod
+    def runDataRef(self, raftRef):
+        """Do instrument signature removal on all sensors of a raft
+
+        @param raftRef daf.persistence.butlerSubset.ButlerDataRef of the raft to be processed
+        @return a pipeBase.Struct with fields:
+        - exposureDict: dict of sensor dataId string: post-ISR exposure; empty if numProcesses != 1
+        - sensorTimeDict: dict of sensor dataId string: elapsed time (sec) or None if processing failed
+        """
+        t0 = time.time()
+        camera = raftRef.get("camera")
+        cameraTime = time.time() - t0
+        sensorRefList = list(raftRef.subItems(level="sensor"))
+        self.log.info("Performing ISR on %d sensors of raft %s", len(sensorRefList), raftRef.dataId)
+
+        exposureDict = {}
+        sensorTimeDict = {}
+        numProcesses = self.config.numProcesses or multiprocessing.cpu_count()
+        numProcesses = min(numProcesses, len(sensorRefList))
+        if numProcesses > 1:
+            _poolState.update(task=self, camera=camera, sensorRefList=sensorRefList)
+            try:
+                pool = multiprocessing.get_context("fork").Pool(processes=numProcesses)
+                try:
+                    for dataId, elapsed in pool.imap_unordered(_runSensor, range(len(sensorRefList))):
+                        sensorTimeDict[str(dataId)] = elapsed
+                finally:
+                    pool.close()
+                    pool.join()
+            finally:
+                _poolState.clear()
+        else:
+            for sensorRef in sensorRefList:
+                t1 = time.time()
+                try:
+                    exposure = self.isr.runDataRef(sensorRef, camera=camera).exposure
+                except Exception as e:
+                    self.log.warn("Failed to process sensor %s: %s", sensorRef.dataId, e)
+                    sensorTimeDict[str(sensorRef.dataId)] = None
+                    continue
+                sensorTimeDict[str(sensorRef.dataId)] = time.time() - t1
+                exposureDict[str(sensorRef.dataId)] = exposure
+
+        self.reportThroughput(raftRef, sensorTimeDict, wallTime=time.time() - t0, cameraTime=cameraTime)
+        return pipeBase.Struct(
+            exposureDict=exposureDict,
+            sensorTimeDict=sensorTimeDict,
+        )
+
+    def reportThroughput(self, raftRef, sensorTimeDict, wallTime, cameraTime):
+        """Log and record the throughput for one raft
+
+        The time independent sensor-level runs would have taken is estimated as the summed
+        per-sensor processing time plus one camera load per sensor.
+
+        @param[in] raftRef  raft-level data reference
+        @param[in] sensorTimeDict  dict of sensor dataId string: elapsed time (sec) or None if failed
+        @param[in] wallTime  wall-clock time for the whole raft (sec)
+        @param[in] cameraTime  time taken to load the camera (sec)
+        """
+        sensorTimeList = [t for t in sensorTimeDict.values() if t is not None]
+        numSensors = len(sensorTimeList)
+        numFailed = len(sensorTimeDict) - numSensors
+        sensorTime = sum(sensorTimeList)
+        independentTime = sensorTime + len(sensorTimeDict)*cameraTime
+        speedup = independentTime/wallTime if wallTime > 0 else float("nan")
+        self.log.info("Raft %s: %d sensors (%d failed) in %.1f s; %.2f sensors/s; "
+                      "estimated %.1f s as independent runs (%.2fx)",
+                      raftRef.dataId, numSensors, numFailed, wallTime,
+                      numSensors/wallTime if wallTime > 0 else float("nan"), independentTime, speedup)
+        self.metadata.set("numSensors", numSensors)
+        self.metadata.set("numFailedSensors", numFailed)
+        self.metadata.set("raftWallTime", wallTime)
+        self.metadata.set("sensorTime", sensorTime)
+        self.metadata.set("independentRunTime", independentTime)
+        self.metadata.set("speedup", speedup)
@@ -0,0 +1,125 @@
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010, 2011, 2012, 2013 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+import os
+import tempfile
+
+import lsst.afw.image as afwImage
+import lsst.geom as geom
+import numpy
+
+__all__ = ["SharedExposure"]
+
+
+def _defaultDir():
+    """Return the directory for shared pixel files: /dev/shm if available, so they stay in memory"""
+    return "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+
+class SharedExposure:
+    """An ExposureF whose pixels live in a memory-mapped file, to hand exposures between processes
+
+    The image, mask and variance planes are copied once into a file (by default in /dev/shm, so
+    in memory), and the exposure is rebuilt in another process around memory maps of that
+    file, without copying the pixels or a FITS round trip.  Everything else (WCS, PSF, calibration,
+    detector, visit info, metadata) travels with the pickled handle, as a 1x1 pixel exposure.
+
+    The process that made the handle owns the file and must call unlink once every user is done;
+    handles received by pickling only map it.
+
+    @param[in] path  path of the pixel file
+    @param[in] bbox  bounding box of the exposure
+    @param[in] maskDtype  numpy dtype of the mask pixels
+    @param[in] infoStub  1x1 pixel exposure carrying the ExposureInfo
+    """
+
+    def __init__(self, path, bbox, maskDtype, infoStub):
+        self.path = path
+        self.bbox = bbox
+        self.maskDtype = numpy.dtype(maskDtype)
+        self.infoStub = infoStub
+
+    @classmethod
+    def fromExposure(cls, exposure, shmDir=None):
+        """Copy the pixels of an ExposureF into a new shared file and return its handle
+
+        @param[in] exposure  ExposureF to share
+        @param[in] shmDir  directory of the pixel file; None for /dev/shm or the default temporary
+            directory
+        """
+        mi = exposure.getMaskedImage()
+        bbox = exposure.getBBox()
+        fd, path = tempfile.mkstemp(prefix="sharedExposure-", suffix=".pix", dir=shmDir or _defaultDir())
+        os.close(fd)
+        stubBBox = geom.Box2I(bbox.getMin(), geom.Extent2I(1, 1))
+        self = cls(path, bbox, mi.getMask().getArray().dtype,
+                   exposure.Factory(exposure, stubBBox, afwImage.PARENT, True))
+        os.truncate(path, sum(self._planeSizes()))
+        planeList = (mi.getImage().getArray(), mi.getMask().getArray(), mi.getVariance().getArray())
+        for dest, src in zip(self._mapPlanes(), planeList):
+            dest[:] = src
+            dest.flush()
+        return self
+
+    def _planeSizes(self):
+        """Return the sizes in bytes of the image, mask and variance planes"""
+        numPix = self.bbox.getHeight()*self.bbox.getWidth()
+        return [numPix*dtype.itemsize for dtype in self._planeDtypes()]
+
+    def _planeDtypes(self):
+        return [numpy.dtype(numpy.float32), self.maskDtype, numpy.dtype(numpy.float32)]
+
+    def _mapPlanes(self):
+        """Return writable memory maps of the image, mask and variance planes of the pixel file"""
+        shape = (self.bbox.getHeight(), self.bbox.getWidth())
+        planeList = []
+        offset = 0
+        for dtype, size in zip(self._planeDtypes(), self._planeSizes()):
+            planeList.append(numpy.memmap(self.path, dtype=dtype, mode="r+", offset=offset, shape=shape))
+            offset += size
+        return planeList
+
+    def getExposure(self):
+        """Return an ExposureF whose pixels are the memory maps of the shared file
+
+        Changes to the pixels are seen by every process that maps the file.
+        """
+        xy0 = self.bbox.getMin()
+        image, mask, variance = self._mapPlanes()
+        mi = afwImage.MaskedImageF(afwImage.ImageF(image, deep=False, xy0=xy0),
+                                   afwImage.Mask(mask, deep=False, xy0=xy0),
+                                   afwImage.ImageF(variance, deep=False, xy0=xy0))
+        return afwImage.ExposureF(mi, self.infoStub.getInfo())
+
+    def unlink(self):
+        """Remove the pixel file; exposures already mapped remain valid until they are deleted"""
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def __reduce__(self):
+        bboxTuple = (self.bbox.getMinX(), self.bbox.getMinY(), self.bbox.getWidth(), self.bbox.getHeight())
+        return (_unpickleSharedExposure, (self.path, bboxTuple, self.maskDtype.str, self.infoStub))
+
+
+def _unpickleSharedExposure(path, bboxTuple, maskDtype, infoStub):
+    x0, y0, width, height = bboxTuple
+    return SharedExposure(path, geom.Box2I(geom.Point2I(x0, y0), geom.Extent2I(width, height)),
+                          maskDtype, infoStub)
@@ -0,0 +1,180 @@
+#
+# LSST Data Management System
+# Copyright 2008-2016 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+import lsst.afw.image as afwImage
+import lsst.daf.base as dafBase
+import numpy
+
+__all__ = ["SnapAccumulator"]
+
+
+class SnapAccumulator:
+    """Combine any number of ISR-corrected snaps by folding them into running sums
+
+    Each snap is added to running image, variance, mask and weight planes as soon as it has
+    been corrected, after which the caller may release it; memory therefore stays at about one
+    sensor however many snaps there are.  The planes of the first snap are reused as the
+    running sums, so that snap is modified in place.
+
+    The result matches SnapCombineTask.addSnaps: pixels with any of the bad mask planes set are
+    left out of the sum, the sum is rescaled by (number of snaps)/(number of good snaps) and
+    pixels with no good snaps have EDGE set.  Header keys listed in averageKeys are averaged
+    and those in sumKeys are summed, as in SnapCombineTask.fixMetadata; the VisitInfo gets the
+    summed exposure and dark times and the average date.
+
+    @param[in] averageKeys  metadata keys whose values are averaged
+    @param[in] sumKeys  metadata keys whose values are summed
+    @param[in] badMaskPlanes  mask planes of pixels to exclude from the sum
+    @param[in] log  log for warnings about metadata that cannot be combined
+    """
+
+    def __init__(self, averageKeys, sumKeys, badMaskPlanes=(), log=None):
+        for key in averageKeys:
+            if key in sumKeys:
+                raise RuntimeError("Key %s cannot be both averaged and summed" % (key,))
+        self.averageKeys = tuple(averageKeys)
+        self.sumKeys = tuple(sumKeys)
+        self.badMaskPlanes = tuple(badMaskPlanes)
+        self.log = log
+        self.numSnaps = 0
+        self._exposure = None
+        self._weight = None
+        self._metadataSums = {}
+        self._skippedKeys = set()
+        self._visitInfoList = []
+
+    def add(self, exposure):
+        """Fold one snap into the running sums
+
+        @param[in,out] exposure  ISR-corrected snap; modified in place if it is the first snap
+        """
+        mi = exposure.getMaskedImage()
+        image = mi.getImage().getArray()
+        variance = mi.getVariance().getArray()
+        mask = mi.getMask().getArray()
+        badPixelMask = mi.getMask().getPlaneBitMask(self.badMaskPlanes) if self.badMaskPlanes else 0
+        good = (mask & badPixelMask) == 0
+
+        if self._exposure is None:
+            image[~good] = 0
+            variance[~good] = 0
+            mask[~good] = 0
+            self._exposure = exposure
+            self._weight = good.astype(numpy.uint16)
+        else:
+            sumMi = self._exposure.getMaskedImage()
+            if sumMi.getDimensions() != mi.getDimensions():
+                raise RuntimeError("Snap dimensions %s do not match %s" %
+                                   (mi.getDimensions(), sumMi.getDimensions()))
+            numpy.add(sumMi.getImage().getArray(), image, out=sumMi.getImage().getArray(), where=good)
+            numpy.add(sumMi.getVariance().getArray(), variance, out=sumMi.getVariance().getArray(),
+                      where=good)
+            numpy.bitwise_or(sumMi.getMask().getArray(), mask, out=sumMi.getMask().getArray(), where=good)
+            self._weight += good
+
+        self._addMetadata(exposure.getMetadata())
+        visitInfo = exposure.getInfo().getVisitInfo()
+        if visitInfo is not None:
+            self._visitInfoList.append(visitInfo)
+        self.numSnaps += 1
+
+    @property
+    def exposure(self):
+        """The exposure holding the running sums (the first snap), or None if no snap was added"""
+        return self._exposure
+
+    def finish(self):
+        """Return the combined exposure
+
+        The sums are normalized in place; no more snaps may be added afterwards.
+
+        @return the combined exposure
+        """
+        if self._exposure is None:
+            raise RuntimeError("No snaps were added")
+        mi = self._exposure.getMaskedImage()
+        image = mi.getImage().getArray()
+        variance = mi.getVariance().getArray()
+        noData = self._weight == 0
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            scale = numpy.float32(self.numSnaps)/self._weight.astype(numpy.float32)
+        image *= scale
+        variance *= scale*scale
+        mi.getMask().getArray()[noData] |= mi.getMask().getPlaneBitMask("EDGE")
+
+        metadata = self._exposure.getMetadata()
+        for key, (total, count) in self._metadataSums.items():
+            if key in self._skippedKeys:
+                continue
+            if count != self.numSnaps:
+                self._warn("Could not combine metadata %r: missing from %d of %d snaps",
+                           key, self.numSnaps - count, self.numSnaps)
+                continue
+            metadata.set(key, total/count if key in self.averageKeys else total)
+        if len(self._visitInfoList) == self.numSnaps and self.numSnaps > 1:
+            self._exposure.getInfo().setVisitInfo(self._combineVisitInfo(self._visitInfoList))
+
+        exposure = self._exposure
+        self._exposure = None
+        self._weight = None
+        return exposure
+
+    def _addMetadata(self, metadata):
+        """Add the averaged and summed metadata values of one snap to the running totals
+        """
+        for key in self.averageKeys + self.sumKeys:
+            if key in self._skippedKeys or not metadata.exists(key):
+                continue
+            value = metadata.getScalar(key)
+            try:
+                total, count = self._metadataSums.get(key, (0, 0))
+                self._metadataSums[key] = (total + value, count + 1)
+            except Exception:
+                self._warn("Could not combine metadata %r: value %r not numeric", key, value)
+                self._skippedKeys.add(key)
+
+    def _combineVisitInfo(self, visitInfoList):
+        """Make a VisitInfo with the summed exposure and dark times and the average date
+        """
+        visitInfo = visitInfoList[0]
+        exposureTime = sum(vi.getExposureTime() for vi in visitInfoList)
+        darkTime = sum(vi.getDarkTime() for vi in visitInfoList)
+        nsecs = [vi.getDate().nsecs(dafBase.DateTime.TAI) for vi in visitInfoList]
+        date = dafBase.DateTime(sum(nsecs)//len(nsecs), dafBase.DateTime.TAI)
+        return afwImage.VisitInfo(
+            exposureId=visitInfo.getExposureId(),
+            exposureTime=exposureTime,
+            darkTime=darkTime,
+            date=date,
+            ut1=visitInfo.getUt1(),
+            era=visitInfo.getEra(),
+            boresightRaDec=visitInfo.getBoresightRaDec(),
+            boresightAzAlt=visitInfo.getBoresightAzAlt(),
+            boresightAirmass=visitInfo.getBoresightAirmass(),
+            boresightRotAngle=visitInfo.getBoresightRotAngle(),
+            rotType=visitInfo.getRotType(),
+            observatory=visitInfo.getObservatory(),
+            weather=visitInfo.getWeather(),
+        )
+
+    def _warn(self, msg, *args):
+        if self.log is not None:
+            self.log.warn(msg, *args)
@@ -0,0 +1,116 @@
+#
+# LSST Data Management System
+# Copyright 2008-2016 AURA/LSST.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+import lsst.geom as geom
+import lsst.pipe.base as pipeBase
+
+__all__ = ["makeStripeList", "copyAmpToCcd", "StripeHalo"]
+
+
+def makeStripeList(detector, ampRowsPerStripe=1, halo=0):
+    """Divide a detector into stripes of whole amplifier rows
+
+    @param[in] detector  detector (lsst.afw.cameraGeom.Detector)
+    @param[in] ampRowsPerStripe  number of rows of amplifiers in each stripe
+    @param[in] halo  number of pixel rows by which each stripe is grown (within the detector)
+        for operations, such as growing saturated footprints, that look at neighbouring rows
+    @return a list of pipeBase.Struct, in increasing y, with fields:
+    - bbox: bounding box of the stripe, in detector pixel coordinates
+    - haloBBox: bbox grown by halo rows above and below, clipped to the detector
+    - ampList: amplifiers whose data sections lie in the stripe
+    """
+    if ampRowsPerStripe < 1:
+        raise RuntimeError("ampRowsPerStripe=%s must be positive" % (ampRowsPerStripe,))
+    ampRowDict = {}
+    for amp in detector:
+        ampRowDict.setdefault(amp.getBBox().getMinY(), []).append(amp)
+    minYList = sorted(ampRowDict.keys())
+
+    detBBox = detector.getBBox()
+    stripeList = []
+    for i in range(0, len(minYList), ampRowsPerStripe):
+        ampList = sum((ampRowDict[minY] for minY in minYList[i:i + ampRowsPerStripe]), [])
+        minY = min(amp.getBBox().getMinY() for amp in ampList)
+        maxY = max(amp.getBBox().getMaxY() for amp in ampList)
+        bbox = geom.Box2I(geom.Point2I(detBBox.getMinX(), minY), geom.Point2I(detBBox.getMaxX(), maxY))
+        haloBBox = geom.Box2I(geom.Point2I(detBBox.getMinX(), max(minY - halo, detBBox.getMinY())),
+                              geom.Point2I(detBBox.getMaxX(), min(maxY + halo, detBBox.getMaxY())))
+        stripeList.append(pipeBase.Struct(bbox=bbox, haloBBox=haloBBox, ampList=ampList))
+    return stripeList
+
+
+def copyAmpToCcd(ampMaskedImage, ccdMaskedImage, amp):
+    """Copy the trimmed data section of an amplifier into its place in a CCD image
+
+    This is the per-amplifier part of CCD assembly, applying the amplifier's raw flips.
+
+    @param[in] ampMaskedImage  masked image of the amplifier data section
+    @param[in,out] ccdMaskedImage  CCD-level (or stripe-level) masked image containing amp.getBBox()
+    @param[in] amp  amplifier (lsst.afw.cameraGeom.Amplifier)
+    """
+    bbox = amp.getBBox()
+    x0 = bbox.getMinX() - ccdMaskedImage.getX0()
+    y0 = bbox.getMinY() - ccdMaskedImage.getY0()
+    xSlice = slice(x0, x0 + bbox.getWidth())
+    ySlice = slice(y0, y0 + bbox.getHeight())
+    xStep = -1 if amp.getRawFlipX() else 1
+    yStep = -1 if amp.getRawFlipY() else 1
+    for ampPlane, ccdPlane in ((ampMaskedImage.getImage(), ccdMaskedImage.getImage()),
+                               (ampMaskedImage.getMask(), ccdMaskedImage.getMask()),
+                               (ampMaskedImage.getVariance(), ccdMaskedImage.getVariance())):
+        ccdPlane.getArray()[ySlice, xSlice] = ampPlane.getArray()[::yStep, ::xStep]
+
+
+class StripeHalo:
+    """Keep the unmodified pixels that neighbouring stripes see through their halos
+
+    Operations that are applied stripe by stripe in place (e.g. interpolation) must see the
+    halo rows as they were before the neighbouring stripe was processed, or results would
+    depend on the stripe layout.  Call save for a stripe before modifying it and restore on
+    the halo copy of the next stripe before processing it.
+    """
+
+    def __init__(self):
+        self._saved = None
+
+    def save(self, ccdMaskedImage, stripe, nextStripe):
+        """Save the rows of stripe that lie in the halo of nextStripe
+
+        @param[in] ccdMaskedImage  CCD-level masked image, before stripe is modified
+        @param[in] stripe  stripe about to be modified
+        @param[in] nextStripe  the following stripe, or None
+        """
+        self._saved = None
+        if nextStripe is None:
+            return
+        overlap = geom.Box2I(stripe.bbox)
+        overlap.clip(nextStripe.haloBBox)
+        if not overlap.isEmpty():
+            self._saved = ccdMaskedImage.Factory(ccdMaskedImage, overlap, deep=True)
+
+    def restore(self, stripeMaskedImage):
+        """Put the saved rows back into a halo copy of the next stripe
+
+        @param[in,out] stripeMaskedImage  deep copy of the next stripe's halo region
+        """
+        if self._saved is None:
+            return
+        stripeMaskedImage.Factory(stripeMaskedImage, self._saved.getBBox()).assign(self._saved)
@@ -0,0 +1,216 @@
+#
+# LSST Data Management System
+# Copyright 2008, 2009, 2010, 2011, 2012, 2013 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+import collections
+
+import lsst.geom as geom
+import lsst.sphgeom as sphgeom
+import numpy
+
+from .fitsHeaders import headerColumns
+
+__all__ = ["VisitFootprint", "tanPixelToSky", "sipDistort"]
+
+
+def tanPixelToSky(crval, crpix, cd, pixels):
+    """Transform pixel positions to sky positions through many TAN WCSs at once
+
+    @param[in] crval  array of shape (N, 2): CRVAL1, CRVAL2 (degrees) of each WCS
+    @param[in] crpix  array of shape (N, 2): CRPIX1, CRPIX2 of each WCS (FITS, 1-based)
+    @param[in] cd  array of shape (N, 2, 2): CD matrix of each WCS (degrees/pixel)
+    @param[in] pixels  array of shape (N, M, 2): M pixel positions (FITS, 1-based) for each WCS
+    @return (ra, dec): arrays of shape (N, M) in radians, ra in [0, 2 pi)
+    """
+    crval = numpy.radians(numpy.asarray(crval, dtype=float))
+    offset = numpy.asarray(pixels, dtype=float) - numpy.asarray(crpix, dtype=float)[:, numpy.newaxis, :]
+    # intermediate world coordinates, in radians
+    xi, eta = numpy.radians(numpy.einsum("nij,nmj->inm", numpy.asarray(cd, dtype=float), offset))
+    ra0 = crval[:, 0:1]
+    dec0 = crval[:, 1:2]
+    denom = numpy.cos(dec0) - eta*numpy.sin(dec0)
+    ra = numpy.mod(ra0 + numpy.arctan2(xi, denom), 2*numpy.pi)
+    dec = numpy.arctan2(eta*numpy.cos(dec0) + numpy.sin(dec0), numpy.hypot(xi, denom))
+    return ra, dec
+
+
+def sipDistort(crpix, sipA, sipB, pixels):
+    """Apply the forward SIP distortion of many WCSs to pixel positions at once
+
+    @param[in] crpix  array of shape (N, 2): CRPIX1, CRPIX2 of each WCS (FITS, 1-based)
+    @param[in] sipA, sipB  arrays of shape (N, K, K): the SIP coefficients A_p_q and B_p_q of each
+        WCS at [p, q], zero where absent (and for a pure TAN WCS)
+    @param[in] pixels  array of shape (N, M, 2): M pixel positions (FITS, 1-based) for each WCS
+    @return array of shape (N, M, 2) of the distorted positions, to be transformed by the TAN
+        projection of tanPixelToSky
+    """
+    pixels = numpy.asarray(pixels, dtype=float)
+    offset = pixels - numpy.asarray(crpix, dtype=float)[:, numpy.newaxis, :]
+    powers = numpy.arange(numpy.shape(sipA)[-1])
+    uPow = offset[..., 0, numpy.newaxis]**powers
+    vPow = offset[..., 1, numpy.newaxis]**powers
+    du = numpy.einsum("nmp,npq,nmq->nm", uPow, sipA, vPow)
+    dv = numpy.einsum("nmp,npq,nmq->nm", uPow, sipB, vPow)
+    return pixels + numpy.stack([du, dv], axis=-1)
+
+
+def _getColumn(columns, key, default, size):
+    """Return a numeric header column as a float array, default where the keyword is missing
+
+    @param[in] columns  dict of keyword: array, as returned by fitsHeaders.headerColumns
+    @param[in] key  keyword
+    @param[in] default  value for the headers without the keyword
+    @param[in] size  number of headers
+    """
+    values = columns.get(key)
+    if values is None:
+        return numpy.full(size, default, dtype=float)
+    values = numpy.asarray(values, dtype=float)
+    return numpy.where(numpy.isnan(values), default, values)
+
+
+class VisitFootprint:
+    """The sky corners and polygons of the detectors of a visit
+
+    The corners of all the detectors are computed in one vectorized transform from the TAN or
+    TAN-SIP (as in calexps) WCS in their FITS headers, with no afw SkyWcs being built.  Polygons
+    are made on first use.
+
+    @param[in] idList  list of the ccdExposureIds of the detectors
+    @param[in] ra, dec  arrays of shape (number of detectors, 4) of the right ascension and
+        declination (radians) of the corners of each detector, in order around its edge
+    """
+
+    def __init__(self, idList, ra, dec):
+        self.idList = list(idList)
+        self.ra = numpy.asarray(ra)
+        self.dec = numpy.asarray(dec)
+        self._index = {ccdExposureId: i for i, ccdExposureId in enumerate(self.idList)}
+        self._polygons = {}
+
+    @classmethod
+    def fromMetadata(cls, mdDict):
+        """Make a VisitFootprint from the headers of the detectors of a visit
+
+        @param[in] mdDict  dict of ccdExposureId: FITS header (lsst.daf.base.PropertyList) with a
+            TAN or TAN-SIP WCS; the corners are those of the NAXIS1 x NAXIS2 pixels of the image
+        @raise RuntimeError if a header has another WCS
+        """
+        columns = collections.OrderedDict(ccdExposureId=numpy.array(list(mdDict), dtype=numpy.int64))
+        columns.update(headerColumns(mdDict.values()))
+        return cls.fromColumns(columns)
+
+    @classmethod
+    def fromColumns(cls, columns):
+        """Make a VisitFootprint from the header columns of the detectors of a visit
+
+        @param[in] columns  dict of keyword: array of the values of the detectors, as returned by
+            LsstSimMapper.readMetadataColumns, with a "ccdExposureId" column; the headers must have
+            a TAN or TAN-SIP WCS and the corners are those of the NAXIS1 x NAXIS2 pixels of the image
+        @raise RuntimeError if a header has another WCS or lacks a keyword of the WCS or the size
+        """
+        idList = [int(ccdExposureId) for ccdExposureId in columns["ccdExposureId"]]
+        size = len(idList)
+        ctype1 = numpy.array([str(value).strip() for value in columns.get("CTYPE1", [None]*size)])
+        ctype2 = numpy.array([str(value).strip() for value in columns.get("CTYPE2", [None]*size)])
+        isSip = (ctype1 == "RA---TAN-SIP") & (ctype2 == "DEC--TAN-SIP")
+        isOther = ~isSip & ((ctype1 != "RA---TAN") | (ctype2 != "DEC--TAN"))
+        if isOther.any():
+            i = numpy.argmax(isOther)
+            raise RuntimeError("Detector %s has a %s WCS, not a TAN or TAN-SIP WCS" %
+                               (idList[i], (str(ctype1[i]), str(ctype2[i]))))
+        required = dict((key, _getColumn(columns, key, numpy.nan, size)) for key in
+                        ("CRVAL1", "CRVAL2", "CRPIX1", "CRPIX2", "NAXIS1", "NAXIS2"))
+        for key, values in required.items():
+            if numpy.isnan(values).any():
+                raise RuntimeError("Detector %s has no %s" % (idList[numpy.argmax(numpy.isnan(values))], key))
+        crval = numpy.stack([required["CRVAL1"], required["CRVAL2"]], axis=-1)
+        crpix = numpy.stack([required["CRPIX1"], required["CRPIX2"]], axis=-1)
+        # the CD matrix from CDi_j, or from CDELTi and PCi_j for the headers without CD1_1
+        hasCd = ~numpy.isnan(_getColumn(columns, "CD1_1", numpy.nan, size))
+        cd = numpy.empty((size, 2, 2))
+        for i in (1, 2):
+            cdelt = _getColumn(columns, "CDELT%d" % (i,), numpy.nan, size)
+            for j in (1, 2):
+                cd[:, i - 1, j - 1] = numpy.where(
+                    hasCd, _getColumn(columns, "CD%d_%d" % (i, j), 0., size),
+                    cdelt*_getColumn(columns, "PC%d_%d" % (i, j), float(i == j), size))
+        # the outer edges of the pixels, in FITS coordinates
+        low = numpy.full(size, 0.5)
+        right = required["NAXIS1"] + 0.5
+        top = required["NAXIS2"] + 0.5
+        pixels = numpy.stack([numpy.stack([low, right, right, low], axis=-1),
+                              numpy.stack([low, low, top, top], axis=-1)], axis=-1)
+        if isSip.any():
+            # the coefficients of all the WCSs padded to the highest order; zero for TAN WCSs
+            orderList = [numpy.where(isSip, _getColumn(columns, "%s_ORDER" % (name,), 0., size), -1)
+                         for name in ("A", "B")]
+            numCoeffs = int(max(order.max() for order in orderList)) + 1
+            sipA, sipB = numpy.zeros((2, size, numCoeffs, numCoeffs))
+            for name, order, coeffs in zip(("A", "B"), orderList, (sipA, sipB)):
+                for p in range(numCoeffs):
+                    for q in range(numCoeffs - p):
+                        coeffs[:, p, q] = numpy.where(
+                            p + q <= order, _getColumn(columns, "%s_%d_%d" % (name, p, q), 0., size), 0.)
+            pixels = sipDistort(crpix, sipA, sipB, pixels)
+        ra, dec = tanPixelToSky(crval, crpix, cd, pixels)
+        return cls(idList, ra, dec)
+
+    def __len__(self):
+        return len(self.idList)
+
+    def getCorners(self, ccdExposureId):
+        """Return the corners of a detector as a list of lsst.geom.SpherePoint"""
+        i = self._index[ccdExposureId]
+        return [geom.SpherePoint(ra, dec, geom.radians) for ra, dec in zip(self.ra[i], self.dec[i])]
+
+    def getPolygon(self, ccdExposureId):
+        """Return the outline of a detector as an lsst.sphgeom.ConvexPolygon"""
+        polygon = self._polygons.get(ccdExposureId)
+        if polygon is None:
+            i = self._index[ccdExposureId]
+            polygon = sphgeom.ConvexPolygon.convexHull(
+                [sphgeom.UnitVector3d(sphgeom.LonLat.fromRadians(ra, dec))
+                 for ra, dec in zip(self.ra[i], self.dec[i])])
+            self._polygons[ccdExposureId] = polygon
+        return polygon
+
+    def getUnitVectors(self):
+        """Return an array of shape (number of detectors, 4, 3) of the corners as unit vectors"""
+        cosDec = numpy.cos(self.dec)
+        return numpy.stack([cosDec*numpy.cos(self.ra), cosDec*numpy.sin(self.ra), numpy.sin(self.dec)],
+                           axis=-1)
+
+    def getBoundingCircle(self):
+        """Return an lsst.sphgeom.Circle containing all the detectors"""
+        vectors = self.getUnitVectors().reshape(-1, 3)
+        center = vectors.mean(axis=0)
+        center /= numpy.linalg.norm(center)
+        cosMinDist = numpy.clip(vectors.dot(center), -1., 1.).min()
+        return sphgeom.Circle(sphgeom.UnitVector3d(*center),
+                              sphgeom.Angle(float(numpy.arccos(cosMinDist))))
+
+    def findOverlapping(self, region):
+        """Return the ccdExposureIds of the detectors whose polygons may overlap an sphgeom region
+        """
+        if self.getBoundingCircle().relate(region) & sphgeom.DISJOINT:
+            return []
+        return [ccdExposureId for ccdExposureId in self.idList
+                if not self.getPolygon(ccdExposureId).relate(region) & sphgeom.DISJOINT]
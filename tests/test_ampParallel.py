@@ -0,0 +1,92 @@
+#
+# LSST Data Management System
+# Copyright 2008-2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+import sys
+import unittest
+
+import numpy
+
+import lsst.afw.image as afwImage
+import lsst.geom as geom
+from lsst.ip.isr import isrFunctions
+from lsst.obs.lsstSim.ampParallel import AmpStageExecutor, maskSaturated, subtractBias, setVarianceFromImage
+import lsst.utils.tests
+
+
+def makeMaskedImage(rng, level):
+    mi = afwImage.MaskedImageF(geom.Box2I(geom.Point2I(0, 0), geom.Extent2I(30, 20)))
+    mi.getImage().getArray()[:] = rng.poisson(level, size=(20, 30))
+    mi.getVariance().getArray()[:] = rng.uniform(1., 2., size=(20, 30))
+    return mi
+
+
+class AmpParallelTestCase(lsst.utils.tests.TestCase):
+    """A test case for the amp-parallel ISR kernels
+    """
+
+    def setUp(self):
+        self.rng = numpy.random.RandomState(12345)
+
+    def testMaskSaturated(self):
+        mi = makeMaskedImage(self.rng, 1000.)
+        mi.getImage().getArray()[3, 4:7] = 5000.
+        expected = mi.clone()
+        isrFunctions.makeThresholdMask(maskedImage=expected, threshold=5000., growFootprints=0,
+                                       maskName="SAT")
+        maskSaturated(mi, 5000., mi.getMask().getPlaneBitMask("SAT"))
+        self.assertMasksEqual(mi.getMask(), expected.getMask())
+
+    def testSubtractBias(self):
+        mi = makeMaskedImage(self.rng, 1000.)
+        bias = makeMaskedImage(self.rng, 10.)
+        expected = mi.clone()
+        expected -= bias
+        subtractBias(mi, bias)
+        self.assertMaskedImagesAlmostEqual(mi, expected)
+
+    def testSetVariance(self):
+        mi = makeMaskedImage(self.rng, 1000.)
+        expected = mi.clone()
+        isrFunctions.updateVariance(expected, 1.7, 7.)
+        setVarianceFromImage(mi, 1.7, 7.)
+        self.assertImagesAlmostEqual(mi.getVariance(), expected.getVariance(), rtol=1e-6)
+
+    def testExecutor(self):
+        """Results come back in order whatever the number of threads"""
+        for numThreads in (1, 4):
+            executor = AmpStageExecutor(numThreads)
+            self.assertEqual(executor.map(lambda x: x*x, range(16)), [x*x for x in range(16)])
+            executor.close()
+        with self.assertRaises(RuntimeError):
+            AmpStageExecutor(0)
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    setup_module(sys.modules[__name__])
+    unittest.main()
@@ -0,0 +1,161 @@
+#
+# LSST Data Management System
+# Copyright 2008-2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+import os
+import sys
+import unittest
+
+import numpy
+
+import lsst.afw.image as afwImage
+import lsst.afw.math as afwMath
+import lsst.geom as geom
+from lsst.obs.lsstSim.calibStack import OutOfCoreStacker
+from lsst.obs.lsstSim.processCalibLsstSim import ProcessCalibLsstSimTask
+import lsst.utils.tests
+
+
+class CalibStackTestCase(lsst.utils.tests.TestCase):
+    """A test case for the out-of-core calibration stacker
+    """
+
+    def setUp(self):
+        rng = numpy.random.RandomState(12345)
+        self.miList = []
+        for i in range(7):
+            mi = afwImage.MaskedImageF(geom.Box2I(geom.Point2I(0, 0), geom.Extent2I(31, 23)))
+            mi.getImage().getArray()[:] = rng.normal(100., 5., size=(23, 31))
+            mi.getImage().getArray()[rng.random_sample((23, 31)) < 0.02] = 1e4
+            mi.getVariance().getArray()[:] = rng.uniform(20., 30., size=(23, 31))
+            mi.getMask().getArray()[rng.random_sample((23, 31)) < 0.05] = mi.getMask().getPlaneBitMask("BAD")
+            self.miList.append(mi)
+        self.statsCtrl = afwMath.StatisticsControl()
+        self.statsCtrl.setNumSigmaClip(3.)
+        self.statsCtrl.setNumIter(3)
+        self.statsCtrl.setAndMask(afwImage.Mask.getPlaneBitMask("BAD"))
+
+    def tearDown(self):
+        del self.miList
+
+    def testMatchesStatisticsStack(self):
+        """Stacking in blocks of rows gives the in-memory result"""
+        for statistic in (afwMath.MEANCLIP, afwMath.MEDIAN):
+            expected = afwMath.statisticsStack(self.miList, statistic, self.statsCtrl)
+            # a block size of a few rows, so the stack is done in several blocks
+            with OutOfCoreStacker(maxBlockBytes=len(self.miList)*31*12*5) as stacker:
+                for mi in self.miList:
+                    stacker.add(mi)
+                self.assertEqual(stacker.rowsPerBlock(), 5)
+                combined = stacker.combine(statistic, self.statsCtrl)
+            self.assertMaskedImagesEqual(combined, expected)
+
+    def testTaskStackStatistic(self):
+        """ProcessCalibLsstSimTask stacks with its configured statistic, in memory or out of core"""
+        for statisticName in ("MEANCLIP", "MEDIAN"):
+            config = ProcessCalibLsstSimTask.ConfigClass()
+            config.stackStatistic = statisticName
+            task = ProcessCalibLsstSimTask(config=config)
+            expected = afwMath.statisticsStack(self.miList, getattr(afwMath, statisticName), task.statsCtrl)
+            self.assertMaskedImagesEqual(task.stackMasterFrame(self.miList), expected)
+            with OutOfCoreStacker(maxBlockBytes=len(self.miList)*31*12*5) as stacker:
+                for mi in self.miList:
+                    stacker.add(mi)
+                self.assertMaskedImagesEqual(task.stackMasterFrame(stacker), expected)
+
+        config = ProcessCalibLsstSimTask.ConfigClass()
+        config.stackStatistic = "MEDIAN"
+        config.doSinglePassStack = True
+        with self.assertRaises(ValueError):
+            config.validate()
+
+    def testEnginesAgree(self):
+        """The afw and numpy engines give the same image, variance and mask with the task's statsCtrl"""
+        weights = numpy.random.RandomState(54321).uniform(0.5, 2., size=len(self.miList)).tolist()
+        stackedDict = {}
+        for engine in ("afw", "numpy"):
+            config = ProcessCalibLsstSimTask.ConfigClass()
+            config.combineEngine = engine
+            task = ProcessCalibLsstSimTask(config=config)
+            self.assertTrue(task.statsCtrl.getCalcErrorFromInputVariance())
+            stackedDict[engine] = [task.combineMIList(self.miList, method="MEANCLIP"),
+                                   task.combineMIList(self.miList, method="MEDIAN"),
+                                   task.combineMIList(self.miList, method="MEANCLIP", weights=weights)]
+        for afwStack, numpyStack in zip(stackedDict["afw"], stackedDict["numpy"]):
+            self.assertImagesAlmostEqual(numpyStack.getImage(), afwStack.getImage(), rtol=1e-5)
+            self.assertImagesAlmostEqual(numpyStack.getVariance(), afwStack.getVariance(), rtol=1e-5)
+            self.assertMasksEqual(numpyStack.getMask(), afwStack.getMask())
+
+    def testSinglePassWeights(self):
+        """A single-pass stack is the inverse-variance weighted mean of the snaps, whatever their order"""
+        # four visits of two snaps, each flat with its own level and variance so none is clipped
+        levels = [100. + 0.1*i for i in range(8)]
+        variances = [10.*(i + 1) for i in range(8)]
+        snapList = []
+        for level, variance in zip(levels, variances):
+            mi = afwImage.MaskedImageF(geom.Box2I(geom.Point2I(0, 0), geom.Extent2I(31, 23)))
+            mi.getImage().set(level)
+            mi.getVariance().set(variance)
+            snapList.append(mi)
+        expected = sum(level/variance for level, variance in zip(levels, variances)) / \
+            sum(1./variance for variance in variances)
+        for engine in ("afw", "numpy"):
+            config = ProcessCalibLsstSimTask.ConfigClass()
+            config.doSinglePassStack = True
+            config.combineEngine = engine
+            task = ProcessCalibLsstSimTask(config=config)
+            weights = [task.frameWeight(mi) for mi in snapList]
+            self.assertFloatsAlmostEqual(numpy.array(weights), 1./numpy.array(variances), rtol=1e-6)
+            results = []
+            # snaps in visit order and snap-major order, stacked in blocks of different sizes
+            for order, rowsPerBlock in ((list(range(8)), 5), ([0, 2, 4, 6, 1, 3, 5, 7], 23)):
+                with OutOfCoreStacker(maxBlockBytes=len(snapList)*31*12*rowsPerBlock) as stacker:
+                    for i in order:
+                        stacker.add(snapList[i])
+                    combined = task.stackMasterFrame(stacker, weights=[weights[i] for i in order])
+                self.assertFloatsAlmostEqual(combined.getImage().getArray(), expected, rtol=1e-5)
+                results.append(combined)
+            self.assertMaskedImagesAlmostEqual(results[0], results[1], rtol=1e-6)
+
+    def testClose(self):
+        """The temporary files are deleted and mismatched frames are rejected"""
+        stacker = OutOfCoreStacker()
+        stacker.add(self.miList[0])
+        tmpDir = stacker._dir
+        self.assertTrue(os.path.isdir(tmpDir))
+        with self.assertRaises(RuntimeError):
+            stacker.add(afwImage.MaskedImageF(geom.Extent2I(5, 5)))
+        stacker.close()
+        self.assertFalse(os.path.exists(tmpDir))
+        with self.assertRaises(RuntimeError):
+            stacker.combine(afwMath.MEANCLIP, self.statsCtrl)
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    setup_module(sys.modules[__name__])
+    unittest.main()
@@ -0,0 +1,108 @@
+#
+# LSST Data Management System
+# Copyright 2008-2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+import os
+import sys
+import tempfile
+import unittest
+
+import numpy
+
+import lsst.afw.image as afwImage
+import lsst.geom as geom
+from lsst.obs.lsstSim.defectCache import InterpolationStencil, StencilCache, interpolateDefectsWithStencil
+from lsst.obs.lsstSim.defectCache import PackedMaskCache, orPackedMask
+from lsst.obs.lsstSim.defectUtils import DefectBoxArray
+import lsst.utils.tests
+
+
+class DefectCacheTestCase(lsst.utils.tests.TestCase):
+    """A test case for the cached defect interpolation stencils
+    """
+
+    def testStencil(self):
+        """Runs are interpolated linearly between the good pixels on either side"""
+        bad = numpy.zeros((3, 10), dtype=bool)
+        bad[0, 3:5] = True
+        bad[1, 0:2] = True
+        bad[2, :] = True
+        stencil = InterpolationStencil.fromMask(bad, numSide=2)
+        image = numpy.tile(numpy.arange(10, dtype=numpy.float32)**2, (3, 1))
+        image[bad] = -1.
+        stencil.apply(image, fallbackValue=123.)
+        # between the means of pixels 1, 2 (2.5) and 5, 6 (30.5)
+        self.assertFloatsAlmostEqual(image[0, 3:5], [2.5 + 28./3, 2.5 + 56./3], rtol=1e-6)
+        # only good pixels to the right: their mean
+        self.assertFloatsAlmostEqual(image[1, 0:2], 6.5, rtol=1e-6)
+        self.assertFloatsAlmostEqual(image[2], 123., rtol=1e-6)
+
+    def testCache(self):
+        """Stencils are cached on disk and interpolate in the parent coordinates of subimages"""
+        boxes = DefectBoxArray([12, 15], [21, 20], [13, 15], [22, 29])
+        mi = afwImage.MaskedImageF(geom.Box2I(geom.Point2I(10, 20), geom.Extent2I(8, 10)))
+        mi.getImage().getArray()[:] = numpy.arange(8, dtype=numpy.float32)
+        expected = mi.getImage().getArray().copy()
+        mi.getImage().getArray()[1:3, 2:4] = -1.
+        mi.getImage().getArray()[:, 5] = -1.
+        mi.getVariance().getArray()[:] = 2.*numpy.arange(8, dtype=numpy.float32)
+        mi.getVariance().getArray()[1:3, 2:4] = 0.
+        mi.getVariance().getArray()[:, 5] = 0.
+        with tempfile.TemporaryDirectory() as cacheDir:
+            interpolateDefectsWithStencil(mi, boxes, 1.0, StencilCache(cacheDir))
+            self.assertEqual(len(os.listdir(cacheDir)), 1)
+            self.assertFloatsAlmostEqual(mi.getImage().getArray(), expected, rtol=1e-6)
+            self.assertFloatsAlmostEqual(mi.getVariance().getArray(), 2.*expected, rtol=1e-6)
+            intrp = mi.getMask().getArray() & afwImage.Mask.getPlaneBitMask("INTRP")
+            self.assertEqual(numpy.count_nonzero(intrp), 4 + 10)
+            # a new cache finds the stencil written by the first
+            cache = StencilCache(cacheDir)
+            stencil = cache.get(boxes.shifted(-10, -20), (10, 8), 1)
+            self.assertEqual(len(stencil.target), 14)
+
+    def testPackedMask(self):
+        """ORing a cached packed mask sets the same pixels as Defects.maskPixels"""
+        rng = numpy.random.RandomState(12345)
+        x0 = rng.randint(0, 50, size=30)
+        y0 = rng.randint(0, 33, size=30)
+        boxes = DefectBoxArray(x0, y0, x0 + rng.randint(0, 9, size=30), y0 + rng.randint(0, 9, size=30))
+        mask = afwImage.Mask(geom.Extent2I(61, 43))
+        expected = mask.clone()
+        boxes.toDefects().maskPixels(afwImage.MaskedImageF(afwImage.ImageF(expected.getBBox()), expected),
+                                     maskName="BAD")
+        badBit = mask.getPlaneBitMask("BAD")
+        with tempfile.TemporaryDirectory() as cacheDir:
+            packed = PackedMaskCache(cacheDir).get(boxes, mask.getArray().shape)
+            self.assertEqual(packed.shape, (43, 8))
+            orPackedMask(mask.getArray(), PackedMaskCache(cacheDir).get(boxes, mask.getArray().shape), badBit)
+        self.assertMasksEqual(mask, expected)
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    setup_module(sys.modules[__name__])
+    unittest.main()
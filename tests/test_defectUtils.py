@@ -0,0 +1,91 @@
+#
+# LSST Data Management System
+# Copyright 2008-2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+import sys
+import unittest
+
+import numpy
+
+import lsst.geom as geom
+import lsst.meas.algorithms as measAlg
+from lsst.obs.lsstSim.defectUtils import DefectBoxArray, DefectGridIndex
+import lsst.utils.tests
+
+
+def boxTuple(bbox):
+    return (bbox.getMinX(), bbox.getMinY(), bbox.getMaxX(), bbox.getMaxY())
+
+
+class DefectUtilsTestCase(lsst.utils.tests.TestCase):
+    """A test case for the vectorized defect boxes and their index
+    """
+
+    def setUp(self):
+        rng = numpy.random.RandomState(12345)
+        self.defectList = measAlg.Defects()
+        for i in range(200):
+            x0, y0 = rng.randint(0, 4000, size=2)
+            w, h = rng.randint(1, 40, size=2)
+            self.defectList.append(measAlg.Defect(geom.Box2I(geom.Point2I(x0, y0), geom.Extent2I(w, h))))
+        self.boxes = DefectBoxArray.fromDefects(self.defectList)
+
+    def tearDown(self):
+        del self.defectList
+        del self.boxes
+
+    def testTransformsMatchBox2I(self):
+        """Transposing, shifting and flipping act as the per-defect Box2I operations"""
+        dx, dy, height = -17, 23, 2000
+        result = self.boxes.transposed().shifted(dx, dy).flippedY(height).toDefects()
+        self.assertEqual(len(result), len(self.defectList))
+        for defect, got in zip(self.defectList, result):
+            bbox = defect.getBBox()
+            expected = measAlg.Defect(geom.Box2I(geom.Point2I(bbox.getMinY(), bbox.getMinX()),
+                                                 geom.Extent2I(bbox.getHeight(), bbox.getWidth())))
+            expected.shift(dx, dy)
+            ebox = expected.getBBox()
+            expected.shift(0, height - 2*ebox.getMinY() - ebox.getHeight())
+            self.assertEqual(boxTuple(got.getBBox()), boxTuple(expected.getBBox()))
+
+    def testOverlapIndex(self):
+        """The grid index finds exactly the boxes that Box2I.overlaps does"""
+        index = DefectGridIndex(self.boxes, cellSize=(300, 500))
+        for region in (geom.Box2I(geom.Point2I(0, 0), geom.Extent2I(509, 2000)),
+                       geom.Box2I(geom.Point2I(1018, 2000), geom.Extent2I(509, 2000)),
+                       geom.Box2I(geom.Point2I(-100, -100), geom.Extent2I(50, 50))):
+            expected = [i for i, d in enumerate(self.defectList) if region.overlaps(d.getBBox())]
+            self.assertEqual(index.query(region).tolist(), expected)
+            self.assertEqual(numpy.flatnonzero(self.boxes.overlaps(region)).tolist(), expected)
+            self.assertEqual(len(index.subset(region)), len(expected))
+        self.assertEqual(len(DefectGridIndex(DefectBoxArray.fromDefects([])).query(region)), 0)
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    setup_module(sys.modules[__name__])
+    unittest.main()
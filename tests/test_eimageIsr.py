@@ -0,0 +1,152 @@
+#
+# LSST Data Management System
+# Copyright 2008-2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+import sys
+import unittest
+
+import numpy
+
+import lsst.afw.image as afwImage
+import lsst.geom as geom
+import lsst.ip.isr as isr
+from lsst.obs.lsstSim.eimageIsr import EimageIsrTask
+import lsst.utils.tests
+
+
+def makeSaturatedImage(rng, width, height, satVal, numBlobs=5):
+    """Make a masked image with Poisson noise and saturated blobs, with SAT masked"""
+    mi = afwImage.MaskedImageF(geom.Box2I(geom.Point2I(0, 0), geom.Extent2I(width, height)))
+    image = mi.getImage().getArray()
+    image[:] = rng.poisson(1000., size=(height, width))
+    for i in range(numBlobs):
+        x0, y0 = rng.randint(0, width - 4), rng.randint(0, height - 10)
+        image[y0:y0 + rng.randint(1, 10), x0:x0 + rng.randint(1, 4)] = satVal + 1.
+    # a saturated column touching the image edge
+    image[:5, width - 1] = satVal + 1.
+    mi.getVariance().getArray()[:] = image
+    isr.makeThresholdMask(maskedImage=mi, threshold=satVal, growFootprints=0, maskName='SAT')
+    return mi
+
+
+class EimageIsrTestCase(lsst.utils.tests.TestCase):
+    """A test case for EimageIsrTask
+    """
+
+    def testInterpolateSaturation(self):
+        """Interpolating column blocks matches interpolating the whole transposed image"""
+        task = EimageIsrTask()
+        mi = makeSaturatedImage(numpy.random.RandomState(12345), 60, 80, task.config.sat_val)
+        expected = isr.transposeMaskedImage(mi)
+        isr.interpolateFromMask(maskedImage=expected, fwhm=task.config.interp_size,
+                                growSaturatedFootprints=0, maskNameList=['SAT'])
+        expected = isr.transposeMaskedImage(expected)
+        task.interpolateSaturation(mi)
+        self.assertEqual(mi.getBBox(), expected.getBBox())
+        self.assertMaskedImagesAlmostEqual(mi, expected, rtol=1e-6)
+
+    def testPrepareExposure(self):
+        """The fused preparation matches running each step over the whole image"""
+        rng = numpy.random.RandomState(12345)
+        eimage = afwImage.ExposureI(geom.Box2I(geom.Point2I(0, 0), geom.Extent2I(37, 53)))
+        eimage.getMaskedImage().getImage().getArray()[:] = rng.randint(0, 200000, size=(53, 37))
+        for varianceType in ("image", "value"):
+            config = EimageIsrTask.ConfigClass()
+            config.doAddNoise = True
+            config.rngSeed = 5
+            config.noiseRng = "global"
+            config.varianceType = varianceType
+            config.maskEdgeBorder = 3
+            config.prepareRowsPerChunk = 7
+            task = EimageIsrTask(config=config)
+            exposure, satColumns = task.prepareExposure(eimage)
+
+            numpy.random.seed(config.rngSeed)
+            expected = eimage.convertF()
+            task.addNoise(expected)
+            task.setVariance(expected)
+            task.maskEdges(expected)
+            isr.makeThresholdMask(maskedImage=expected.getMaskedImage(), threshold=config.sat_val,
+                                  growFootprints=0, maskName='SAT')
+            self.assertMaskedImagesEqual(exposure.getMaskedImage(), expected.getMaskedImage())
+            satBit = expected.getMaskedImage().getMask().getPlaneBitMask('SAT')
+            expectedColumns = numpy.any(expected.getMaskedImage().getMask().getArray() & satBit, axis=0)
+            numpy.testing.assert_array_equal(satColumns, expectedColumns)
+
+    def testNoiseStreams(self):
+        """Stream noise depends on the sensor but not on the blocking or number of threads"""
+        eimage = afwImage.ExposureI(geom.Box2I(geom.Point2I(0, 0), geom.Extent2I(37, 53)))
+        dataId = dict(visit=85470982, raft="2,2", sensor="1,1", snap=0)
+        imageList = []
+        for numThreads, rowsPerChunk, sensor in ((1, 16, "1,1"), (4, 5, "1,1"), (3, 53, "1,2")):
+            config = EimageIsrTask.ConfigClass()
+            config.doAddNoise = True
+            config.rngSeed = 5
+            config.noiseRng = "stream"
+            config.numThreads = numThreads
+            config.prepareRowsPerChunk = rowsPerChunk
+            task = EimageIsrTask(config=config)
+            exposure, satColumns = task.prepareExposure(eimage, dict(dataId, sensor=sensor))
+            imageList.append(exposure.getMaskedImage().getImage().getArray())
+        self.assertFloatsEqual(imageList[0], imageList[1])
+        self.assertGreater(numpy.count_nonzero(imageList[0] != imageList[2]), 0)
+        self.assertFloatsAlmostEqual(imageList[0].mean(), config.noiseValue, rtol=0.01)
+
+        # the step-by-step path draws the same noise
+        expected = eimage.convertF()
+        task.addNoise(expected, dataId)
+        self.assertFloatsEqual(expected.getMaskedImage().getImage().getArray(), imageList[0])
+
+    def testDefaultLeavesGlobalRng(self):
+        """By default the task neither seeds nor draws from the global numpy generator"""
+        numpy.random.seed(321)
+        state = numpy.random.get_state()
+        config = EimageIsrTask.ConfigClass()
+        config.doAddNoise = True
+        config.rngSeed = 5
+        task = EimageIsrTask(config=config)
+        eimage = afwImage.ExposureI(geom.Box2I(geom.Point2I(0, 0), geom.Extent2I(11, 13)))
+        task.prepareExposure(eimage, dict(visit=1, raft="2,2", sensor="1,1", snap=0))
+        newState = numpy.random.get_state()
+        self.assertEqual(state[2:], newState[2:])
+        numpy.testing.assert_array_equal(state[1], newState[1])
+
+    def testNoSaturation(self):
+        """An image without SAT pixels is left unchanged"""
+        task = EimageIsrTask()
+        mi = makeSaturatedImage(numpy.random.RandomState(54321), 20, 30, task.config.sat_val, numBlobs=0)
+        mi.getImage().getArray()[:] = 1.
+        mi.getMask().set(0)
+        expected = mi.clone()
+        task.interpolateSaturation(mi)
+        self.assertMaskedImagesEqual(mi, expected)
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    setup_module(sys.modules[__name__])
+    unittest.main()
@@ -0,0 +1,126 @@
+#
+# LSST Data Management System
+# Copyright 2008-2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+import os
+import sys
+import tempfile
+import unittest
+
+import numpy
+
+import lsst.afw.image as afwImage
+import lsst.geom as geom
+from lsst.obs.lsstSim.flatNorm import FlatStatsTable, flatNormKey, combineAmpStats
+from lsst.obs.lsstSim.processCalibLsstSim import ProcessCalibLsstSimTask
+import lsst.utils.tests
+
+
+class StubButler:
+    """A butler that keeps a copy of what is put"""
+
+    def __init__(self):
+        self.puts = []
+
+    def put(self, exposure, datasetType, dataId):
+        self.puts.append((exposure.getMaskedImage().clone(), datasetType, dataId))
+
+
+class FlatNormTestCase(lsst.utils.tests.TestCase):
+    """A test case for the flat normalization statistics table
+    """
+
+    def fillTable(self, table):
+        for raft, raftScale in (("2,2", 1.), ("1,2", 2.)):
+            for sensor, sensorScale in (("1,1", 1.), ("0,1", 3.)):
+                for channel in ("0,0", "1,0"):
+                    dataId = dict(raft=raft, sensor=sensor, channel=channel, visit=1, snap=0)
+                    table.add(dataId, 10.*raftScale*sensorScale, 1000)
+
+    def testNormalization(self):
+        """Each level averages the amp means over its own group"""
+        with tempfile.TemporaryDirectory() as tmpDir:
+            table = FlatStatsTable(os.path.join(tmpDir, "flatStats.sqlite3"))
+            self.fillTable(table)
+            # re-adding an amp replaces it
+            self.fillTable(table)
+            self.assertEqual(len(table.getRows()), 8)
+            self.assertEqual(table.computeNormalization("sensor")[("2,2", "0,1")], 30.)
+            self.assertEqual(table.computeNormalization("raft")[("1,2",)], 40.)
+            self.assertEqual(table.computeNormalization("focalPlane"), {(): 30.})
+            row = table.getRows()[0]
+            table.remove(row.dataId)
+            self.assertEqual(len(FlatStatsTable(table.path).getRows()), 7)
+
+    def testHelpers(self):
+        self.assertFloatsAlmostEqual(combineAmpStats([(1., 1), (4., 3)]), 2.5)
+        self.assertFloatsAlmostEqual(combineAmpStats([(1., 1), (4., 3)], "pixel"), 3.25)
+        with self.assertRaises(RuntimeError):
+            combineAmpStats([])
+        with self.assertRaises(ValueError):
+            combineAmpStats([(1., 1)], "sensor")
+        with self.assertRaises(ValueError):
+            flatNormKey(dict(raft="2,2", sensor="1,1"), "amp")
+        table = FlatStatsTable(":memory:")
+        self.fillTable(table)
+        self.assertEqual(len(table.computeNormalization("sensor")), 4)
+        self.assertTrue(table.containsAll([dict(raft="1,2", sensor="0,1", channel=channel, visit=1, snap=0)
+                                           for channel in ("0,0", "1,0")]))
+        self.assertFalse(table.containsAll([dict(raft="1,2", sensor="0,1", channel="2,0", visit=1, snap=0)]))
+
+    def testStagedFlat(self):
+        """A staged flat is divided by its normalization and written, and its files removed"""
+        rng = numpy.random.RandomState(12345)
+        exposure = afwImage.ExposureF(geom.Box2I(geom.Point2I(0, 0), geom.Extent2I(31, 23)))
+        mi = exposure.getMaskedImage()
+        mi.getImage().getArray()[:] = rng.normal(100., 5., size=(23, 31))
+        mi.getVariance().set(25.)
+        dataId = dict(raft="2,2", sensor="1,1", channel="0,0", visit=1, snap=0)
+        task = ProcessCalibLsstSimTask()
+        butler = StubButler()
+        with tempfile.TemporaryDirectory() as tmpDir:
+            task.stageFlat(exposure, dataId, tmpDir)
+            # restaging replaces the staged flat
+            task.stageFlat(exposure, dataId, tmpDir)
+            table = FlatStatsTable(os.path.join(tmpDir, "flatStats.sqlite3"))
+            row, = table.getRows()
+            self.assertEqual(row.dataId, dataId)
+            self.assertEqual(row.numPix, 31*23)
+            task.writeStagedFlats(butler, tmpDir, "raft")
+            self.assertEqual(table.getRows(), [])
+            self.assertEqual(os.listdir(tmpDir), ["flatStats.sqlite3"])
+        written, datasetType, writtenId = butler.puts[0]
+        self.assertEqual((datasetType, writtenId), ("flat", dataId))
+        expected = mi.clone()
+        expected /= row.mean
+        self.assertMaskedImagesAlmostEqual(written, expected)
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    setup_module(sys.modules[__name__])
+    unittest.main()
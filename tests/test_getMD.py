@@ -20,11 +20,20 @@
 # see <http://www.lsstcorp.org/LegalNotices/>.
 #
 import os.path
+import shutil
+import sqlite3
 import sys
+import tempfile
 import unittest
 
+import numpy
+
 import lsst.utils.tests
 import lsst.daf.persistence as dafPersist
+from lsst.afw.fits import readMetadata
+from lsst.obs.lsstSim import LsstSimMapper
+from lsst.obs.lsstSim.fitsHeaders import readFitsHeader
+from lsst.obs.lsstSim.headerSidecar import HeaderSidecar, HEADER_SIDECAR_NAME
 
 
 class GetRawMetadataTestCase(unittest.TestCase):
@@ -44,6 +53,68 @@ class GetRawMetadataTestCase(unittest.TestCase):
         self.assertEqual(rawMd.getScalar("BITPIX"), 16)
         self.assertEqual(rawMd.getScalar("CCDID"), "R03_S01_C10")
 
+    def testBulkMetadata(self):
+        """Headers read in bulk match the butler's and are keyed by ccdExposureId"""
+        dataId = dict(visit=85471048, snap=0, raft='0,3', sensor='0,1', channel='1,0')
+        mapper = LsstSimMapper(root=os.path.join(os.path.dirname(__file__), "data"))
+        mdDict = mapper.readMetadataBulk("raw_md", [dataId], numThreads=2)
+        self.assertEqual(list(mdDict), [self.butler.get("ccdExposureId", dataId)])
+        rawMd = self.butler.get("raw_md", dataId)
+        bulkMd = mdDict[self.butler.get("ccdExposureId", dataId)]
+        for name in ("AIRMASS", "BITPIX", "CCDID", "NAXIS1", "NAXIS2"):
+            self.assertEqual(bulkMd.getScalar(name), rawMd.getScalar(name))
+
+        md = readMetadata(self.butler.get("raw_filename", dataId)[0])
+        fastMd = readFitsHeader(self.butler.get("raw_filename", dataId)[0])
+        for name in ("AIRMASS", "BITPIX", "CCDID", "EXPTIME", "NAXIS1", "RA_DEG", "TAI", "OUTFILE"):
+            self.assertEqual(fastMd.getScalar(name), md.getScalar(name), msg=name)
+
+    def testMetadataColumns(self):
+        """Headers read as columns have one array per keyword, in the order of the data IDs"""
+        dataId = dict(visit=85471048, snap=0, raft='0,3', sensor='0,1', channel='1,0')
+        mapper = LsstSimMapper(root=os.path.join(os.path.dirname(__file__), "data"))
+        columns = mapper.readMetadataColumns("raw", [dataId],
+                                             keys=["AIRMASS", "BITPIX", "CCDID", "NOSUCHKEY"])
+        self.assertEqual(list(columns), ["ccdExposureId", "AIRMASS", "BITPIX", "CCDID", "NOSUCHKEY"])
+        self.assertEqual(columns["ccdExposureId"].tolist(), [self.butler.get("ccdExposureId", dataId)])
+        self.assertEqual(columns["AIRMASS"].dtype, numpy.float64)
+        self.assertAlmostEqual(columns["AIRMASS"][0], 1.3184949200550, places=11)
+        self.assertEqual(columns["BITPIX"].dtype, numpy.int64)
+        self.assertEqual(columns["BITPIX"].tolist(), [16])
+        self.assertEqual(columns["CCDID"].tolist(), ["R03_S01_C10"])
+        self.assertEqual(columns["NOSUCHKEY"].tolist(), [None])
+        # by default, every keyword of the headers
+        columns = mapper.readMetadataColumns("raw_md", [dataId], numThreads=2)
+        self.assertEqual(list(columns)[1:], mapper.readMetadataBulk("raw_md", [dataId])[
+            columns["ccdExposureId"][0]].getOrderedNames())
+
+    def testHeaderSidecar(self):
+        """raw_md and raw_visitInfo are read from the header sidecar if it has a row for the file"""
+        dataId = dict(visit=85471048, snap=0, raft='0,3', sensor='0,1', channel='1,0')
+        with tempfile.TemporaryDirectory() as tmpDir:
+            root = os.path.join(tmpDir, "data")
+            shutil.copytree(os.path.join(os.path.dirname(__file__), "data"), root)
+            relPath = os.path.relpath(self.butler.get("raw_filename", dataId)[0],
+                                      os.path.join(os.path.dirname(__file__), "data"))
+            md = readMetadata(os.path.join(root, relPath))
+            md.set("AIRMASS", 2.0)
+            HeaderSidecar(os.path.join(root, HEADER_SIDECAR_NAME)).add(relPath, md)
+
+            butler = dafPersist.Butler(root=root)
+            rawMd = butler.get("raw_md", dataId)
+            self.assertEqual(rawMd.getScalar("AIRMASS"), 2.0)
+            self.assertEqual(rawMd.getScalar("BITPIX"), 16)
+            self.assertEqual(rawMd.getScalar("CCDID"), "R03_S01_C10")
+            self.assertTrue(rawMd.exists("Computed_ampExposureId"))
+            self.assertEqual(butler.get("raw_visitInfo", dataId).getBoresightAirmass(), 2.0)
+
+            # without a row, the header is read from the file
+            with sqlite3.connect(os.path.join(root, HEADER_SIDECAR_NAME)) as conn:
+                conn.execute("DELETE FROM headers")
+            butler = dafPersist.Butler(root=root)
+            self.assertAlmostEqual(butler.get("raw_md", dataId).getScalar("AIRMASS"), 1.3184949200550,
+                                   places=11)
+
 
 class MemoryTester(lsst.utils.tests.MemoryTestCase):
     pass
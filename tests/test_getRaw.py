@@ -30,6 +30,7 @@ from lsst.obs.base import MakeRawVisitInfo
 import lsst.utils.tests
 from lsst.afw.image import RotType
 from lsst.geom import degrees, SpherePoint
+from lsst.obs.lsstSim import MakeLsstSimRawVisitInfo
 
 
 class GetRawTestCase(lsst.utils.tests.TestCase):
@@ -89,6 +90,22 @@ class GetRawTestCase(lsst.utils.tests.TestCase):
         self.assertAlmostEqual(weather.getAirPressure(), self.weath_airPressure)
         self.assertAlmostEqual(weather.getHumidity(), self.weath_humidity)
 
+    def testVisitInfoCache(self):
+        """Reads of a visit share the cached VisitInfo arguments but not their exposure IDs"""
+        makeVisitInfo = MakeLsstSimRawVisitInfo()
+        visitInfoList = []
+        for i in range(3):
+            md = self.butler.get("raw_md", visit=85471048, snap=0, raft='0,3', sensor='0,1', channel='1,0')
+            visitInfoList.append(makeVisitInfo(md, exposureId=len(visitInfoList)))
+            self.assertFalse(md.exists("RA_DEG"))
+            self.assertFalse(md.exists("TAI"))
+        self.assertEqual(len(makeVisitInfo._argDictCache), 1)
+        for i, visitInfo in enumerate(visitInfoList):
+            self.assertEqual(visitInfo.getExposureId(), i)
+            self.assertAlmostEqual(visitInfo.getDate().get(), self.dateAvg.get())
+            self.assertSpherePointsAlmostEqual(visitInfo.getBoresightRaDec(), self.boresightRaDec)
+            self.assertAlmostEqual(visitInfo.getWeather().getAirPressure(), self.weath_airPressure)
+
 
 class MemoryTester(lsst.utils.tests.MemoryTestCase):
     pass
@@ -23,6 +23,8 @@ import os
 import sys
 import unittest
 
+import numpy
+
 import lsst.afw.math as afwMath
 import lsst.daf.persistence as dafPersist
 from lsst.obs.lsstSim import LsstSimIsrTask
@@ -84,6 +86,42 @@ class LsstSimIsrTaskTestCase(unittest.TestCase):
         self.assertAlmostEqual(afwMath.makeStatistics(postIsrExp.getMaskedImage(), afwMath.MEAN).getValue(),
                                2.855780, places=3)
 
+    def testReuseBuffers(self):
+        """An exposure returned with doReuseBuffers keeps its pixels when later sensors are processed
+        """
+        config = LsstSimIsrTask.ConfigClass()
+        config.doDark = False
+        config.doFringe = False
+        config.doAssembleCcd = False
+        config.doSnapCombine = False
+        config.doLinearize = False
+        config.doWrite = False
+        config.doWriteSnaps = False
+        config.doReuseBuffers = True
+        lsstIsrTask = LsstSimIsrTask(config=config)
+        first = lsstIsrTask.runDataRef(self.ampRef).exposure
+        firstMi = first.getMaskedImage()
+        firstArrays = [arr.copy() for arr in (firstMi.getImage().getArray(), firstMi.getMask().getArray(),
+                                              firstMi.getVariance().getArray())]
+        second = lsstIsrTask.runDataRef(self.ampRef).exposure
+        self.assertFalse(numpy.shares_memory(first.getMaskedImage().getImage().getArray(),
+                                             second.getMaskedImage().getImage().getArray()))
+        second.getMaskedImage().getImage().getArray()[:] = -1.
+        second.getMaskedImage().getVariance().getArray()[:] = -1.
+        third = lsstIsrTask.runDataRef(self.ampRef).exposure
+        for arr, expected in zip((firstMi.getImage().getArray(), firstMi.getMask().getArray(),
+                                  firstMi.getVariance().getArray()), firstArrays):
+            numpy.testing.assert_array_equal(arr, expected)
+        numpy.testing.assert_array_equal(third.getMaskedImage().getImage().getArray(), firstArrays[0])
+
+        # a returned exposure given back to the task is reused for the next sensor
+        numReused = lsstIsrTask.bufferPool.numReused
+        lsstIsrTask.recycleExposure(second)
+        fourth = lsstIsrTask.runDataRef(self.ampRef).exposure
+        self.assertGreater(lsstIsrTask.bufferPool.numReused, numReused)
+        numpy.testing.assert_array_equal(fourth.getMaskedImage().getImage().getArray(), firstArrays[0])
+        numpy.testing.assert_array_equal(first.getMaskedImage().getImage().getArray(), firstArrays[0])
+
 
 class MemoryTester(lsst.utils.tests.MemoryTestCase):
     pass
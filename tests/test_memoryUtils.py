@@ -0,0 +1,78 @@
+#
+# LSST Data Management System
+# Copyright 2008-2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+import sys
+import unittest
+
+import numpy
+
+from lsst.obs.lsstSim.memoryUtils import BufferPool, getRss
+import lsst.utils.tests
+
+
+class BufferPoolTestCase(lsst.utils.tests.TestCase):
+    """A test case for the pool of reusable arrays
+    """
+
+    def testAcquireRelease(self):
+        """A released array is handed out again only for the same shape and dtype"""
+        pool = BufferPool()
+        arr = pool.acquire((3, 4), numpy.float32)
+        self.assertEqual(arr.shape, (3, 4))
+        self.assertEqual(arr.dtype, numpy.float32)
+        self.assertEqual((pool.numAllocated, pool.numReused), (1, 0))
+        pool.release(arr)
+        self.assertEqual(pool.nbytes, arr.nbytes)
+
+        other = pool.acquire((3, 4), numpy.int32)
+        self.assertIsNot(other, arr)
+        other = pool.acquire((4, 3), numpy.float32)
+        self.assertIsNot(other, arr)
+        self.assertIs(pool.acquire([3, 4], "float32"), arr)
+        self.assertEqual((pool.numAllocated, pool.numReused), (3, 1))
+        self.assertEqual(pool.nbytes, 0)
+
+        # an array is not handed out twice
+        self.assertIsNot(pool.acquire((3, 4), numpy.float32), arr)
+
+        pool.release(arr)
+        pool.clear()
+        self.assertEqual(pool.nbytes, 0)
+        self.assertIsNot(pool.acquire((3, 4), numpy.float32), arr)
+
+    def testGetRss(self):
+        current, peak = getRss()
+        self.assertGreater(peak, 0)
+        if current is not None:
+            self.assertGreater(current, 0)
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    setup_module(sys.modules[__name__])
+    unittest.main()
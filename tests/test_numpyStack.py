@@ -0,0 +1,124 @@
+#
+# LSST Data Management System
+# Copyright 2008-2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+import sys
+import unittest
+
+import numpy
+
+import lsst.afw.image as afwImage
+import lsst.afw.math as afwMath
+import lsst.geom as geom
+from lsst.obs.lsstSim.numpyStack import stackMaskedImages
+import lsst.utils.tests
+
+
+class NumpyStackTestCase(lsst.utils.tests.TestCase):
+    """A test case comparing the numpy stacker with afwMath.statisticsStack
+    """
+
+    def setUp(self):
+        rng = numpy.random.RandomState(12345)
+        self.badBit = afwImage.Mask.getPlaneBitMask("BAD")
+        self.miList = []
+        for i in range(7):
+            mi = afwImage.MaskedImageF(geom.Box2I(geom.Point2I(0, 0), geom.Extent2I(37, 29)))
+            mi.getImage().getArray()[:] = rng.normal(1000., 30., size=(29, 37))
+            mi.getImage().getArray()[rng.random_sample((29, 37)) < 0.03] = 1e5
+            mi.getVariance().getArray()[:] = rng.uniform(800., 1200., size=(29, 37))
+            mi.getMask().getArray()[rng.random_sample((29, 37)) < 0.05] = self.badBit
+            self.miList.append(mi)
+        self.statsCtrl = afwMath.StatisticsControl()
+        self.statsCtrl.setNumSigmaClip(3.)
+        self.statsCtrl.setNumIter(3)
+        self.statsCtrl.setAndMask(self.badBit)
+        # the numpy stacker's variances are those of the mean, from the input variances
+        self.statsCtrl.setCalcErrorFromInputVariance(True)
+        # a few other mask bits, which are ORed into the stack
+        for mi in self.miList:
+            mi.getMask().getArray()[rng.random_sample((29, 37)) < 0.02] |= \
+                afwImage.Mask.getPlaneBitMask("CR")
+
+    def tearDown(self):
+        del self.miList
+
+    def assertStacksAgree(self, stacked, expected):
+        """Assert that the image, variance and mask planes of two stacks agree"""
+        self.assertImagesAlmostEqual(stacked.getImage(), expected.getImage(), rtol=1e-5)
+        self.assertImagesAlmostEqual(stacked.getVariance(), expected.getVariance(), rtol=1e-5)
+        self.assertMasksEqual(stacked.getMask(), expected.getMask())
+
+    def testMatchesAfw(self):
+        """The stacked images, variances and masks agree with statisticsStack"""
+        for method, statistic in (("MEANCLIP", afwMath.MEANCLIP), ("MEDIAN", afwMath.MEDIAN)):
+            expected = afwMath.statisticsStack(self.miList, statistic, self.statsCtrl)
+            stacked = stackMaskedImages(self.miList, method=method, numSigmaClip=3., numIter=3,
+                                        andMask=self.badBit, rowsPerChunk=5)
+            self.assertStacksAgree(stacked, expected)
+
+    def testMatchesAfwWeighted(self):
+        """The weighted clipped mean agrees with statisticsStack in all three planes"""
+        weights = numpy.random.RandomState(54321).uniform(0.5, 2., size=len(self.miList)).tolist()
+        self.statsCtrl.setWeighted(True)
+        expected = afwMath.statisticsStack(self.miList, afwMath.MEANCLIP, self.statsCtrl, weights)
+        stacked = stackMaskedImages(self.miList, numSigmaClip=3., numIter=3, andMask=self.badBit,
+                                    weights=weights, rowsPerChunk=5)
+        self.assertStacksAgree(stacked, expected)
+
+    def testNoGoodPixels(self):
+        """Pixels masked in every input are flagged NO_DATA"""
+        for mi in self.miList:
+            mi.getMask().getArray()[3, 4] = self.badBit
+        stacked = stackMaskedImages(self.miList, andMask=self.badBit)
+        self.assertTrue(numpy.isnan(stacked.getImage().getArray()[3, 4]))
+        self.assertTrue(stacked.getMask().getArray()[3, 4] & afwImage.Mask.getPlaneBitMask("NO_DATA"))
+        self.assertEqual(numpy.sum(numpy.isnan(stacked.getImage().getArray())), 1)
+        self.assertTrue(numpy.isnan(stacked.getVariance().getArray()[3, 4]))
+        expected = afwMath.statisticsStack(self.miList, afwMath.MEANCLIP, self.statsCtrl)
+        self.assertMasksEqual(stacked.getMask(), expected.getMask())
+
+    def testWeightsAndVariance(self):
+        """Equal weights change nothing, and unclipped variances are those of the mean"""
+        stacked = stackMaskedImages(self.miList, andMask=self.badBit)
+        weighted = stackMaskedImages(self.miList, andMask=self.badBit, weights=[2.]*len(self.miList))
+        self.assertMaskedImagesAlmostEqual(stacked, weighted, rtol=1e-6)
+        for mi in self.miList:
+            mi.getImage().set(10.)
+            mi.getVariance().set(4.)
+            mi.getMask().set(0)
+        stacked = stackMaskedImages(self.miList)
+        self.assertFloatsAlmostEqual(stacked.getImage().getArray(), 10., rtol=1e-6)
+        self.assertFloatsAlmostEqual(stacked.getVariance().getArray(), 4./len(self.miList), rtol=1e-6)
+        with self.assertRaises(ValueError):
+            stackMaskedImages(self.miList, method="MEAN")
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    setup_module(sys.modules[__name__])
+    unittest.main()
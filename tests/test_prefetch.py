@@ -0,0 +1,144 @@
+#
+# LSST Data Management System
+# Copyright 2008-2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+import sys
+import threading
+import time
+import unittest
+
+import lsst.pipe.base as pipeBase
+from lsst.obs.lsstSim.prefetch import PrefetchIterator
+from lsst.obs.lsstSim.processCalibLsstSim import ProcessCalibLsstSimTask
+import lsst.utils.tests
+
+
+def slowSquare(x):
+    time.sleep(0.02)
+    if x < 0:
+        raise ValueError("negative item %s" % (x,))
+    return x*x
+
+
+class StubProxy:
+    """A deferred read that records the thread on which it is read"""
+
+    def __init__(self, butler, datasetType, dataId):
+        self.butler = butler
+        self.datasetType = datasetType
+        self.dataId = dataId
+
+    @property
+    def __subject__(self):
+        self.butler.readThreads.add(threading.get_ident())
+        return (self.datasetType, self.dataId)
+
+
+class StubButler:
+    """A butler that records the threads on which it is called"""
+
+    def __init__(self):
+        self.callThreads = set()
+        self.readThreads = set()
+
+    def queryMetadata(self, datasetType, key, dataId):
+        self.callThreads.add(threading.get_ident())
+        return ["r"]
+
+    def get(self, datasetType, dataId, immediate=True):
+        self.callThreads.add(threading.get_ident())
+        proxy = StubProxy(self, datasetType, dataId)
+        return proxy.__subject__ if immediate else proxy
+
+
+class PrefetchTestCase(lsst.utils.tests.TestCase):
+    """A test case for the prefetching iterator
+    """
+
+    def testOrder(self):
+        """Results come back in order whatever the depth"""
+        for depth in (0, 1, 4):
+            with PrefetchIterator(slowSquare, range(9), depth=depth) as reader:
+                self.assertEqual(reader.take(4), [0, 1, 4, 9])
+                self.assertEqual(reader.take(0), [])
+                self.assertEqual(list(reader), [16, 25, 36, 49, 64])
+                self.assertGreater(reader.readTime, 0.)
+            if depth == 0:
+                self.assertEqual(reader.hiddenTime, 0.)
+
+    def testHiddenTime(self):
+        """Reads overlapping the caller's work are reported as hidden"""
+        reader = PrefetchIterator(slowSquare, range(6), depth=2)
+        for result in reader:
+            time.sleep(0.04)
+        self.assertGreater(reader.hiddenTime, 0.5*reader.readTime)
+
+    def testException(self):
+        """A failed read is raised when its result is reached"""
+        with PrefetchIterator(slowSquare, [1, 2, -3, 4], depth=3) as reader:
+            self.assertEqual(reader.take(2), [1, 4])
+            with self.assertRaises(ValueError):
+                next(reader)
+
+    def testItemsMadeOnCallerThread(self):
+        """The items are made on the caller's thread and only the reads run on the threads"""
+        itemThreads = set()
+
+        def makeItems():
+            for x in range(8):
+                itemThreads.add(threading.get_ident())
+                yield x
+
+        with PrefetchIterator(slowSquare, makeItems(), depth=3) as reader:
+            self.assertEqual(list(reader), [x*x for x in range(8)])
+        self.assertEqual(itemThreads, {threading.get_ident()})
+
+    def testCalibButlerCalls(self):
+        """ProcessCalibLsstSimTask calls the butler on the caller's thread and reads on the threads"""
+        butler = StubButler()
+        sRefList = [pipeBase.Struct(butlerSubset=pipeBase.Struct(butler=butler), dataId=dict(visit=visit))
+                    for visit in range(4)]
+        visitIdList = [(sRef, [dict(visit=sRef.dataId["visit"], snap=snap) for snap in (0, 1)])
+                       for sRef in sRefList]
+        task = ProcessCalibLsstSimTask()
+        with PrefetchIterator(task.readVisitFrames, task.locateVisitFrames(visitIdList, "flat"),
+                              depth=3) as reader:
+            visitFramesList = list(reader)
+        self.assertEqual(butler.callThreads, {threading.get_ident()})
+        self.assertNotIn(threading.get_ident(), butler.readThreads)
+        self.assertEqual(len(visitFramesList), 4)
+        for visit, visitFrames in enumerate(visitFramesList):
+            self.assertIs(visitFrames.sensorRef, sRefList[visit])
+            self.assertEqual(visitFrames.exposureList,
+                             [("raw", dict(visit=visit, snap=snap, filter="r")) for snap in (0, 1)])
+            self.assertEqual(visitFrames.bias, ("bias", dict(visit=visit, snap=0)))
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    setup_module(sys.modules[__name__])
+    unittest.main()
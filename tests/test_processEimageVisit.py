@@ -0,0 +1,205 @@
+#
+# LSST Data Management System
+# Copyright 2008-2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+import multiprocessing
+import sys
+import unittest
+
+import numpy
+
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.geom as geom
+import lsst.pipe.base as pipeBase
+from lsst.obs.lsstSim.eimageIsr import EimageIsrTask
+from lsst.obs.lsstSim.processEimage import ProcessEimageConfig
+from lsst.obs.lsstSim.processEimageVisit import (CachingButler, ProcessEimageVisitConfig,
+                                                 ProcessEimageVisitTask)
+import lsst.utils.tests
+
+
+class CountingButler:
+    """A minimal butler that counts its reads"""
+
+    def __init__(self, datasets):
+        self.datasets = datasets
+        self.numGets = 0
+
+    def get(self, datasetType, dataId=None, immediate=True, **rest):
+        self.numGets += 1
+        return self.datasets[(datasetType, dict(dataId or {}, **rest)["id"])]
+
+    def datasetExists(self, datasetType, dataId=None, **rest):
+        return (datasetType, dict(dataId or {}, **rest)["id"]) in self.datasets
+
+
+# the ISR task made before the pool is forked, as in ProcessEimageVisitTask
+_poolState = {}
+
+
+def _noiseOfSensor(sensor):
+    """Return the noise the ISR task of the parent process adds to a blank eimage of a sensor"""
+    eimage = afwImage.ExposureI(geom.Box2I(geom.Point2I(0, 0), geom.Extent2I(23, 17)))
+    exposure, satColumns = _poolState["isrTask"].prepareExposure(
+        eimage, dict(visit=85470982, raft="2,2", sensor=sensor, snap=0))
+    return exposure.getMaskedImage().getImage().getArray().copy()
+
+
+class RefCatButler:
+    """A minimal butler holding reference catalog shards, as read by an indexed loader"""
+
+    def __init__(self, shards):
+        self.shards = shards
+        self.numGets = 0
+
+    def get(self, datasetType, dataId=None, immediate=True, **rest):
+        self.numGets += 1
+        dataId = dict(dataId or {}, **rest)
+        return self.shards[(datasetType, dataId["name"], dataId["pixel_id"])]
+
+    def datasetExists(self, datasetType, dataId=None, **rest):
+        dataId = dict(dataId or {}, **rest)
+        return (datasetType, dataId["name"], dataId["pixel_id"]) in self.shards
+
+
+class StubIndexer:
+    """An indexer whose shards near any position are 1, 2 and 3"""
+
+    def getShardIds(self, center, radius):
+        return [1, 2, 3], [True, False, True]
+
+    def makeDataId(self, pixelId, datasetName):
+        return {"pixel_id": pixelId, "name": datasetName}
+
+
+class StubSensorRef:
+    """A sensor reference with an eimage header"""
+
+    def __init__(self, md):
+        self.md = md
+
+    def get(self, datasetType):
+        return self.md
+
+
+class ProcessEimageVisitTestCase(lsst.utils.tests.TestCase):
+    """A test case for the helpers of ProcessEimageVisitTask
+    """
+
+    def testCachingButler(self):
+        """Only the cached dataset types are read once; other calls are forwarded"""
+        butler = CountingButler({("ref_cat", 1): "shard1", ("ref_cat", 2): "shard2", ("calexp", 1): "exp"})
+        cachingButler = CachingButler(butler, ["ref_cat"])
+        self.assertEqual(cachingButler.preload("ref_cat", [dict(id=1), dict(id=2), dict(id=3)]), 2)
+        self.assertEqual(butler.numGets, 2)
+        self.assertEqual(cachingButler.get("ref_cat", dict(id=2)), "shard2")
+        self.assertEqual(cachingButler.get("ref_cat", id=1), "shard1")
+        self.assertEqual(butler.numGets, 2)
+        self.assertTrue(cachingButler.datasetExists("ref_cat", dict(id=1)))
+        self.assertFalse(cachingButler.datasetExists("ref_cat", dict(id=3)))
+        self.assertEqual(cachingButler.get("calexp", dict(id=1)), "exp")
+        self.assertEqual(cachingButler.get("calexp", dict(id=1)), "exp")
+        self.assertEqual(butler.numGets, 4)
+        self.assertIs(cachingButler.datasets, butler.datasets)
+
+    def testWriteIntermediates(self):
+        """Assigning doWriteIntermediates sets the write flags of the stages before calibrate"""
+        config = ProcessEimageConfig()
+        self.assertTrue(config.doWriteIntermediates)
+        config.doWriteIntermediates = False
+        self.assertFalse(config.charImage.doWrite)
+        self.assertFalse(config.charImage.doWriteExposure)
+        self.assertTrue(config.calibrate.doWrite)
+        self.assertFalse(config.doWriteIntermediates)
+        # validate changes nothing, and a flag assigned afterwards wins
+        config.validate()
+        self.assertFalse(config.charImage.doWrite)
+        config.charImage.doWrite = True
+        config.validate()
+        self.assertTrue(config.charImage.doWrite)
+        self.assertFalse(config.charImage.doWriteExposure)
+        self.assertTrue(config.doWriteIntermediates)
+        # as in a config override file for a visit
+        visitConfig = ProcessEimageVisitConfig()
+        visitConfig.processEimage.doWriteIntermediates = False
+        self.assertFalse(visitConfig.processEimage.charImage.doWrite)
+
+    def testForkedNoise(self):
+        """CCDs processed in forked workers get different noise, the same as when run serially"""
+        config = ProcessEimageVisitConfig()
+        config.numProcesses = 2
+        config.processEimage.isr.doAddNoise = True
+        config.processEimage.isr.rngSeed = 5
+        config.validate()
+        _poolState.update(isrTask=EimageIsrTask(config=config.processEimage.isr))
+        try:
+            with multiprocessing.get_context("fork").Pool(processes=2) as pool:
+                noiseList = pool.map(_noiseOfSensor, ["1,1", "1,2"], chunksize=1)
+            serialList = [_noiseOfSensor(sensor) for sensor in ["1,1", "1,2"]]
+        finally:
+            _poolState.clear()
+        self.assertGreater(numpy.count_nonzero(noiseList[0] != noiseList[1]), 0)
+        for noise, serial in zip(noiseList, serialList):
+            self.assertFloatsEqual(noise, serial)
+
+        # the global generator would be shared by the workers
+        config.processEimage.isr.noiseRng = "global"
+        with self.assertRaises(ValueError):
+            config.validate()
+        config.numProcesses = 1
+        config.validate()
+
+    def testPreloadRefCats(self):
+        """The shards are cached under the dataset type and dataId an indexed loader reads"""
+        butler = RefCatButler({("ref_cat", "cal_ref_cat", 1): "shard1",
+                               ("ref_cat", "cal_ref_cat", 3): "shard3"})
+        loader = pipeBase.Struct(butler=butler, indexer=StubIndexer(), ref_dataset_name="cal_ref_cat")
+        wcs = afwGeom.makeSkyWcs(geom.Point2D(100., 100.),
+                                 geom.SpherePoint(53.0, -28.0, geom.degrees),
+                                 afwGeom.makeCdMatrix(scale=0.2*geom.arcseconds))
+        md = wcs.getFitsMetadata()
+        md.set("NAXIS1", 200)
+        md.set("NAXIS2", 200)
+        processEimage = pipeBase.Struct(charImage=pipeBase.Struct(refObjLoader=loader),
+                                        calibrate=pipeBase.Struct())
+        task = pipeBase.Struct(processEimage=processEimage, config=ProcessEimageVisitConfig(),
+                               log=pipeBase.Struct(info=lambda *args: None))
+        ProcessEimageVisitTask.preloadRefCats(task, butler, [StubSensorRef(md)])
+        self.assertIsInstance(loader.butler, CachingButler)
+        self.assertEqual(butler.numGets, 2)
+        # what the loader reads comes from the cache
+        self.assertEqual(loader.butler.get("ref_cat", dict(pixel_id=3, name="cal_ref_cat")), "shard3")
+        self.assertTrue(loader.butler.datasetExists("ref_cat", dict(pixel_id=1, name="cal_ref_cat")))
+        self.assertFalse(loader.butler.datasetExists("ref_cat", dict(pixel_id=2, name="cal_ref_cat")))
+        self.assertEqual(butler.numGets, 2)
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    setup_module(sys.modules[__name__])
+    unittest.main()
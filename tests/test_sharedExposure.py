@@ -0,0 +1,94 @@
+#
+# LSST Data Management System
+# Copyright 2008-2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+import multiprocessing
+import os
+import pickle
+import sys
+import tempfile
+import unittest
+
+import numpy
+
+import lsst.afw.image as afwImage
+import lsst.geom as geom
+from lsst.obs.lsstSim.sharedExposure import SharedExposure
+import lsst.utils.tests
+
+
+def _addOne(sharedExposure):
+    """Add one to the image of a shared exposure and return its metadata value"""
+    exposure = sharedExposure.getExposure()
+    exposure.getMaskedImage().getImage().getArray()[:] += 1.
+    return exposure.getMetadata().getScalar("TESTKEY")
+
+
+class SharedExposureTestCase(lsst.utils.tests.TestCase):
+    """A test case for SharedExposure
+    """
+
+    def setUp(self):
+        rng = numpy.random.RandomState(12345)
+        self.exposure = afwImage.ExposureF(geom.Box2I(geom.Point2I(5, 7), geom.Extent2I(23, 17)))
+        mi = self.exposure.getMaskedImage()
+        mi.getImage().getArray()[:] = rng.normal(size=(17, 23))
+        mi.getMask().getArray()[:] = rng.randint(0, 64, size=(17, 23))
+        mi.getVariance().getArray()[:] = rng.uniform(size=(17, 23))
+        self.exposure.getMetadata().set("TESTKEY", 42)
+        self.shmDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        os.rmdir(self.shmDir)
+
+    def testRoundTrip(self):
+        """A pickled handle maps the same pixels and carries the ExposureInfo"""
+        shared = SharedExposure.fromExposure(self.exposure, shmDir=self.shmDir)
+        try:
+            exposure = pickle.loads(pickle.dumps(shared)).getExposure()
+            self.assertEqual(exposure.getBBox(), self.exposure.getBBox())
+            self.assertMaskedImagesEqual(exposure.getMaskedImage(), self.exposure.getMaskedImage())
+            self.assertEqual(exposure.getMetadata().getScalar("TESTKEY"), 42)
+
+            pool = multiprocessing.get_context("fork").Pool(processes=1)
+            try:
+                self.assertEqual(pool.apply(_addOne, (shared,)), 42)
+            finally:
+                pool.close()
+                pool.join()
+            self.assertFloatsAlmostEqual(shared.getExposure().getMaskedImage().getImage().getArray(),
+                                         self.exposure.getMaskedImage().getImage().getArray() + 1.,
+                                         rtol=1e-6)
+        finally:
+            shared.unlink()
+        self.assertEqual(os.listdir(self.shmDir), [])
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    setup_module(sys.modules[__name__])
+    unittest.main()
@@ -0,0 +1,105 @@
+#
+# LSST Data Management System
+# Copyright 2008-2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+import sys
+import unittest
+
+import numpy
+
+import lsst.afw.image as afwImage
+import lsst.geom as geom
+from lsst.obs.lsstSim.snapAccumulator import SnapAccumulator
+from lsst.pipe.tasks.snapCombine import SnapCombineTask
+import lsst.utils.tests
+
+
+def makeSnap(value, variance, exptime, tai):
+    """Make a small constant-valued snap exposure"""
+    exposure = afwImage.ExposureF(geom.Box2I(geom.Point2I(0, 0), geom.Extent2I(20, 10)))
+    mi = exposure.getMaskedImage()
+    mi.getImage().set(value)
+    mi.getVariance().set(variance)
+    md = exposure.getMetadata()
+    md.set("EXPTIME", exptime)
+    md.set("TAI", tai)
+    return exposure
+
+
+class SnapAccumulatorTestCase(lsst.utils.tests.TestCase):
+    """A test case for SnapAccumulator
+    """
+
+    def testMatchesSnapCombine(self):
+        """Two snaps combine the same way as SnapCombineTask.addSnaps"""
+        config = SnapCombineTask.ConfigClass()
+        config.averageKeys = ("TAI",)
+        config.sumKeys = ("EXPTIME",)
+        task = SnapCombineTask(config=config)
+
+        def makeSnapList():
+            snapList = [makeSnap(10., 2., 15., 50000.), makeSnap(14., 3., 15., 50000.001)]
+            mask = snapList[1].getMaskedImage().getMask()
+            mask.getArray()[2, 3] = mask.getPlaneBitMask(config.badMaskPlanes)
+            return snapList
+
+        expected = task.addSnaps(*makeSnapList())
+
+        accumulator = SnapAccumulator(config.averageKeys, config.sumKeys, config.badMaskPlanes)
+        for snap in makeSnapList():
+            accumulator.add(snap)
+        combined = accumulator.finish()
+
+        self.assertImagesAlmostEqual(combined.getMaskedImage().getImage(),
+                                     expected.getMaskedImage().getImage())
+        self.assertImagesAlmostEqual(combined.getMaskedImage().getVariance(),
+                                     expected.getMaskedImage().getVariance())
+        self.assertAlmostEqual(combined.getMetadata().getScalar("EXPTIME"), 30.)
+        self.assertAlmostEqual(combined.getMetadata().getScalar("TAI"), 50000.0005)
+
+    def testManySnaps(self):
+        """Any number of snaps may be combined"""
+        accumulator = SnapAccumulator(averageKeys=("TAI",), sumKeys=("EXPTIME",))
+        for i in range(5):
+            accumulator.add(makeSnap(float(i), 1., 10., 50000. + i))
+        combined = accumulator.finish()
+        self.assertEqual(accumulator.numSnaps, 5)
+        numpy.testing.assert_allclose(combined.getMaskedImage().getImage().getArray(), 10.)
+        numpy.testing.assert_allclose(combined.getMaskedImage().getVariance().getArray(), 5.)
+        self.assertAlmostEqual(combined.getMetadata().getScalar("EXPTIME"), 50.)
+        self.assertAlmostEqual(combined.getMetadata().getScalar("TAI"), 50002.)
+
+    def testNoSnaps(self):
+        accumulator = SnapAccumulator(averageKeys=(), sumKeys=())
+        with self.assertRaises(RuntimeError):
+            accumulator.finish()
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    setup_module(sys.modules[__name__])
+    unittest.main()
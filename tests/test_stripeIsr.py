@@ -0,0 +1,149 @@
+#
+# LSST Data Management System
+# Copyright 2008-2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+import os
+import sys
+import unittest
+
+import numpy
+
+import lsst.afw.image as afwImage
+import lsst.daf.persistence as dafPersist
+import lsst.geom as geom
+import lsst.meas.algorithms as measAlg
+import lsst.pipe.base as pipeBase
+from lsst.obs.lsstSim import LsstSimIsrTask
+from lsst.obs.lsstSim.stripeIsr import makeStripeList, copyAmpToCcd
+import lsst.utils.tests
+
+
+class StripeIsrTestCase(lsst.utils.tests.TestCase):
+    """A test case for the stripe ISR utilities
+    """
+
+    def setUp(self):
+        butler = dafPersist.Butler(root=os.path.join(os.path.dirname(__file__), "data"))
+        self.detector = butler.get("camera")["R:0,3 S:0,1"]
+
+    def tearDown(self):
+        del self.detector
+
+    def testStripeList(self):
+        """Stripes partition the amplifiers and tile the detector"""
+        detBBox = self.detector.getBBox()
+        halo = 3
+        stripeList = makeStripeList(self.detector, ampRowsPerStripe=1, halo=halo)
+        self.assertEqual(len(stripeList), 2)
+        self.assertEqual(sum(len(stripe.ampList) for stripe in stripeList), len(self.detector))
+        self.assertEqual(stripeList[0].bbox.getMinY(), detBBox.getMinY())
+        self.assertEqual(stripeList[-1].bbox.getMaxY(), detBBox.getMaxY())
+        for stripe, nextStripe in zip(stripeList[:-1], stripeList[1:]):
+            self.assertEqual(stripe.bbox.getMaxY() + 1, nextStripe.bbox.getMinY())
+            self.assertEqual(stripe.haloBBox.getMaxY(), stripe.bbox.getMaxY() + halo)
+            self.assertEqual(nextStripe.haloBBox.getMinY(), nextStripe.bbox.getMinY() - halo)
+        self.assertTrue(detBBox.contains(stripeList[0].haloBBox))
+        self.assertTrue(detBBox.contains(stripeList[-1].haloBBox))
+
+        wholeList = makeStripeList(self.detector, ampRowsPerStripe=2)
+        self.assertEqual(len(wholeList), 1)
+        self.assertEqual(wholeList[0].bbox, detBBox)
+
+    def testCopyAmpToCcd(self):
+        """Each amplifier lands in its own bbox, flipped as required"""
+        ccdMi = afwImage.MaskedImageF(self.detector.getBBox())
+        for i, amp in enumerate(self.detector):
+            ampMi = afwImage.MaskedImageF(amp.getRawDataBBox())
+            ampArr = ampMi.getImage().getArray()
+            ampArr[:] = i
+            ampArr[0, 0] = -1
+            copyAmpToCcd(ampMi, ccdMi, amp)
+            view = ccdMi.Factory(ccdMi, amp.getBBox()).getImage().getArray()
+            y = -1 if amp.getRawFlipY() else 0
+            x = -1 if amp.getRawFlipX() else 0
+            self.assertEqual(view[y, x], -1)
+            self.assertEqual(numpy.sum(view == i), view.size - 1)
+
+    def testInterpolateStripes(self):
+        """Interpolating stripe by stripe matches interpolating the whole exposure"""
+        bbox = geom.Box2I(geom.Point2I(10, 20), geom.Extent2I(50, 60))
+        rng = numpy.random.RandomState(12345)
+        exposure = afwImage.ExposureF(bbox)
+        mi = exposure.getMaskedImage()
+        mi.getImage().getArray()[:] = rng.normal(1000., 10., size=(60, 50))
+        mi.getVariance().getArray()[:] = 100.
+        satBit = mi.getMask().getPlaneBitMask("SAT")
+        # saturated blobs away from, next to and across the stripe boundaries at y = 40 and 60
+        for x0, y0, x1, y1 in ((5, 5, 8, 7), (20, 18, 24, 21), (30, 38, 33, 43), (40, 58, 41, 61)):
+            mi.getImage().getArray()[y0:y1 + 1, x0:x1 + 1] = 5e4
+            mi.getMask().getArray()[y0:y1 + 1, x0:x1 + 1] |= satBit
+        defectList = measAlg.Defects()
+        for x0, y0, w, h in ((12, 20, 1, 60), (25, 35, 3, 10), (47, 55, 2, 2), (50, 30, 10, 1)):
+            defectList.append(measAlg.Defect(geom.Box2I(geom.Point2I(x0, y0), geom.Extent2I(w, h))))
+
+        stripeList = []
+        for y0, y1 in ((20, 39), (40, 59), (60, 79)):
+            stripeBBox = geom.Box2I(geom.Point2I(10, y0), geom.Point2I(59, y1))
+            haloBBox = geom.Box2I(stripeBBox)
+            haloBBox.grow(geom.Extent2I(0, 1))
+            haloBBox.clip(bbox)
+            stripeList.append(pipeBase.Struct(bbox=stripeBBox, haloBBox=haloBBox, ampList=[]))
+
+        for defectInterpolation in ("afw", "stencil"):
+            for doPackedDefectMask in (False, True):
+                config = LsstSimIsrTask.ConfigClass()
+                config.doSaturationInterpolation = True
+                config.growSaturationFootprintSize = 1
+                config.defectInterpolation = defectInterpolation
+                config.doPackedDefectMask = doPackedDefectMask
+                task = LsstSimIsrTask(config=config)
+
+                whole = exposure.clone()
+                task.saturationInterpolation(whole)
+                task.maskAndInterpolateDefects(whole, defectList)
+
+                striped = exposure.clone()
+                task.interpolateStripeExposure(striped, stripeList, defectList)
+                self.assertMaskedImagesEqual(striped.getMaskedImage(), whole.getMaskedImage(),
+                                             msg="%s %s" % (defectInterpolation, doPackedDefectMask))
+                self.assertFalse(numpy.array_equal(striped.getMaskedImage().getImage().getArray(),
+                                                   exposure.getMaskedImage().getImage().getArray()))
+
+    def testNumAmpThreadsRequiresStripes(self):
+        """Amplifier threads are only used by the stripe path"""
+        config = LsstSimIsrTask.ConfigClass()
+        config.numAmpThreads = 4
+        with self.assertRaises(ValueError):
+            config.validate()
+        config.doStripes = True
+        config.validate()
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    setup_module(sys.modules[__name__])
+    unittest.main()
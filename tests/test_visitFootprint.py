@@ -0,0 +1,123 @@
+#
+# LSST Data Management System
+# Copyright 2008-2017 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+import os.path
+import sys
+import unittest
+
+import lsst.afw.geom as afwGeom
+import lsst.geom as geom
+import lsst.sphgeom as sphgeom
+import lsst.utils.tests
+from lsst.obs.lsstSim import LsstSimMapper
+from lsst.obs.lsstSim.visitFootprint import VisitFootprint
+
+
+class VisitFootprintTestCase(lsst.utils.tests.TestCase):
+    """Test the vectorized detector footprints of a visit"""
+
+    def setUp(self):
+        self.mapper = LsstSimMapper(root=os.path.join(os.path.dirname(__file__), "data"))
+        self.dataId = dict(visit=85471048, snap=0, raft='0,3', sensor='0,1', channel='1,0')
+
+    def tearDown(self):
+        del self.mapper
+
+    def testCorners(self):
+        """The corners match those computed by an afw SkyWcs"""
+        mdDict = self.mapper.readMetadataBulk("raw", [self.dataId])
+        ccdExposureId, md = next(iter(mdDict.items()))
+        wcs = afwGeom.makeSkyWcs(md.deepCopy())
+        footprint = VisitFootprint.fromMetadata(mdDict)
+        self.assertEqual(len(footprint), 1)
+        width, height = md.getScalar("NAXIS1"), md.getScalar("NAXIS2")
+        pixelList = [(-0.5, -0.5), (width - 0.5, -0.5), (width - 0.5, height - 0.5), (-0.5, height - 0.5)]
+        for corner, (x, y) in zip(footprint.getCorners(ccdExposureId), pixelList):
+            expected = wcs.pixelToSky(geom.Point2D(x, y))
+            self.assertLess(corner.separation(expected).asArcseconds(), 1e-6)
+
+        # the same corners from the headers read as columns
+        columnFootprint = VisitFootprint.fromColumns(self.mapper.readMetadataColumns("raw", [self.dataId]))
+        self.assertEqual(columnFootprint.idList, [ccdExposureId])
+        self.assertFloatsEqual(columnFootprint.ra, footprint.ra)
+        self.assertFloatsEqual(columnFootprint.dec, footprint.dec)
+
+        polygon = footprint.getPolygon(ccdExposureId)
+        center = wcs.pixelToSky(geom.Point2D(0.5*(width - 1), 0.5*(height - 1)))
+        centerVector = sphgeom.UnitVector3d(sphgeom.LonLat.fromRadians(center.getRa().asRadians(),
+                                                                       center.getDec().asRadians()))
+        self.assertTrue(polygon.contains(centerVector))
+        self.assertEqual(footprint.findOverlapping(sphgeom.Circle(centerVector)), [ccdExposureId])
+        self.assertEqual(footprint.findOverlapping(sphgeom.Circle(-centerVector)), [])
+
+    def testTanSip(self):
+        """TAN-SIP WCSs are transformed with their distortion, alongside TAN ones, as by afw"""
+        mdDict = self.mapper.readMetadataBulk("raw", [self.dataId])
+        ccdExposureId, md = next(iter(mdDict.items()))
+        sipMd = md.deepCopy()
+        sipMd.set("CTYPE1", "RA---TAN-SIP")
+        sipMd.set("CTYPE2", "DEC--TAN-SIP")
+        for name, value in (("A_ORDER", 3), ("B_ORDER", 2), ("A_2_0", 1e-4), ("A_1_1", -3e-5),
+                            ("A_0_3", 2e-8), ("B_0_2", -1e-4), ("B_2_0", 5e-5)):
+            sipMd.set(name, value)
+        sipId = ccdExposureId + 1
+        footprint = VisitFootprint.fromMetadata({ccdExposureId: md, sipId: sipMd})
+        self.assertEqual(len(footprint), 2)
+        width, height = md.getScalar("NAXIS1"), md.getScalar("NAXIS2")
+        pixelList = [(-0.5, -0.5), (width - 0.5, -0.5), (width - 0.5, height - 0.5), (-0.5, height - 0.5)]
+        for detectorId, detectorMd in ((ccdExposureId, md), (sipId, sipMd)):
+            wcs = afwGeom.makeSkyWcs(detectorMd.deepCopy())
+            for corner, (x, y) in zip(footprint.getCorners(detectorId), pixelList):
+                expected = wcs.pixelToSky(geom.Point2D(x, y))
+                self.assertLess(corner.separation(expected).asArcseconds(), 1e-6)
+        # the distortion moves the far corners
+        farCorner = footprint.getCorners(ccdExposureId)[2]
+        sipFarCorner = footprint.getCorners(sipId)[2]
+        self.assertGreater(farCorner.separation(sipFarCorner).asArcseconds(), 1.)
+
+        # other projections are rejected
+        sinMd = md.deepCopy()
+        sinMd.set("CTYPE1", "RA---SIN")
+        sinMd.set("CTYPE2", "DEC--SIN")
+        with self.assertRaises(RuntimeError):
+            VisitFootprint.fromMetadata({ccdExposureId: sinMd})
+
+    def testCache(self):
+        """Footprints are cached per visit, dataset type and list of detectors"""
+        footprint = self.mapper.getVisitFootprint(85471048, datasetType="raw", dataIdList=[self.dataId])
+        self.assertIs(self.mapper.getVisitFootprint(85471048, datasetType="raw",
+                                                    dataIdList=[dict(self.dataId)]), footprint)
+        # the footprint of one detector is not that of the whole visit
+        self.assertEqual(list(self.mapper._visitFootprintCache),
+                         [("raw", 85471048, (tuple(sorted(self.dataId.items())),))])
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    setup_module(sys.modules[__name__])
+    unittest.main()